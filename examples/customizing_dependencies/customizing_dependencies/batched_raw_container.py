@@ -0,0 +1,216 @@
+# %% [markdown]
+# (batched_raw_container)=
+#
+# # Batching Raw Container Invocations
+#
+# ```{eval-rst}
+# .. tags:: Containerization, Advanced
+# ```
+#
+# The {ref}`raw container <raw_container>` example computes the area of one ellipse per container run. Every run pays
+# for scheduling a pod, pulling and starting a container, and starting the interpreter of its language, which takes
+# far longer than computing one area. To compute the areas of many ellipses, it is much cheaper to start a few
+# containers that each compute the areas of many ellipses.
+#
+# In this example, each container reads a CSV file of `a,b` rows and writes a CSV file with one `area,metadata` row
+# per input row. A dynamic workflow splits the rows into chunks and runs one container per chunk, in parallel,
+# like a map task does, and merges the results back in the order of the rows.
+# CSV files are used because every language can read and write them without extra packages.
+# %%
+import csv
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import typing
+
+import nebulakit
+from nebulakit import ContainerTask, dynamic, kwtypes, task, workflow
+from nebulakit.types.file import NebulaFile
+
+# %% [markdown]
+# ## Batched container tasks
+#
+# Nebula downloads the `rows` file to `/var/inputs/rows` before the container starts, and uploads the file the container
+# writes to `/var/outputs/areas` after it exits. The images contain the batched scripts next to the scripts of the
+# raw container example. They are built from the Dockerfiles in `raw-containers-supporting-files` and pushed to
+# the GitHub container registry with `make raw-container-images`, which has to run before the example is registered.
+# %%
+LANGUAGES = {
+    "shell": (
+        "ghcr.io/nebulaclouds/rawcontainers-shell:v3",
+        ["./calculate-ellipse-area.sh"],
+        ["./calculate-ellipse-areas.sh"],
+    ),
+    "python": (
+        "ghcr.io/nebulaclouds/rawcontainers-python:v3",
+        ["python", "calculate-ellipse-area.py"],
+        ["python", "calculate-ellipse-areas.py"],
+    ),
+    "r": (
+        "ghcr.io/nebulaclouds/rawcontainers-r:v3",
+        ["Rscript", "--vanilla", "calculate-ellipse-area.R"],
+        ["Rscript", "--vanilla", "calculate-ellipse-areas.R"],
+    ),
+    "haskell": (
+        "ghcr.io/nebulaclouds/rawcontainers-haskell:v3",
+        ["./calculate-ellipse-area"],
+        ["./calculate-ellipse-areas"],
+    ),
+    "julia": (
+        "ghcr.io/nebulaclouds/rawcontainers-julia:v3",
+        ["julia", "calculate-ellipse-area.jl"],
+        ["julia", "calculate-ellipse-areas.jl"],
+    ),
+}
+
+
+def batched_container_task(language: str) -> ContainerTask:
+    image, _, command = LANGUAGES[language]
+    return ContainerTask(
+        name=f"ellipse-areas-metadata-{language}",
+        input_data_dir="/var/inputs",
+        output_data_dir="/var/outputs",
+        inputs=kwtypes(rows=NebulaFile),
+        outputs=kwtypes(areas=NebulaFile),
+        image=image,
+        command=command + ["/var/inputs/rows", "/var/outputs/areas"],
+    )
+
+
+calculate_ellipse_areas_shell = batched_container_task("shell")
+calculate_ellipse_areas_python = batched_container_task("python")
+calculate_ellipse_areas_r = batched_container_task("r")
+calculate_ellipse_areas_haskell = batched_container_task("haskell")
+calculate_ellipse_areas_julia = batched_container_task("julia")
+
+
+# %% [markdown]
+# ## Fan-out
+#
+# `split_rows` writes the rows into chunks of `chunk_size` rows, and the dynamic workflow runs the container task of
+# the language for each chunk. Since the container tasks are not Python function tasks, they cannot be passed to
+# `map_task`, but the nodes of a dynamic workflow run in parallel all the same.
+# %%
+def write_rows(path: str, a: typing.List[float], b: typing.List[float]):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["a", "b"])
+        writer.writerows(zip(a, b))
+
+
+def read_areas(path: str) -> typing.Tuple[typing.List[float], typing.List[str]]:
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    return [float(row["area"]) for row in rows], [row["metadata"] for row in rows]
+
+
+@task
+def split_rows(a: typing.List[float], b: typing.List[float], chunk_size: int) -> typing.List[NebulaFile]:
+    if len(a) != len(b):
+        raise ValueError(f"Got {len(a)} values of a and {len(b)} values of b")
+    working_dir = nebulakit.current_context().working_directory
+    chunks = []
+    for i, start in enumerate(range(0, len(a), chunk_size)):
+        path = os.path.join(working_dir, f"rows-{i:05d}.csv")
+        write_rows(path, a[start : start + chunk_size], b[start : start + chunk_size])
+        chunks.append(NebulaFile(path))
+    return chunks
+
+
+@dynamic
+def calculate_areas_in_chunks(chunks: typing.List[NebulaFile], language: str) -> typing.List[NebulaFile]:
+    calculate = {
+        "shell": calculate_ellipse_areas_shell,
+        "python": calculate_ellipse_areas_python,
+        "r": calculate_ellipse_areas_r,
+        "haskell": calculate_ellipse_areas_haskell,
+        "julia": calculate_ellipse_areas_julia,
+    }[language]
+    return [calculate(rows=chunk) for chunk in chunks]
+
+
+@task
+def merge_areas(chunks: typing.List[NebulaFile]) -> typing.List[float]:
+    areas = []
+    for chunk in chunks:
+        chunk.download()
+        areas += read_areas(chunk.path)[0]
+    return areas
+
+
+@workflow
+def batched_wf(
+    a: typing.List[float], b: typing.List[float], language: str = "python", chunk_size: int = 10_000
+) -> typing.List[float]:
+    chunks = split_rows(a=a, b=b, chunk_size=chunk_size)
+    return merge_areas(chunks=calculate_areas_in_chunks(chunks=chunks, language=language))
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# Raw containers cannot be run locally by Nebulakit, so the benchmark runs the images with `docker run`, mounting
+# temporary directories where Nebula would mount its input and output volumes. For every language, it times
+# `per_row_runs` runs of the per-row script of the raw container example, one container per row,
+# and a single run of the batched script on `batch_rows` rows, and reports the time per row of both.
+# Most of the time per row of the per-row script is the time it takes to start a container and its interpreter.
+# The images are built locally from their Dockerfiles before timing starts, so the benchmark does not depend on
+# the images in the registry.
+# %%
+SUPPORTING_FILES_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "raw-containers-supporting-files", "per-language"
+)
+
+
+def _docker_run(image: str, command: typing.List[str], inputs_dir: str, outputs_dir: str):
+    subprocess.run(
+        ["docker", "run", "--rm", "-v", f"{inputs_dir}:/var/inputs", "-v", f"{outputs_dir}:/var/outputs", image]
+        + command,
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def benchmark(languages=tuple(LANGUAGES), per_row_runs: int = 10, batch_rows: int = 100_000):
+    if shutil.which("docker") is None:
+        raise RuntimeError("The benchmark runs the raw container images with docker, which is not installed")
+    a = [float(i % 100 + 1) for i in range(batch_rows)]
+    b = [float(i % 7 + 1) for i in range(batch_rows)]
+
+    print(f"{'language':>10} {'per-row ms/row':>15} {'batched ms/row':>15} {'speedup':>8}")
+    for language in languages:
+        image, per_row_command, batched_command = LANGUAGES[language]
+        subprocess.run(
+            ["docker", "build", "--quiet", "-t", image, os.path.join(SUPPORTING_FILES_DIR, language)],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        with tempfile.TemporaryDirectory() as inputs_dir, tempfile.TemporaryDirectory() as outputs_dir:
+            os.chmod(outputs_dir, 0o777)
+            per_row_seconds = []
+            for i in range(per_row_runs):
+                start = time.perf_counter()
+                _docker_run(image, per_row_command + [str(a[i]), str(b[i]), "/var/outputs"], inputs_dir, outputs_dir)
+                per_row_seconds.append(time.perf_counter() - start)
+
+            write_rows(os.path.join(inputs_dir, "rows"), a, b)
+            start = time.perf_counter()
+            _docker_run(image, batched_command + ["/var/inputs/rows", "/var/outputs/areas"], inputs_dir, outputs_dir)
+            batched_seconds = (time.perf_counter() - start) / batch_rows
+            if len(read_areas(os.path.join(outputs_dir, "areas"))[0]) != batch_rows:
+                raise RuntimeError(f"The batched {language} container did not write an area for every row")
+
+        per_row = statistics.median(per_row_seconds)
+        print(
+            f"{language:>10} {per_row * 1000:>15.2f} {batched_seconds * 1000:>15.4f} {per_row / batched_seconds:>8.0f}"
+        )
+
+
+# %% [markdown]
+# You can run the benchmark locally, with docker, as follows:
+# %%
+if __name__ == "__main__":
+    benchmark()
@@ -134,3 +134,13 @@ if __name__ == "__main__":
 # pynebula build --remote image_spec.py wf
 # ```
 #
+
+# %% [markdown]
+# Every distinct `ImageSpec` is a separate image to build and push. To see the images that the `ImageSpec`s of all the
+# examples resolve to, without building them, and which of them could share one image, run the following from the root
+# of the repository:
+#
+# ```
+# make analyze-image-specs
+# ```
+#
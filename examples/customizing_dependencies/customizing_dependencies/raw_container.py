@@ -167,6 +167,9 @@ def wf(a: float, b: float):
 # Raw containers cannot be run locally at the moment.
 # :::
 #
+# Each of these containers computes a single area. To compute many areas with a few containers,
+# see {ref}`batched_raw_container`.
+#
 # ## Scripts
 #
 # The contents of each script specified in the `ContainerTask` is as follows:
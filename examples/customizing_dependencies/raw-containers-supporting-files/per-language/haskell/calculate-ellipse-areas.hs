@@ -0,0 +1,23 @@
+import System.Environment
+
+calculateEllipseArea :: Double -> Double -> Double
+calculateEllipseArea a b = pi * a * b
+
+splitOn :: Char -> String -> [String]
+splitOn c s = case break (== c) s of
+  (field, []) -> [field]
+  (field, _:rest) -> field : splitOn c rest
+
+area :: String -> String
+area row =
+  let [a, b] = splitOn ',' row
+   in show (calculateEllipseArea (read a) (read b)) ++ ",[from haskell rawcontainer]"
+
+main = do
+  args <- getArgs
+  let input_path = args!!0
+      output_path = args!!1
+
+  contents <- readFile input_path
+  let rows = filter (not . null) (drop 1 (lines contents))
+  writeFile output_path (unlines ("area,metadata" : map area rows))
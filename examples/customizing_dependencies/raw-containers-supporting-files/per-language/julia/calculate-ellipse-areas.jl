@@ -0,0 +1,20 @@
+
+function calculate_area(a, b)
+    π * a * b
+end
+
+function main(input_path, output_path)
+    open(output_path, "w") do output_file
+        println(output_file, "area,metadata")
+        # skip the header row
+        for row in Iterators.drop(eachline(input_path), 1)
+            isempty(row) && continue
+            a, b = parse.(Float64, split(row, ","))
+            println(output_file, string(calculate_area(a, b)), ",[from julia rawcontainer]")
+        end
+    end
+end
+
+# the keyword ARGS is a special value that contains the command-line arguments
+# julia arrays are 1-indexed
+main(ARGS[1], ARGS[2])
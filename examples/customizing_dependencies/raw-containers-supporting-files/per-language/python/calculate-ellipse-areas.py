@@ -0,0 +1,23 @@
+import csv
+import math
+import sys
+
+
+def calculate_area(a, b):
+    return math.pi * a * b
+
+
+def main(input_path, output_path):
+    with open(input_path, newline="") as input_file, open(output_path, "w", newline="") as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(["area", "metadata"])
+        for row in csv.DictReader(input_file):
+            area = calculate_area(float(row["a"]), float(row["b"]))
+            writer.writerow([area, "[from python rawcontainer]"])
+
+
+if __name__ == "__main__":
+    input_path = sys.argv[1]
+    output_path = sys.argv[2]
+
+    main(input_path, output_path)
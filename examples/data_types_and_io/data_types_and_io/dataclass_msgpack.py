@@ -0,0 +1,313 @@
+# %% [markdown]
+# (dataclass_msgpack)=
+#
+# # Binary Data Classes with MessagePack
+#
+# ```{eval-rst}
+# .. tags:: Advanced
+# ```
+#
+# The {ref}`data class <dataclass>` example sends data classes through the default data class transformer,
+# which serializes them to JSON with Mashumaro and stores the JSON in a protobuf struct.
+# For configurations with thousands of nested entries or long numeric lists,
+# encoding and decoding the JSON becomes a noticeable part of the task startup time.
+#
+# This example adds an opt-in transformer that stores data classes as a binary literal encoded with
+# [MessagePack](https://msgpack.org/). The fields of every data class are reflected over once per type,
+# and the compiled encoders and decoders are cached, so a value is converted without looking at its type hints again.
+# Nested `NebulaFile`, `NebulaDirectory` and `StructuredDataset` fields are uploaded by their own transformers,
+# and only their URIs are stored in the binary payload.
+#
+# To begin, import the dependencies.
+# %%
+import dataclasses
+import functools
+import os
+import tempfile
+import time
+import typing
+from enum import Enum
+from typing import Type
+
+import msgpack
+import pandas as pd
+from mashumaro.mixins.json import DataClassJSONMixin
+from nebulakit import (
+    Blob,
+    BlobMetadata,
+    Literal,
+    LiteralType,
+    NebulaContext,
+    NebulaContextManager,
+    Scalar,
+    StructuredDatasetType,
+    task,
+    workflow,
+)
+from nebulakit.extend import TypeEngine, TypeTransformer
+from nebulakit.models import literals
+from nebulakit.models.literals import Binary, StructuredDatasetMetadata
+from nebulakit.models.types import SimpleType
+from nebulakit.types.directory import NebulaDirectory
+from nebulakit.types.file import NebulaFile
+from nebulakit.types.structured import StructuredDataset
+
+from .dataclass import Datum, NebulaTypes
+
+# %% [markdown]
+# ## Codecs
+#
+# A codec is a pair of functions that convert a value to and from something MessagePack can pack.
+# Primitive values, and lists and dictionaries of primitive values, are packed as they are,
+# so a list of a million floats is handed to MessagePack in one call instead of being walked element by element.
+# Data classes are packed as arrays of their field values, in the order of the fields.
+# %%
+PRIMITIVE_TYPES = (int, float, str, bool, bytes, type(None))
+T = typing.TypeVar("T")
+
+
+def _identity(value):
+    return value
+
+
+def _optional(codec: typing.Tuple[typing.Callable, typing.Callable]) -> typing.Tuple[typing.Callable, typing.Callable]:
+    encode, decode = codec
+    return (lambda v: None if v is None else encode(v)), (lambda v: None if v is None else decode(v))
+
+
+def _blob_codec(t: Type, literal_type: LiteralType) -> typing.Tuple[typing.Callable, typing.Callable]:
+    def encode(value) -> str:
+        ctx = NebulaContextManager.current_context()
+        return TypeEngine.to_literal(ctx, value, t, literal_type).scalar.blob.uri
+
+    def decode(uri: str):
+        ctx = NebulaContextManager.current_context()
+        blob = Blob(uri=uri, metadata=BlobMetadata(type=literal_type.blob))
+        return TypeEngine.to_python_value(ctx, Literal(scalar=Scalar(blob=blob)), t)
+
+    return encode, decode
+
+
+def _structured_dataset_codec(t: Type, literal_type: LiteralType) -> typing.Tuple[typing.Callable, typing.Callable]:
+    def encode(value) -> typing.List[str]:
+        ctx = NebulaContextManager.current_context()
+        sd = TypeEngine.to_literal(ctx, value, t, literal_type).scalar.structured_dataset
+        return [sd.uri, sd.metadata.structured_dataset_type.format]
+
+    def decode(value: typing.List[str]):
+        ctx = NebulaContextManager.current_context()
+        uri, file_format = value
+        sd_type = StructuredDatasetType(columns=literal_type.structured_dataset_type.columns, format=file_format)
+        sd = literals.StructuredDataset(uri=uri, metadata=StructuredDatasetMetadata(structured_dataset_type=sd_type))
+        return TypeEngine.to_python_value(ctx, Literal(scalar=Scalar(structured_dataset=sd)), t)
+
+    return encode, decode
+
+
+def _dataclass_codec(t: Type) -> typing.Tuple[typing.Callable, typing.Callable]:
+    schema = schema_for(t)
+    names = [name for name, _ in schema]
+    encoders = [encode for _, (encode, _) in schema]
+    decoders = [decode for _, (_, decode) in schema]
+
+    def encode(value) -> list:
+        return [encode_field(getattr(value, name)) for name, encode_field in zip(names, encoders)]
+
+    def decode(values: list):
+        return t(**{name: decode_field(v) for name, decode_field, v in zip(names, decoders, values)})
+
+    return encode, decode
+
+
+def codec_for(t: Type) -> typing.Tuple[typing.Callable, typing.Callable]:
+    if t in PRIMITIVE_TYPES or t is typing.Any:
+        return _identity, _identity
+    origin, args = typing.get_origin(t), typing.get_args(t)
+    if origin is typing.Union:
+        non_none = [arg for arg in args if arg is not type(None)]
+        if len(non_none) != 1:
+            raise TypeError(f"Only Optional unions are supported, got {t}")
+        return _optional(codec_for(non_none[0]))
+    if origin is list:
+        encode, decode = codec_for(args[0] if args else typing.Any)
+        if encode is _identity and decode is _identity:
+            return _identity, _identity
+        return (lambda v: [encode(x) for x in v]), (lambda v: [decode(x) for x in v])
+    if origin is dict:
+        key_type, value_type = args if args else (str, typing.Any)
+        if key_type not in (int, str):
+            raise TypeError(f"Only int and str dictionary keys are supported, got {key_type}")
+        encode, decode = codec_for(value_type)
+        if encode is _identity and decode is _identity:
+            return _identity, _identity
+        return (
+            lambda v: {k: encode(x) for k, x in v.items()},
+            lambda v: {k: decode(x) for k, x in v.items()},
+        )
+    if dataclasses.is_dataclass(t):
+        return _dataclass_codec(t)
+    if isinstance(t, type) and issubclass(t, Enum):
+        return (lambda v: v.value), t
+
+    literal_type = TypeEngine.to_literal_type(t)
+    if literal_type.blob is not None:
+        return _blob_codec(t, literal_type)
+    if literal_type.structured_dataset_type is not None:
+        return _structured_dataset_codec(t, literal_type)
+    raise TypeError(f"Type {t} is not supported by the msgpack data class transformer")
+
+
+# %% [markdown]
+# ## Schema cache
+#
+# `schema_for` resolves the type hints of a data class and compiles a codec for every field.
+# It is cached per type, so the reflection only happens the first time a type is converted.
+# %%
+@functools.lru_cache(maxsize=None)
+def schema_for(t: Type) -> typing.Tuple[typing.Tuple[str, typing.Tuple[typing.Callable, typing.Callable]], ...]:
+    hints = typing.get_type_hints(t)
+    return tuple((field.name, codec_for(hints[field.name])) for field in dataclasses.fields(t) if field.init)
+
+
+# %% [markdown]
+# ## Transformer
+#
+# The value is stored as a binary scalar tagged `msgpack`.
+# Integer dictionary keys, such as the keys of `Datum.z`, are kept as integers, unlike in JSON.
+# %%
+MSGPACK_TAG = "msgpack"
+
+
+class MsgPackDataclassTransformer(TypeTransformer[T]):
+    def __init__(self, t: Type[T]):
+        super().__init__(name=f"msgpack-{t.__name__}-transform", t=t)
+        self._encode, self._decode = _dataclass_codec(t)
+
+    def get_literal_type(self, t: Type[T]) -> LiteralType:
+        return LiteralType(simple=SimpleType.BINARY)
+
+    def to_literal(self, ctx: NebulaContext, python_val: T, python_type: Type[T], expected: LiteralType) -> Literal:
+        payload = msgpack.packb(self._encode(python_val), use_bin_type=True)
+        return Literal(scalar=Scalar(binary=Binary(value=payload, tag=MSGPACK_TAG)))
+
+    def to_python_value(self, ctx: NebulaContext, lv: Literal, expected_python_type: Type[T]) -> T:
+        binary = lv.scalar.binary
+        if binary is None or binary.tag != MSGPACK_TAG:
+            raise TypeError(f"Expected a binary literal tagged {MSGPACK_TAG}, got {lv}")
+        return self._decode(msgpack.unpackb(binary.value, raw=False, strict_map_key=False))
+
+
+# %% [markdown]
+# The encoding is opt-in per data class. `msgpack_dataclass` registers the transformer for the decorated class,
+# and other data classes keep using the JSON transformer.
+# Nested data classes do not need to be decorated, since they are encoded as part of the outer class.
+# %%
+def msgpack_dataclass(t: Type[T]) -> Type[T]:
+    TypeEngine.register(MsgPackDataclassTransformer(t))
+    return t
+
+
+# %% [markdown]
+# Let's bundle the data classes from the {ref}`data class <dataclass>` example into an experiment,
+# along with a long list of numbers.
+# %%
+@msgpack_dataclass
+@dataclasses.dataclass
+class Experiment:
+    data: typing.List[Datum]
+    inputs: NebulaTypes
+    weights: typing.List[float]
+    notes: typing.Optional[str] = None
+
+
+@task
+def create_experiment(n: int) -> Experiment:
+    df = pd.DataFrame({"Name": ["Tom", "Joseph"], "Age": [20, 22]})
+    temp_dir = tempfile.mkdtemp(prefix="nebula-")
+    df.to_parquet(os.path.join(temp_dir, "df.parquet"))
+    file_path = os.path.join(temp_dir, "hello.txt")
+    with open(file_path, "w") as f:
+        f.write("Hello, World!")
+
+    return Experiment(
+        data=[Datum(x=i, y=str(i), z={i: str(i)}) for i in range(n)],
+        inputs=NebulaTypes(
+            dataframe=StructuredDataset(dataframe=df),
+            file=NebulaFile(file_path),
+            directory=NebulaDirectory(temp_dir),
+        ),
+        weights=[i / n for i in range(n)],
+    )
+
+
+@task
+def summarize_experiment(experiment: Experiment) -> float:
+    assert experiment.data[-1].z == {len(experiment.data) - 1: str(len(experiment.data) - 1)}
+    with open(experiment.inputs.file) as f:
+        assert f.read() == "Hello, World!"
+    ages = experiment.inputs.dataframe.open(pd.DataFrame).all()["Age"]
+    return float(ages.sum()) + sum(experiment.weights)
+
+
+@workflow
+def msgpack_dataclass_wf(n: int = 1000) -> float:
+    return summarize_experiment(experiment=create_experiment(n=n))
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark converts a configuration with `n_entries` nested entries, each holding `list_size` floats,
+# to a literal and back, once through the JSON transformer and once through the msgpack transformer.
+# Both classes have the same fields.
+# %%
+@dataclasses.dataclass
+class Entry(DataClassJSONMixin):
+    name: str
+    values: typing.List[float]
+    tags: typing.Dict[str, str]
+
+
+@dataclasses.dataclass
+class Config(DataClassJSONMixin):
+    entries: typing.List[Entry]
+    scale: float
+
+
+@msgpack_dataclass
+@dataclasses.dataclass
+class PackedConfig(Config):
+    pass
+
+
+def _time(fn, repeat: int) -> typing.Tuple[float, typing.Any]:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def benchmark(n_entries: int = 5000, list_size: int = 100, repeat: int = 5):
+    ctx = NebulaContextManager.current_context()
+    entries = [
+        Entry(name=f"entry_{i}", values=[float(j) for j in range(list_size)], tags={"kind": str(i % 7)})
+        for i in range(n_entries)
+    ]
+    print(f"{'encoding':>10} {'encode s':>10} {'decode s':>10} {'size MB':>10}")
+    for name, python_type in [("json", Config), ("msgpack", PackedConfig)]:
+        value = python_type(entries=entries, scale=1.0)
+        literal_type = TypeEngine.to_literal_type(python_type)
+        encode_seconds, literal = _time(lambda: TypeEngine.to_literal(ctx, value, python_type, literal_type), repeat)
+        decode_seconds, restored = _time(lambda: TypeEngine.to_python_value(ctx, literal, python_type), repeat)
+        assert restored.entries[-1] == entries[-1]
+        scalar = literal.scalar
+        size_mb = (len(scalar.binary.value) if scalar.binary else scalar.generic.ByteSize()) / 1024 / 1024
+        print(f"{name:>10} {encode_seconds:>10.3f} {decode_seconds:>10.3f} {size_mb:>10.1f}")
+
+
+# %% [markdown]
+# You can run the workflow and the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    print(f"Experiment summary: {msgpack_dataclass_wf()}")
+    benchmark()
@@ -14,7 +14,7 @@
 # [blob type](https://github.com/nebulaclouds/nebulaidl/blob/master/protos/nebulaidl/core/types.proto#L47).
 #
 # Let's assume our mission here is pretty simple. We download a few CSV file
-# links, read them with the python built-in {py:class}`csv.DictReader` function,
+# links, read them in chunks with {py:func}`pandas.read_csv`,
 # normalize some pre-specified columns, and output the normalized columns to
 # another csv file.
 #
@@ -22,20 +22,73 @@
 # %%
 import csv
 import os
-from collections import defaultdict
+import resource
+import tempfile
+import time
 from typing import List
 
 import nebulakit
+import numpy as np
+import pandas as pd
 from nebulakit import task, workflow
 from nebulakit.types.file import NebulaFile
 
 
+# %% [markdown]
+# We define a helper function that z-score normalizes columns of a CSV file, which involves
+# mean-centering and standard-deviation-scaling.
+#
+# The file is read in chunks of `chunk_rows` rows, and all columns of a chunk are processed at once as a NumPy block,
+# so the memory used by the function is bounded by the chunk size, no matter how large the file is.
+# The first pass computes the mean and the variance of every chunk and merges them into running statistics
+# with the parallel variant of [Welford's algorithm](https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm).
+# The second pass reads the file again and streams the normalized chunks to the output file.
+# %%
+def normalize_csv(
+    input_path: str,
+    output_path: str,
+    column_names: List[str],
+    columns_to_normalize: List[str],
+    chunk_rows: int = 1_000_000,
+):
+    def blocks():
+        chunks = pd.read_csv(
+            input_path,
+            names=column_names,
+            header=0,
+            usecols=columns_to_normalize,
+            skipinitialspace=True,
+            dtype=np.float64,
+            chunksize=chunk_rows,
+        )
+        for chunk in chunks:
+            yield chunk[columns_to_normalize].to_numpy()
+
+    # first pass: merge the count, mean and sum of squared deviations of every block
+    count, mean, m2 = 0, np.zeros(len(columns_to_normalize)), np.zeros(len(columns_to_normalize))
+    for block in blocks():
+        block_count = len(block)
+        block_mean = block.mean(axis=0)
+        delta = block_mean - mean
+        total = count + block_count
+        mean = mean + delta * block_count / total
+        m2 = m2 + ((block - block_mean) ** 2).sum(axis=0) + delta**2 * count * block_count / total
+        count = total
+    std = np.sqrt(m2 / count)
+
+    # second pass: normalize every block and append it to the output file
+    with open(output_path, mode="w", newline="") as output_file:
+        csv.writer(output_file).writerow(columns_to_normalize)
+        for block in blocks():
+            normalized = pd.DataFrame((block - mean) / std, columns=columns_to_normalize)
+            normalized.to_csv(output_file, header=False, index=False)
+
+
 # %% [markdown]
 # Define a task that accepts {py:class}`~nebulakit.types.file.NebulaFile` as an input.
 # The following is a task that accepts a `NebulaFile`, a list of column names,
 # and a list of column names to normalize. The task then outputs a CSV file
-# containing only the normalized columns. For this example, we use z-score normalization,
-# which involves mean-centering and standard-deviation-scaling.
+# containing only the normalized columns.
 #
 # :::{note}
 # The `NebulaFile` literal can be scoped with a string, which gets inserted
@@ -53,32 +106,12 @@ def normalize_columns(
     columns_to_normalize: List[str],
     output_location: str,
 ) -> NebulaFile:
-    # read the data from the raw csv file
-    parsed_data = defaultdict(list)
-    with open(csv_url, newline="\n") as input_file:
-        reader = csv.DictReader(input_file, fieldnames=column_names)
-        next(reader)  # Skip header
-        for row in reader:
-            for column in columns_to_normalize:
-                parsed_data[column].append(float(row[column].strip()))
-
-    # normalize the data
-    normalized_data = defaultdict(list)
-    for colname, values in parsed_data.items():
-        mean = sum(values) / len(values)
-        std = (sum([(x - mean) ** 2 for x in values]) / len(values)) ** 0.5
-        normalized_data[colname] = [(x - mean) / std for x in values]
-
     # write to local path
     out_path = os.path.join(
         nebulakit.current_context().working_directory,
         f"normalized-{os.path.basename(csv_url.path).rsplit('.')[0]}.csv",
     )
-    with open(out_path, mode="w") as output_file:
-        writer = csv.DictWriter(output_file, fieldnames=columns_to_normalize)
-        writer.writeheader()
-        for row in zip(*normalized_data.values()):
-            writer.writerow({k: row[i] for i, k in enumerate(columns_to_normalize)})
+    normalize_csv(csv_url, out_path, column_names, columns_to_normalize)
 
     if output_location:
         return NebulaFile(path=out_path, remote_path=output_location)
@@ -117,7 +150,34 @@ def normalize_csv_file(
 
 
 # %% [markdown]
-# You can run the workflow locally as follows:
+# ## Benchmark
+#
+# The benchmark generates a CSV file with `n_rows` rows and normalizes all of its columns.
+# Both the file generation and the normalization work in chunks, so the peak resident set size stays
+# roughly constant as `n_rows` grows.
+# %%
+def benchmark(n_rows: int = 10_000_000, n_cols: int = 5, chunk_rows: int = 1_000_000):
+    column_names = [f"col_{i}" for i in range(n_cols)]
+    with tempfile.TemporaryDirectory() as working_dir:
+        input_path = os.path.join(working_dir, "input.csv")
+        rng = np.random.default_rng(0)
+        with open(input_path, mode="w", newline="") as input_file:
+            csv.writer(input_file).writerow(column_names)
+            for start in range(0, n_rows, chunk_rows):
+                block = rng.normal(size=(min(chunk_rows, n_rows - start), n_cols))
+                pd.DataFrame(block).to_csv(input_file, header=False, index=False)
+
+        start = time.perf_counter()
+        normalize_csv(input_path, os.path.join(working_dir, "output.csv"), column_names, column_names, chunk_rows)
+        seconds = time.perf_counter() - start
+
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Normalized {n_rows} rows in {seconds:.1f}s ({n_rows / seconds:,.0f} rows/s), peak RSS {peak_mb:.0f} MB")
+
+
+# %% [markdown]
+# You can run the workflow locally as follows. The benchmark writes a large file to the temporary directory, about 1 GB
+# for ten million rows, so it only runs when `BENCHMARK_ROWS` is set, for instance to `10000000`.
 # %%
 if __name__ == "__main__":
     default_files = [
@@ -140,3 +200,6 @@ if __name__ == "__main__":
             columns_to_normalize=columns_to_normalize,
         )
         print(f"Running normalize_csv_file workflow on {csv_url}: " f"{normalized_columns}")
+
+    if os.environ.get("BENCHMARK_ROWS"):
+        benchmark(n_rows=int(os.environ["BENCHMARK_ROWS"]))
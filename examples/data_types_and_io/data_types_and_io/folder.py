@@ -13,10 +13,8 @@
 #
 # To begin, import the libraries.
 # %%
-import csv
 import os
 import urllib.request
-from collections import defaultdict
 from pathlib import Path
 from typing import List
 
@@ -24,6 +22,8 @@ import nebulakit
 from nebulakit import task, workflow
 from nebulakit.types.directory import NebulaDirectory
 
+from .file import normalize_csv
+
 
 # %% [markdown]
 # Building upon the previous example demonstrated in the {std:ref}`file <file>` section,
@@ -68,7 +68,8 @@ def download_files(csv_urls: List[str]) -> NebulaDirectory:
 # Similarly, for outputs, Nebulakit uploads the resulting directory in chunks of 100.
 # :::
 #
-# We define a helper function to normalize the columns in-place.
+# We define a helper function to normalize the columns in-place,
+# reusing the chunked `normalize_csv` function from the {std:ref}`file <file>` example.
 #
 # :::{note}
 # This is a plain Python function that will be called in a subsequent Nebula task. This example
@@ -81,27 +82,10 @@ def normalize_columns(
     column_names: List[str],
     columns_to_normalize: List[str],
 ):
-    # read the data from the raw csv file
-    parsed_data = defaultdict(list)
-    with open(local_csv_file, newline="\n") as input_file:
-        reader = csv.DictReader(input_file, fieldnames=column_names)
-        for row in (x for i, x in enumerate(reader) if i > 0):
-            for column in columns_to_normalize:
-                parsed_data[column].append(float(row[column].strip()))
-
-    # normalize the data
-    normalized_data = defaultdict(list)
-    for colname, values in parsed_data.items():
-        mean = sum(values) / len(values)
-        std = (sum([(x - mean) ** 2 for x in values]) / len(values)) ** 0.5
-        normalized_data[colname] = [(x - mean) / std for x in values]
-
+    normalized_csv_file = f"{local_csv_file}.normalized"
+    normalize_csv(local_csv_file, normalized_csv_file, column_names, columns_to_normalize)
     # overwrite the csv file with the normalized columns
-    with open(local_csv_file, mode="w") as output_file:
-        writer = csv.DictWriter(output_file, fieldnames=columns_to_normalize)
-        writer.writeheader()
-        for row in zip(*normalized_data.values()):
-            writer.writerow({k: row[i] for i, k in enumerate(columns_to_normalize)})
+    os.replace(normalized_csv_file, local_csv_file)
 
 
 # %% [markdown]
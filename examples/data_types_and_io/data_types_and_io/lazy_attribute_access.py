@@ -0,0 +1,300 @@
+# %% [markdown]
+# (lazy_attribute_access)=
+#
+# # Lazy Element Access
+#
+# ```{eval-rst}
+# .. tags:: Advanced
+# ```
+#
+# In the {ref}`attribute access <attribute_access>` example, `print_str(a=o[0])` passes a single element of a list
+# to a downstream task. The list is stored as a single literal, though, so the element is resolved by loading the whole
+# collection and then indexing it. When the upstream task returns a list with a million elements or a huge dictionary,
+# every downstream task pays for the full payload to read a single entry.
+#
+# This example defines `IndexedList` and `IndexedDict` types that offload their elements to the blob store
+# in an indexed layout. A downstream task receives a reference to the collection,
+# and only the elements it accesses are fetched, each with a range request.
+#
+# To begin, import the dependencies.
+# %%
+import os
+import time
+import typing
+from collections.abc import Mapping, Sequence
+from dataclasses import dataclass
+from typing import Type
+
+import msgpack
+import numpy as np
+from dataclasses_json import dataclass_json
+from nebulakit import (
+    Blob,
+    BlobMetadata,
+    BlobType,
+    Literal,
+    LiteralType,
+    NebulaContext,
+    NebulaContextManager,
+    Scalar,
+    task,
+    workflow,
+)
+from nebulakit.extend import TypeEngine, TypeTransformer
+
+from .dataclass_msgpack import codec_for
+
+T = typing.TypeVar("T")
+K = typing.TypeVar("K", int, str)
+
+# %% [markdown]
+# ## Indexed layout
+#
+# A collection is stored as a multi-part blob with three files:
+#
+# - `values` holds the elements, each packed with the MessagePack codecs of the
+#   {ref}`binary data class <dataclass_msgpack>` example, one after the other,
+# - `offsets` holds `n + 1` little-endian 64-bit offsets, so element `i` spans `offsets[i]:offsets[i + 1]`, and
+# - `keys`, for dictionaries only, holds the keys in the order of the values.
+#
+# Reading element `i` of a list takes two range requests, one for its two offsets and one for its bytes.
+# A dictionary also loads its keys the first time it is accessed, but never the values it doesn't need.
+# %%
+VALUES_FILE = "values"
+OFFSETS_FILE = "offsets"
+KEYS_FILE = "keys"
+
+
+def write_elements(local_dir: str, values: typing.Iterable, element_type: Type) -> int:
+    encode, _ = codec_for(element_type)
+    offsets = [0]
+    with open(os.path.join(local_dir, VALUES_FILE), "wb") as f:
+        for value in values:
+            offsets.append(offsets[-1] + f.write(msgpack.packb(encode(value), use_bin_type=True)))
+    np.asarray(offsets, dtype="<u8").tofile(os.path.join(local_dir, OFFSETS_FILE))
+    return len(offsets) - 1
+
+
+class ElementStore:
+    def __init__(self, uri: str, element_type: Type):
+        ctx = NebulaContextManager.current_context()
+        self._uri = uri
+        self._fs = ctx.file_access.get_filesystem_for_path(uri)
+        self._decode = codec_for(element_type)[1]
+        self.count = self._fs.size(os.path.join(uri, OFFSETS_FILE)) // 8 - 1
+
+    def _unpack(self, data: bytes):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    def get(self, index: int):
+        offsets = self._fs.cat_file(os.path.join(self._uri, OFFSETS_FILE), start=8 * index, end=8 * index + 16)
+        start, end = np.frombuffer(offsets, dtype="<u8")
+        data = self._fs.cat_file(os.path.join(self._uri, VALUES_FILE), start=int(start), end=int(end))
+        return self._decode(self._unpack(data))
+
+    def keys(self) -> list:
+        return self._unpack(self._fs.cat_file(os.path.join(self._uri, KEYS_FILE)))
+
+
+# %% [markdown]
+# ## Lazy collections
+#
+# On the producer side, `IndexedList` and `IndexedDict` wrap a plain list or dictionary.
+# On the consumer side, they are backed by an `ElementStore`, and behave like read-only sequences and mappings.
+# The element type is taken from the type parameter, for instance `IndexedList[str]`.
+# %%
+class IndexedList(Sequence, typing.Generic[T]):
+    def __init__(self, items: typing.Optional[typing.List[T]] = None):
+        self._items = items
+        self._store: typing.Optional[ElementStore] = None
+
+    @classmethod
+    def _from_store(cls, store: ElementStore) -> "IndexedList":
+        lazy = cls()
+        lazy._store = store
+        return lazy
+
+    def __len__(self) -> int:
+        return len(self._items) if self._items is not None else self._store.count
+
+    def __getitem__(self, index):
+        if self._items is not None:
+            return self._items[index]
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Index {index} is out of range for a list of length {len(self)}")
+        return self._store.get(index)
+
+
+class IndexedDict(Mapping, typing.Generic[K, T]):
+    def __init__(self, items: typing.Optional[typing.Dict[K, T]] = None):
+        self._items = items
+        self._store: typing.Optional[ElementStore] = None
+        self._positions: typing.Optional[typing.Dict[K, int]] = None
+
+    @classmethod
+    def _from_store(cls, store: ElementStore) -> "IndexedDict":
+        lazy = cls()
+        lazy._store = store
+        return lazy
+
+    def _index(self) -> typing.Dict[K, int]:
+        if self._positions is None:
+            self._positions = {key: i for i, key in enumerate(self._store.keys())}
+        return self._positions
+
+    def __len__(self) -> int:
+        return len(self._items) if self._items is not None else self._store.count
+
+    def __iter__(self):
+        return iter(self._items if self._items is not None else self._index())
+
+    def __getitem__(self, key: K) -> T:
+        if self._items is not None:
+            return self._items[key]
+        return self._store.get(self._index()[key])
+
+
+# %% [markdown]
+# ## Transformers
+#
+# Both transformers write the indexed layout to a local directory and upload it as a multi-part blob.
+# `to_python_value` only looks up the size of the offsets file.
+# %%
+class IndexedListTransformer(TypeTransformer[IndexedList]):
+    _TYPE_INFO = BlobType(format="IndexedList", dimensionality=BlobType.BlobDimensionality.MULTIPART)
+
+    def __init__(self):
+        super().__init__(name="indexed-list-transform", t=IndexedList)
+
+    def get_literal_type(self, t: Type[IndexedList]) -> LiteralType:
+        return LiteralType(blob=self._TYPE_INFO)
+
+    def to_literal(
+        self, ctx: NebulaContext, python_val: IndexedList, python_type: Type[IndexedList], expected: LiteralType
+    ) -> Literal:
+        (element_type,) = typing.get_args(python_type) or (typing.Any,)
+        local_dir = ctx.file_access.get_random_local_directory()
+        write_elements(local_dir, python_val, element_type)
+
+        remote_dir = ctx.file_access.get_random_remote_directory()
+        ctx.file_access.upload_directory(local_dir, remote_dir)
+        return Literal(scalar=Scalar(blob=Blob(uri=remote_dir, metadata=BlobMetadata(type=self._TYPE_INFO))))
+
+    def to_python_value(self, ctx: NebulaContext, lv: Literal, expected_python_type: Type[IndexedList]) -> IndexedList:
+        (element_type,) = typing.get_args(expected_python_type) or (typing.Any,)
+        return IndexedList._from_store(ElementStore(lv.scalar.blob.uri, element_type))
+
+
+class IndexedDictTransformer(TypeTransformer[IndexedDict]):
+    _TYPE_INFO = BlobType(format="IndexedDict", dimensionality=BlobType.BlobDimensionality.MULTIPART)
+
+    def __init__(self):
+        super().__init__(name="indexed-dict-transform", t=IndexedDict)
+
+    def get_literal_type(self, t: Type[IndexedDict]) -> LiteralType:
+        return LiteralType(blob=self._TYPE_INFO)
+
+    def to_literal(
+        self, ctx: NebulaContext, python_val: IndexedDict, python_type: Type[IndexedDict], expected: LiteralType
+    ) -> Literal:
+        _, value_type = typing.get_args(python_type) or (str, typing.Any)
+        local_dir = ctx.file_access.get_random_local_directory()
+        keys = list(python_val.keys())
+        write_elements(local_dir, (python_val[key] for key in keys), value_type)
+        with open(os.path.join(local_dir, KEYS_FILE), "wb") as f:
+            f.write(msgpack.packb(keys, use_bin_type=True))
+
+        remote_dir = ctx.file_access.get_random_remote_directory()
+        ctx.file_access.upload_directory(local_dir, remote_dir)
+        return Literal(scalar=Scalar(blob=Blob(uri=remote_dir, metadata=BlobMetadata(type=self._TYPE_INFO))))
+
+    def to_python_value(self, ctx: NebulaContext, lv: Literal, expected_python_type: Type[IndexedDict]) -> IndexedDict:
+        _, value_type = typing.get_args(expected_python_type) or (str, typing.Any)
+        return IndexedDict._from_store(ElementStore(lv.scalar.blob.uri, value_type))
+
+
+TypeEngine.register(IndexedListTransformer())
+TypeEngine.register(IndexedDictTransformer())
+
+
+# %% [markdown]
+# Promises of these types are references to the stored collection, so instead of indexing the promise in the workflow,
+# pass the collection to the downstream task along with the index or key, and access the element there.
+# Nested elements, such as the data class below, are only decoded when they are accessed.
+# %%
+@dataclass_json
+@dataclass
+class foo:
+    a: str
+
+
+@task
+def list_task(n: int) -> IndexedList[str]:
+    return IndexedList([str(i) for i in range(n)])
+
+
+@task
+def dict_task(n: int) -> IndexedDict[str, foo]:
+    return IndexedDict({str(i): foo(a=str(i)) for i in range(n)})
+
+
+@task
+def print_element(items: IndexedList[str], index: int):
+    print(items[index])
+
+
+@task
+def print_attribute(items: IndexedDict[str, foo], key: str):
+    print(items[key].a)
+
+
+@workflow
+def lazy_access_wf(n: int = 100_000):
+    print_element(items=list_task(n=n), index=0)
+    print_attribute(items=dict_task(n=n), key="42")
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark stores lists and dictionaries of increasing size, as plain `List[str]` and `Dict[str, str]` literals
+# and as indexed collections, and measures the time it takes a downstream task to convert its input
+# and read a single element.
+# %%
+def _access_seconds(python_type: Type, literal: Literal, key, repeat: int) -> float:
+    ctx = NebulaContextManager.current_context()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        TypeEngine.to_python_value(ctx, literal, python_type)[key]
+    return (time.perf_counter() - start) / repeat
+
+
+def benchmark(sizes=(1_000, 10_000, 100_000, 1_000_000), repeat: int = 3):
+    ctx = NebulaContextManager.current_context()
+    print(f"{'size':>10} {'List ms':>10} {'IndexedList ms':>15} {'Dict ms':>10} {'IndexedDict ms':>15}")
+    for size in sizes:
+        items = [f"element_{i}" for i in range(size)]
+        key = size // 2
+        cases = [
+            (typing.List[str], items, key),
+            (IndexedList[str], IndexedList(items), key),
+            (typing.Dict[str, str], dict(zip(items, items)), items[key]),
+            (IndexedDict[str, str], IndexedDict(dict(zip(items, items))), items[key]),
+        ]
+        timings = []
+        for python_type, value, element_key in cases:
+            literal = TypeEngine.to_literal(ctx, value, python_type, TypeEngine.to_literal_type(python_type))
+            timings.append(_access_seconds(python_type, literal, element_key, repeat) * 1000)
+        print(f"{size:>10} {timings[0]:>10.2f} {timings[1]:>15.2f} {timings[2]:>10.2f} {timings[3]:>15.2f}")
+
+
+# %% [markdown]
+# You can run the workflow and the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    lazy_access_wf(n=1000)
+    benchmark()
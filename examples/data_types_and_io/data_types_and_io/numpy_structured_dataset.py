@@ -0,0 +1,276 @@
+# %% [markdown]
+# (numpy_structured_dataset)=
+#
+# # Zero-Copy NumPy Structured Datasets
+#
+# ```{eval-rst}
+# .. tags:: DataFrame, Intermediate
+# ```
+# ```{currentmodule} nebulakit.types.structured
+# ```
+#
+# The {ref}`structured dataset <structured_dataset>` example shows how to build a NumPy encoder and decoder.
+# Those handlers are deliberately minimal: the encoder writes a parquet file to a local directory before uploading it,
+# and the decoder downloads the whole directory and converts the table to pandas before converting it to NumPy,
+# which costs two full copies of the array. Beyond a few hundred megabytes that becomes impractical.
+#
+# This example builds handlers that scale to arrays of several gigabytes. They
+#
+# - write straight to the remote path, so the array is never serialized to local disk first,
+# - preserve the dtype and the full shape of N-dimensional arrays, and
+# - decode numeric arrays through a memory-mapped, uncompressed
+#   [Arrow IPC](https://arrow.apache.org/docs/format/Columnar.html#ipc-file-format) file, so the array data is read
+#   straight out of the page cache without being deserialized or copied, whatever the size of the array.
+#
+# To begin, import the dependencies.
+# %%
+import json
+import multiprocessing
+import os
+import resource
+import time
+import typing
+
+import numpy as np
+import pyarrow as pa
+from nebulakit import NebulaContext, NebulaContextManager, StructuredDatasetType, task, workflow
+from nebulakit.models import literals
+from nebulakit.models.literals import StructuredDatasetMetadata
+from nebulakit.types.structured.structured_dataset import (
+    StructuredDataset,
+    StructuredDatasetDecoder,
+    StructuredDatasetEncoder,
+    StructuredDatasetTransformerEngine,
+)
+from typing_extensions import Annotated
+
+# %% [markdown]
+# The handlers are registered under their own byte format, so they coexist with the parquet handlers
+# from the structured dataset example. Every dataset is stored as a single part file inside the dataset directory.
+# %%
+ARROW_IPC = "arrow"
+PART_FILE_NAME = "00000"
+SHAPE_KEY = b"nebula.numpy.shape"
+DTYPE_KEY = b"nebula.numpy.dtype"
+
+
+# %% [markdown]
+# ## Layout
+#
+# An N-dimensional array is stored as a single Arrow column of fixed-size lists:
+# every entry along the first axis becomes one row holding the flattened trailing dimensions.
+# The original shape and dtype are kept in the schema metadata, so the decoder can restore the exact array.
+#
+# The helpers below only wrap or unwrap buffers. For numeric dtypes, Arrow references the NumPy memory directly,
+# and no copy is made. Record batches are not contiguous in the file, since every batch is preceded by its own
+# metadata, so only an array stored as a single record batch can be decoded without a copy.
+#
+# Arrow has no complex type, so complex arrays are stored as pairs of floats, with twice as many values per row,
+# and viewed as complex numbers again when they are decoded.
+# %%
+def _to_record_batch(arr: np.ndarray) -> pa.RecordBatch:
+    flat = np.ascontiguousarray(arr).reshape(-1)
+    if arr.dtype.kind == "c":
+        flat = flat.view(np.finfo(arr.dtype).dtype)
+    row_size = int(np.prod(arr.shape[1:], dtype=np.int64)) * (arr.dtype.itemsize // flat.itemsize)
+    values = pa.FixedSizeListArray.from_arrays(pa.array(flat), row_size)
+    return pa.RecordBatch.from_arrays([values], names=["values"])
+
+
+def values_to_numpy(values: pa.Array, dtype: np.dtype) -> np.ndarray:
+    flat = values.to_numpy(zero_copy_only=dtype.kind not in "OUb")
+    return flat.view(dtype) if dtype.kind == "c" else flat.astype(dtype, copy=False)
+
+
+def _schema_for(arr: np.ndarray) -> pa.Schema:
+    return _to_record_batch(arr[:1]).schema.with_metadata(
+        {SHAPE_KEY: json.dumps(list(arr.shape)), DTYPE_KEY: arr.dtype.str}
+    )
+
+
+def _from_chunks(chunks: typing.List[pa.FixedSizeListArray], schema: pa.Schema) -> np.ndarray:
+    shape = tuple(json.loads(schema.metadata[SHAPE_KEY]))
+    dtype = np.dtype(schema.metadata[DTYPE_KEY].decode())
+    # A single record batch maps to a single contiguous buffer in the file, which is returned as is.
+    # Multiple batches, which the encoder only writes for non-numeric dtypes, are stitched together with one copy.
+    parts = [values_to_numpy(chunk.flatten(), dtype) for chunk in chunks]
+    flat = parts[0] if len(parts) == 1 else np.concatenate(parts)
+    return flat.reshape(shape)
+
+
+# %% [markdown]
+# ## Streaming encoder
+#
+# The encoder opens the remote part file through the filesystem that Nebula uses for the raw output prefix.
+# A numeric array is wrapped without a copy, so it is written as a single record batch, the Arrow counterpart of
+# a parquet row group, which the decoder can map as a whole. Arrays of other dtypes, such as booleans and strings,
+# are converted as they are wrapped, so they are written in chunks of `chunk_bytes`, one record batch per chunk,
+# and only one converted chunk is held in memory at a time.
+#
+# Arrow only reads values in the native byte order, so an array in another byte order, such as `>i4`, is converted
+# first, with a copy. Arrow cannot store rows without values either, so arrays with a zero-sized trailing dimension
+# are rejected.
+# %%
+ZERO_COPY_KINDS = "iufc"
+
+
+class NumpyArrowEncodingHandler(StructuredDatasetEncoder):
+    def __init__(self, chunk_bytes: int = 64 * 1024 * 1024):
+        super().__init__(np.ndarray, None, ARROW_IPC)
+        self._chunk_bytes = chunk_bytes
+
+    def encode(
+        self,
+        ctx: NebulaContext,
+        structured_dataset: StructuredDataset,
+        structured_dataset_type: StructuredDatasetType,
+    ) -> literals.StructuredDataset:
+        arr = typing.cast(np.ndarray, structured_dataset.dataframe)
+        if arr.ndim == 0:
+            raise ValueError("Zero-dimensional arrays cannot be stored as a structured dataset")
+        if 0 in arr.shape[1:]:
+            raise TypeError(f"Arrays of shape {arr.shape} have empty rows, which Arrow cannot store")
+        if not arr.dtype.isnative:
+            arr = arr.astype(arr.dtype.newbyteorder("="))
+
+        uri = typing.cast(str, structured_dataset.uri) or ctx.file_access.get_random_remote_directory()
+        fs = ctx.file_access.get_filesystem_for_path(uri)
+        fs.makedirs(uri, exist_ok=True)
+
+        if arr.dtype.kind in ZERO_COPY_KINDS:
+            chunk_rows = max(len(arr), 1)
+        else:
+            chunk_rows = max(1, self._chunk_bytes // max(1, arr[:1].nbytes))
+        with fs.open(os.path.join(uri, PART_FILE_NAME), "wb") as sink:
+            with pa.ipc.new_file(sink, _schema_for(arr)) as writer:
+                for start in range(0, max(len(arr), 1), chunk_rows):
+                    writer.write_batch(_to_record_batch(arr[start : start + chunk_rows]))
+
+        structured_dataset_type.format = ARROW_IPC
+        return literals.StructuredDataset(
+            uri=uri,
+            metadata=StructuredDatasetMetadata(structured_dataset_type=structured_dataset_type),
+        )
+
+
+# %% [markdown]
+# ## Memory-mapped decoder
+#
+# Memory mapping requires a local file, so the part file is fetched first when the dataset lives in a blob store.
+# The Arrow IPC reader then exposes the record batches as views into the mapped file, and
+# `to_numpy(zero_copy_only=True)` turns them into NumPy arrays without touching the data.
+#
+# :::{note}
+# A numeric array is a read-only view of the mapped file.
+# Call `.copy()` on it if the task needs to modify it in place.
+# :::
+# %%
+class NumpyArrowDecodingHandler(StructuredDatasetDecoder):
+    def __init__(self):
+        super().__init__(np.ndarray, None, ARROW_IPC)
+
+    def decode(
+        self,
+        ctx: NebulaContext,
+        nebula_value: literals.StructuredDataset,
+        current_task_metadata: StructuredDatasetMetadata,
+    ) -> np.ndarray:
+        local_path = local_part_file(ctx, nebula_value.uri)
+        reader = pa.ipc.open_file(pa.memory_map(local_path, "r"))
+        chunks = [reader.get_batch(i).column(0) for i in range(reader.num_record_batches)]
+        return _from_chunks(chunks, reader.schema)
+
+
+def local_part_file(ctx: NebulaContext, uri: str) -> str:
+    if not ctx.file_access.is_remote(uri):
+        return os.path.join(uri, PART_FILE_NAME)
+    local_dir = ctx.file_access.get_random_local_directory()
+    ctx.file_access.get_data(uri, local_dir, is_multipart=True)
+    return os.path.join(local_dir, PART_FILE_NAME)
+
+
+# %% [markdown]
+# Register the handlers with the `StructuredDatasetTransformerEngine`.
+# %%
+StructuredDatasetTransformerEngine.register(NumpyArrowEncodingHandler())
+StructuredDatasetTransformerEngine.register(NumpyArrowDecodingHandler())
+
+
+# %% [markdown]
+# Annotate a `StructuredDataset` with the `ARROW_IPC` format to select the new handlers.
+# The dtype and the three-dimensional shape of the array survive the round trip.
+# %%
+@task
+def generate_volume(n: int) -> Annotated[StructuredDataset, ARROW_IPC]:
+    volume = np.arange(n * 4 * 3, dtype=np.float32).reshape(n, 4, 3)
+    return StructuredDataset(dataframe=volume)
+
+
+@task
+def volume_mean(sd: Annotated[StructuredDataset, ARROW_IPC]) -> float:
+    volume = sd.open(np.ndarray).all()
+    assert volume.shape[1:] == (4, 3) and volume.dtype == np.float32
+    return float(volume.mean())
+
+
+@workflow
+def numpy_arrow_wf(n: int = 10) -> float:
+    return volume_mean(sd=generate_volume(n=n))
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark encodes and decodes a float64 array of `size_mb` megabytes with both the parquet handlers
+# from the {ref}`structured dataset <structured_dataset>` example and the Arrow IPC handlers above.
+# Every case runs in a fresh process, so the peak resident set size reported for a case is not inflated by the previous one.
+# With a 1 GB array, the parquet handlers peak at several times the array size, whereas the
+# Arrow IPC handlers stay close to the size of the array itself: the decoded array is a view of the mapped file,
+# whose pages are counted in the resident set size once they are read.
+# %%
+def _run_case(handler_format: str, size_mb: int, results: multiprocessing.Queue):
+    from .structured_dataset import PARQUET, NumpyDecodingHandler, NumpyEncodingHandler
+
+    handlers = {
+        PARQUET: (NumpyEncodingHandler(np.ndarray, None, PARQUET), NumpyDecodingHandler(np.ndarray, None, PARQUET)),
+        ARROW_IPC: (NumpyArrowEncodingHandler(), NumpyArrowDecodingHandler()),
+    }
+    encoder, decoder = handlers[handler_format]
+    ctx = NebulaContextManager.current_context()
+
+    # The parquet handlers turn every row of a 2D array into a column, so keep the number of rows small.
+    arr = np.random.default_rng(0).random((16, size_mb * 1024 * 1024 // (16 * 8)))
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    sd_type = StructuredDatasetType(format=handler_format)
+    literal = encoder.encode(ctx, StructuredDataset(dataframe=arr), sd_type)
+    encode_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoded = decoder.decode(ctx, literal, StructuredDatasetMetadata(structured_dataset_type=sd_type))
+    checksum = float(np.asarray(decoded).sum())
+    decode_seconds = time.perf_counter() - start
+
+    peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss) / 1024
+    results.put((handler_format, size_mb / encode_seconds, size_mb / decode_seconds, peak_mb, checksum))
+
+
+def benchmark(size_mb: int = 1024):
+    mp_ctx = multiprocessing.get_context("spawn")
+    results = mp_ctx.Queue()
+    print(f"{'format':>8} {'encode MB/s':>12} {'decode MB/s':>12} {'peak RSS MB':>12}")
+    for handler_format in ("parquet", ARROW_IPC):
+        process = mp_ctx.Process(target=_run_case, args=(handler_format, size_mb, results))
+        process.start()
+        process.join()
+        name, encode_rate, decode_rate, peak_mb, _ = results.get()
+        print(f"{name:>8} {encode_rate:>12.1f} {decode_rate:>12.1f} {peak_mb:>12.1f}")
+
+
+# %% [markdown]
+# You can run the workflow and the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    print(f"Mean of the decoded volume: {numpy_arrow_wf()}")
+    benchmark(size_mb=int(os.environ.get("BENCHMARK_SIZE_MB", "1024")))
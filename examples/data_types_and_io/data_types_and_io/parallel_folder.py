@@ -0,0 +1,434 @@
+# %% [markdown]
+# (parallel_folder)=
+#
+# # Parallel Directory Ingest
+#
+# ```{eval-rst}
+# .. tags:: Data, Intermediate
+# ```
+#
+# The {std:ref}`folder <folder>` example downloads its CSV files one at a time and then normalizes them one at a time.
+# With a few thousand files, the task spends nearly all of its time waiting on network round trips, while a single core
+# does the normalization.
+#
+# This example ingests the same kind of directory with
+#
+# - a pooled HTTP downloader with bounded concurrency, retries, and resumable range requests,
+# - a content-addressed download cache, so files that have not changed are not downloaded again, and
+# - a process pool that normalizes the files in parallel and writes straight into the output `NebulaDirectory`.
+#
+# To begin, import the libraries.
+# %%
+import email.utils
+import hashlib
+import http.client
+import http.server
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import nebulakit
+from nebulakit import task, workflow
+from nebulakit.types.directory import NebulaDirectory
+
+from .file import normalize_csv
+
+# %% [markdown]
+# ## Download cache
+#
+# Downloaded files are stored under the SHA-256 of their content, and a small index file per URL records the content hash
+# along with the `ETag` and `Last-Modified` headers of the response. When a URL is requested again, the downloader sends
+# them back as `If-None-Match` and `If-Modified-Since`, and a `304 Not Modified` response is served from the cache
+# without transferring the body.
+# Writing one index file per URL keeps concurrent downloads from contending on a shared index.
+# %%
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "nebula-download-cache")
+
+
+def _replace_atomically(write, path: Path):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+class DownloadCache:
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR):
+        self._objects = Path(cache_dir) / "objects"
+        self._index = Path(cache_dir) / "index"
+        self._objects.mkdir(parents=True, exist_ok=True)
+        self._index.mkdir(parents=True, exist_ok=True)
+
+    def _index_path(self, url: str) -> Path:
+        return self._index / hashlib.sha256(url.encode()).hexdigest()
+
+    def lookup(self, url: str) -> Optional[dict]:
+        try:
+            entry = json.loads(self._index_path(url).read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return entry if (self._objects / entry["sha256"]).exists() else None
+
+    def object_path(self, entry: dict) -> Path:
+        return self._objects / entry["sha256"]
+
+    def store(self, url: str, path: str, validators: dict) -> dict:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(partial(f.read, 1024 * 1024), b""):
+                digest.update(block)
+        entry = {"sha256": digest.hexdigest(), **validators}
+        object_path = self._objects / entry["sha256"]
+        if not object_path.exists():
+            _replace_atomically(partial(shutil.copyfile, path), object_path)
+        _replace_atomically(lambda tmp_path: Path(tmp_path).write_text(json.dumps(entry)), self._index_path(url))
+        return entry
+
+
+# %% [markdown]
+# ## Pooled downloader
+#
+# Each download writes to a `.part` file first, and records the `ETag` and `Last-Modified` headers of the response
+# next to it. If a transfer breaks off, the next attempt asks the server for the remaining bytes with a `Range` header,
+# along with an `If-Range` header that carries the recorded validator. The server only sends the remaining bytes if the
+# file has not changed since the `.part` file was started, and the full file otherwise, in which case the `.part` file
+# is rewritten from the start. A `.part` file without a validator, or one that does not match the `Content-Range` of
+# the response, is discarded rather than resumed. Failed attempts, including truncated responses and responses with
+# status 429 or 5xx, are retried with exponential backoff, and wait at least as long as the `Retry-After` header of
+# the response asks for.
+# %%
+def _validators(headers) -> dict:
+    return {"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+
+
+def _resume_validator(validators: dict) -> Optional[str]:
+    etag = validators.get("etag")
+    # If-Range only accepts strong entity tags
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validators.get("last_modified")
+
+
+def _content_range(headers) -> Tuple[Optional[int], Optional[int]]:
+    # "bytes <first>-<last>/<length>" for partial content, or "bytes */<length>" for an unsatisfiable range
+    match = re.fullmatch(r"bytes (?:(\d+)-\d+|\*)/(\d+|\*)", (headers.get("Content-Range") or "").strip())
+    if match is None:
+        return None, None
+    start, length = match.groups()
+    return int(start) if start else None, int(length) if length != "*" else None
+
+
+def _retry_after(headers) -> Optional[float]:
+    # either a number of seconds or an HTTP date
+    value = (headers.get("Retry-After") or "").strip() if headers else ""
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_retryable(status: int) -> bool:
+    return status == 429 or status >= 500
+
+
+class _StalePart(Exception):
+    pass
+
+
+def _discard(*paths: str):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def download(
+    url: str,
+    destination: str,
+    cache: Optional[DownloadCache] = None,
+    retries: int = 3,
+    backoff: float = 0.5,
+    timeout: float = 30,
+) -> str:
+    cached = cache.lookup(url) if cache else None
+    part_path = f"{destination}.part"
+    part_validators_path = f"{part_path}.json"
+    for attempt in range(retries + 1):
+        delay = backoff * 2**attempt
+        headers = {}
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        try:
+            part_validators = json.loads(Path(part_validators_path).read_text()) if offset else {}
+        except (FileNotFoundError, json.JSONDecodeError):
+            part_validators = {}
+        resume_validator = _resume_validator(part_validators)
+        if offset and resume_validator:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = resume_validator
+        else:
+            offset = 0
+            if cached:
+                if cached.get("etag"):
+                    headers["If-None-Match"] = cached["etag"]
+                if cached.get("last_modified"):
+                    headers["If-Modified-Since"] = cached["last_modified"]
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+                if response.status == 206:
+                    if not offset or _content_range(response.headers)[0] != offset:
+                        raise _StalePart()
+                    mode, validators = "ab", part_validators
+                else:
+                    mode, validators = "wb", _validators(response.headers)
+                    Path(part_validators_path).write_text(json.dumps(validators))
+                with open(part_path, mode) as f:
+                    shutil.copyfileobj(response, f, 1024 * 1024)
+                    received = f.tell() - offset if mode == "ab" else f.tell()
+                # reading in blocks does not raise when the connection closes early, so the length is checked here
+                expected = response.headers.get("Content-Length")
+                if expected is not None and received != int(expected):
+                    raise http.client.IncompleteRead(b"", int(expected) - received)
+            break
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                shutil.copyfile(cache.object_path(cached), destination)
+                return destination
+            if e.code == 416 and offset and _content_range(e.headers)[1] == offset:
+                # the .part file already holds every byte of the file
+                validators = part_validators
+                break
+            if e.code == 416:
+                # the .part file is longer than the file on the server, so it is not a prefix of it
+                _discard(part_path, part_validators_path)
+            elif attempt == retries or not _is_retryable(e.code):
+                raise
+            else:
+                delay = max(delay, _retry_after(e.headers) or 0.0)
+        except _StalePart:
+            _discard(part_path, part_validators_path)
+        except (urllib.error.URLError, http.client.HTTPException, OSError):
+            if attempt == retries:
+                raise
+        time.sleep(delay)
+    else:
+        raise RuntimeError(f"Could not resume the download of {url} after {retries + 1} attempts")
+
+    os.replace(part_path, destination)
+    _discard(part_validators_path)
+    if cache:
+        cache.store(url, destination, validators)
+    return destination
+
+
+def download_all(
+    urls: List[str], local_dir: str, max_workers: int = 16, cache: Optional[DownloadCache] = None
+) -> List[str]:
+    # prefix the file names with the index of the url to preserve the order of the urls in the local directory
+    zfill_len = len(str(len(urls)))
+    destinations = [
+        os.path.join(local_dir, f"{str(idx).zfill(zfill_len)}_{os.path.basename(url)}") for idx, url in enumerate(urls)
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(partial(download, cache=cache), urls, destinations))
+
+
+# %% [markdown]
+# ## Tasks
+#
+# The download task is I/O bound and uses threads. The normalization task is CPU bound, so it fans out to a process pool
+# and every worker writes its result straight into the directory that is returned as the output `NebulaDirectory`.
+# %%
+@task
+def download_files_concurrently(csv_urls: List[str], max_workers: int = 16) -> NebulaDirectory:
+    local_dir = Path(nebulakit.current_context().working_directory) / "csv_files"
+    local_dir.mkdir(exist_ok=True)
+    download_all(csv_urls, str(local_dir), max_workers=max_workers, cache=DownloadCache())
+    return NebulaDirectory(path=str(local_dir))
+
+
+@task
+def normalize_all_files_in_parallel(
+    csv_files_dir: NebulaDirectory,
+    columns_metadata: List[List[str]],
+    columns_to_normalize_metadata: List[List[str]],
+) -> NebulaDirectory:
+    csv_files_dir.download()
+    output_dir = Path(nebulakit.current_context().working_directory) / "normalized_csv_files"
+    output_dir.mkdir(exist_ok=True)
+
+    file_names = sorted(os.listdir(csv_files_dir))
+    with ProcessPoolExecutor() as pool:
+        futures = [
+            pool.submit(
+                normalize_csv,
+                os.path.join(csv_files_dir, file_name),
+                str(output_dir / file_name),
+                column_names,
+                columns_to_normalize,
+            )
+            for file_name, column_names, columns_to_normalize in zip(
+                file_names, columns_metadata, columns_to_normalize_metadata
+            )
+        ]
+        for future in futures:
+            future.result()
+    return NebulaDirectory(path=str(output_dir))
+
+
+@workflow
+def download_and_normalize_csv_files_in_parallel(
+    csv_urls: List[str],
+    columns_metadata: List[List[str]],
+    columns_to_normalize_metadata: List[List[str]],
+) -> NebulaDirectory:
+    directory = download_files_concurrently(csv_urls=csv_urls)
+    return normalize_all_files_in_parallel(
+        csv_files_dir=directory,
+        columns_metadata=columns_metadata,
+        columns_to_normalize_metadata=columns_to_normalize_metadata,
+    )
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark serves `n_files` CSV files from a local HTTP server that adds `latency` seconds to every response.
+# Like most object stores and CDNs, the server supports `ETag`, `If-None-Match`, `Range` and `If-Range`.
+# The benchmark downloads the files serially with `urllib.request.urlretrieve`, as in the folder example, then with the
+# pooled downloader with a cold and a warm cache. Last, the server cuts off the first response for every file halfway,
+# so that the pooled downloader resumes every file with a range request. Its time includes the backoff before every
+# retry, and the benchmark checks that every resumed file is complete. The server queues up to 128 pending
+# connections, rather than the default of 5, so that the connections of the pooled downloader are not reset.
+# %%
+class _BenchmarkServer(http.server.ThreadingHTTPServer):
+    request_queue_size = 128
+
+
+class _RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    latency = 0.0
+    interrupt = False
+    interrupted: set = set()
+
+    def send_head(self):
+        time.sleep(self.latency)
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+        stat = os.stat(path)
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        start = 0
+        if "Range" in self.headers and self.headers.get("If-Range", etag) == etag:
+            start = int(self.headers["Range"].split("=", 1)[1].split("-", 1)[0])
+            if start >= stat.st_size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{stat.st_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+        elif self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return None
+
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header("Content-Range", f"bytes {start}-{stat.st_size - 1}/{stat.st_size}")
+        self.send_header("Content-Length", str(stat.st_size - start))
+        self.send_header("ETag", etag)
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        if self.interrupt and self.path not in self.interrupted:
+            self.interrupted.add(self.path)
+            data = source.read()
+            outputfile.write(data[: len(data) // 2])
+            self.close_connection = True
+            return
+        super().copyfile(source, outputfile)
+
+    def log_message(self, *args):
+        pass
+
+
+def benchmark(n_files: int = 2000, latency: float = 0.02, max_workers: int = 32):
+    with tempfile.TemporaryDirectory() as root:
+        served_dir = os.path.join(root, "served")
+        os.mkdir(served_dir)
+        for i in range(n_files):
+            Path(served_dir, f"{i}.csv").write_text("x,y\n" + "".join(f"{j},{j * i}\n" for j in range(100)))
+
+        class BenchmarkHandler(_RangeRequestHandler):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, directory=served_dir, **kwargs)
+
+        BenchmarkHandler.latency = latency
+        BenchmarkHandler.interrupted = set()
+        server = _BenchmarkServer(("127.0.0.1", 0), BenchmarkHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        urls = [f"http://127.0.0.1:{server.server_port}/{i}.csv" for i in range(n_files)]
+        cache = DownloadCache(os.path.join(root, "cache"))
+
+        def timed(label: str, fn):
+            local_dir = tempfile.mkdtemp(dir=root)
+            start = time.perf_counter()
+            fn(local_dir)
+            print(f"{label:>20}: {time.perf_counter() - start:6.2f}s")
+            return local_dir
+
+        timed(
+            "serial", lambda d: [urllib.request.urlretrieve(u, os.path.join(d, f"{i}.csv")) for i, u in enumerate(urls)]
+        )
+        timed("pooled, cold cache", lambda d: download_all(urls, d, max_workers=max_workers, cache=cache))
+        timed("pooled, warm cache", lambda d: download_all(urls, d, max_workers=max_workers, cache=cache))
+
+        BenchmarkHandler.interrupt = True
+        local_dir = timed(
+            "pooled, interrupted",
+            lambda d: download_all(urls, d, max_workers=max_workers, cache=DownloadCache(os.path.join(root, "cold"))),
+        )
+        server.shutdown()
+        for i, name in enumerate(sorted(os.listdir(local_dir), key=lambda n: int(n.split("_")[0]))):
+            if Path(local_dir, name).read_bytes() != Path(served_dir, f"{i}.csv").read_bytes():
+                raise RuntimeError(f"The resumed download of {i}.csv is corrupt")
+
+
+# %% [markdown]
+# You can run the workflow and the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    csv_urls = [
+        "https://people.sc.fsu.edu/~jburkardt/data/csv/biostats.csv",
+        "https://people.sc.fsu.edu/~jburkardt/data/csv/faithful.csv",
+    ]
+    columns_metadata = [
+        ["Name", "Sex", "Age", "Heights (in)", "Weight (lbs)"],
+        ["Index", "Eruption length (mins)", "Eruption wait (mins)"],
+    ]
+    columns_to_normalize_metadata = [
+        ["Age"],
+        ["Eruption length (mins)"],
+    ]
+
+    print(f"Running {__file__} main...")
+    directory = download_and_normalize_csv_files_in_parallel(
+        csv_urls=csv_urls,
+        columns_metadata=columns_metadata,
+        columns_to_normalize_metadata=columns_to_normalize_metadata,
+    )
+    print(f"Running download_and_normalize_csv_files_in_parallel on {csv_urls}: {directory}")
+    benchmark()
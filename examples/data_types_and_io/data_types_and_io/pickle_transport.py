@@ -0,0 +1,318 @@
+# %% [markdown]
+# (pickle_transport)=
+#
+# # Fast Pickle Transport
+#
+# ```{eval-rst}
+# .. tags:: Advanced
+# ```
+#
+# The {ref}`pickle type <pickle_type>` example shows how `Annotated[list[Superhero], BatchSize(3)]` splits a list
+# of arbitrary Python objects into several pickle files. Every batch is still a single pickle stream, though,
+# so objects that hold large NumPy buffers are copied into the stream when they are written and copied out of it
+# when they are read, and a downstream task unpickles every batch before it can look at the first element.
+#
+# This example defines a `PickledList` type with its own {py:class}`~nebulakit:nebulakit.extend.TypeTransformer` that
+#
+# - pickles with protocol 5 and writes [out-of-band buffers](https://peps.python.org/pep-0574/) to separate files,
+#   which are memory-mapped on load instead of being copied,
+# - optionally compresses the pickle streams and buffers with zstd or lz4, and
+# - loads batches lazily, when a downstream task first touches an element of the batch.
+#
+# To begin, import the dependencies.
+# %%
+import json
+import mmap
+import os
+import pickle
+import time
+import typing
+from collections.abc import Sequence
+from dataclasses import dataclass
+from typing import Type
+
+import numpy as np
+from nebulakit import (
+    Blob,
+    BlobMetadata,
+    BlobType,
+    Literal,
+    LiteralType,
+    NebulaContext,
+    NebulaContextManager,
+    Scalar,
+    task,
+    workflow,
+)
+from nebulakit.extend import TypeEngine, TypeTransformer
+from nebulakit.types.pickle.pickle import BatchSize
+from typing_extensions import Annotated
+
+
+# %% [markdown]
+# ## Options
+#
+# The options are attached to the type with `Annotated`, like `BatchSize`.
+# `zstd` requires the `zstandard` package and `lz4` the `lz4` package.
+# %%
+@dataclass(frozen=True)
+class PickleOptions:
+    batch_size: int = 1000
+    compression: typing.Optional[str] = None
+    out_of_band: bool = True
+
+
+def _identity(data):
+    return data
+
+
+def _compressor(compression: typing.Optional[str]) -> typing.Tuple[typing.Callable, typing.Callable]:
+    if compression is None:
+        return _identity, _identity
+    if compression == "zstd":
+        import zstandard
+
+        return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+    if compression == "lz4":
+        import lz4.frame
+
+        return lz4.frame.compress, lz4.frame.decompress
+    raise ValueError(f"Unsupported compression {compression}, expected zstd or lz4")
+
+
+# %% [markdown]
+# ## Lazy list
+#
+# `PickledList` is a read-only sequence. On the producer side, it wraps a plain list. On the consumer side,
+# it only knows the number of elements in each batch, taken from a small manifest, and fetches and unpickles a batch
+# the first time one of its elements is accessed. Only the most recently used batch is kept in memory,
+# so iterating over the list holds one batch at a time.
+#
+# When the batches are not compressed, the out-of-band buffers are memory-mapped copy-on-write:
+# NumPy arrays are backed directly by the downloaded files, and are still writable.
+# %%
+class PickledList(Sequence):
+    def __init__(self, items: typing.Optional[list] = None):
+        self._items = items
+        self._remote_dir: typing.Optional[str] = None
+        self._manifest: typing.Optional[dict] = None
+        self._loaded: typing.Tuple[int, list] = (-1, [])
+        self._local_dir: typing.Optional[str] = None
+
+    @classmethod
+    def _from_remote(cls, remote_dir: str, manifest: dict) -> "PickledList":
+        lazy = cls()
+        lazy._remote_dir = remote_dir
+        lazy._manifest = manifest
+        return lazy
+
+    def __len__(self) -> int:
+        if self._items is not None:
+            return len(self._items)
+        return sum(self._manifest["batch_lengths"])
+
+    def __getitem__(self, index):
+        if self._items is not None:
+            return self._items[index]
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Index {index} is out of range for a list of length {len(self)}")
+        batch_size = self._manifest["batch_size"]
+        return self._batch(index // batch_size)[index % batch_size]
+
+    def __iter__(self):
+        if self._items is not None:
+            yield from self._items
+            return
+        for batch_index in range(len(self._manifest["batch_lengths"])):
+            yield from self._batch(batch_index)
+
+    def _batch(self, batch_index: int) -> list:
+        if self._loaded[0] != batch_index:
+            if self._local_dir is None:
+                self._local_dir = NebulaContextManager.current_context().file_access.get_random_local_directory()
+            # the files of the previous batch are removed; memory-mapped buffers that are still in use stay valid
+            for name in os.listdir(self._local_dir):
+                os.remove(os.path.join(self._local_dir, name))
+            self._loaded = (batch_index, _load_batch(self._remote_dir, self._manifest, batch_index, self._local_dir))
+        return self._loaded[1]
+
+
+# %% [markdown]
+# ## Batch files
+#
+# Batch `i` is stored as `batch-i.pkl`, and its out-of-band buffers as `batch-i.buf-j`.
+# `manifest.json` records the options and the length of every batch.
+# %%
+def _batch_file(batch_index: int) -> str:
+    return f"batch-{batch_index:05}.pkl"
+
+
+def _buffer_file(batch_index: int, buffer_index: int) -> str:
+    return f"batch-{batch_index:05}.buf-{buffer_index:05}"
+
+
+def _dump_batch(local_dir: str, batch_index: int, batch: list, options: PickleOptions) -> int:
+    compress, _ = _compressor(options.compression)
+    buffers: typing.List[pickle.PickleBuffer] = []
+    data = pickle.dumps(batch, protocol=5, buffer_callback=buffers.append if options.out_of_band else None)
+    with open(os.path.join(local_dir, _batch_file(batch_index)), "wb") as f:
+        f.write(compress(data))
+    for buffer_index, buffer in enumerate(buffers):
+        with open(os.path.join(local_dir, _buffer_file(batch_index, buffer_index)), "wb") as f:
+            # without compression, the raw memory of the buffer is written as is, without an intermediate copy
+            f.write(compress(buffer.raw()))
+    return len(buffers)
+
+
+def _load_batch(remote_dir: str, manifest: dict, batch_index: int, local_dir: str) -> list:
+    ctx = NebulaContextManager.current_context()
+    _, decompress = _compressor(manifest["compression"])
+
+    def fetch(name: str) -> str:
+        local_path = os.path.join(local_dir, name)
+        ctx.file_access.get_data(os.path.join(remote_dir, name), local_path)
+        return local_path
+
+    buffers = []
+    for buffer_index in range(manifest["buffer_counts"][batch_index]):
+        with open(fetch(_buffer_file(batch_index, buffer_index)), "rb") as f:
+            if manifest["compression"] is None:
+                buffers.append(
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY) if os.fstat(f.fileno()).st_size else b""
+                )
+            else:
+                buffers.append(decompress(f.read()))
+    with open(fetch(_batch_file(batch_index)), "rb") as f:
+        return pickle.loads(decompress(f.read()), buffers=buffers)
+
+
+# %% [markdown]
+# ## Transformer
+#
+# `to_literal` writes the batches to a local directory and uploads it as a multi-part blob.
+# `to_python_value` only downloads the manifest.
+# %%
+class PickledListTransformer(TypeTransformer[PickledList]):
+    _TYPE_INFO = BlobType(format="PickledList", dimensionality=BlobType.BlobDimensionality.MULTIPART)
+
+    def __init__(self):
+        super().__init__(name="pickled-list-transform", t=PickledList)
+
+    def get_literal_type(self, t: Type[PickledList]) -> LiteralType:
+        return LiteralType(blob=self._TYPE_INFO)
+
+    def to_literal(
+        self,
+        ctx: NebulaContext,
+        python_val: PickledList,
+        python_type: Type[PickledList],
+        expected: LiteralType,
+    ) -> Literal:
+        options = _options_for(python_type)
+        items = list(python_val)
+        local_dir = ctx.file_access.get_random_local_directory()
+        batches = [items[i : i + options.batch_size] for i in range(0, len(items), options.batch_size)]
+        manifest = {
+            "batch_size": options.batch_size,
+            "compression": options.compression,
+            "batch_lengths": [len(batch) for batch in batches],
+            "buffer_counts": [_dump_batch(local_dir, i, batch, options) for i, batch in enumerate(batches)],
+        }
+        with open(os.path.join(local_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+
+        remote_dir = ctx.file_access.get_random_remote_directory()
+        ctx.file_access.upload_directory(local_dir, remote_dir)
+        return Literal(scalar=Scalar(blob=Blob(uri=remote_dir, metadata=BlobMetadata(type=self._TYPE_INFO))))
+
+    def to_python_value(self, ctx: NebulaContext, lv: Literal, expected_python_type: Type[PickledList]) -> PickledList:
+        remote_dir = lv.scalar.blob.uri
+        local_path = ctx.file_access.get_random_local_path()
+        ctx.file_access.get_data(os.path.join(remote_dir, "manifest.json"), local_path)
+        with open(local_path) as f:
+            return PickledList._from_remote(remote_dir, json.load(f))
+
+
+def _options_for(python_type: Type) -> PickleOptions:
+    for annotation in getattr(python_type, "__metadata__", ()):
+        if isinstance(annotation, PickleOptions):
+            return annotation
+    return PickleOptions()
+
+
+TypeEngine.register(PickledListTransformer())
+
+
+# %% [markdown]
+# Let's give every superhero a power map held in a NumPy array.
+# `welcome_superheroes` writes batches of three superheroes, compressed with zstd,
+# and `strongest_superhero` only ever holds one batch in memory while it scans the list.
+# %%
+class Superhero:
+    def __init__(self, name: str, power_map: np.ndarray):
+        self.name = name
+        self.power_map = power_map
+
+
+@task
+def welcome_superheroes(
+    names: typing.List[str], size: int
+) -> Annotated[PickledList, PickleOptions(batch_size=3, compression="zstd")]:
+    rng = np.random.default_rng(0)
+    return PickledList([Superhero(name, rng.random((size, size))) for name in names])
+
+
+@task
+def strongest_superhero(superheroes: PickledList) -> str:
+    return max(superheroes, key=lambda superhero: superhero.power_map.sum()).name
+
+
+@workflow
+def pickled_superheroes_wf(
+    names: typing.List[str] = ["Thor", "Spiderman", "Hulk", "Storm", "Groot"], size: int = 100
+) -> str:
+    return strongest_superhero(superheroes=welcome_superheroes(names=names, size=size))
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark round-trips lists of objects holding arrays of different sizes through the `BatchSize`-annotated
+# pickle transformer and through `PickledList`, for several batch sizes, and then reads every element.
+# Every list holds `total_mb` megabytes of array data.
+# %%
+class Payload:
+    def __init__(self, nbytes: int):
+        self.data = np.zeros(nbytes // 8)
+
+
+def _round_trip(python_type: Type, value: typing.Any) -> float:
+    ctx = NebulaContextManager.current_context()
+    start = time.perf_counter()
+    literal = TypeEngine.to_literal(ctx, value, python_type, TypeEngine.to_literal_type(python_type))
+    restored = TypeEngine.to_python_value(ctx, literal, python_type)
+    for payload in restored:
+        payload.data.sum()
+    return time.perf_counter() - start
+
+
+def benchmark(total_mb: int = 256, object_sizes=(1024, 1024 * 1024, 16 * 1024 * 1024), batch_sizes=(1, 16, 256)):
+    print(f"{'object size':>12} {'batch size':>10} {'BatchSize s':>12} {'PickledList s':>14}")
+    for object_size in object_sizes:
+        payloads = [Payload(object_size) for _ in range(max(1, total_mb * 1024 * 1024 // object_size))]
+        for batch_size in batch_sizes:
+            baseline = _round_trip(Annotated[typing.List[Payload], BatchSize(batch_size)], payloads)
+            pickled = _round_trip(Annotated[PickledList, PickleOptions(batch_size=batch_size)], PickledList(payloads))
+            print(f"{object_size:>12} {batch_size:>10} {baseline:>12.3f} {pickled:>14.3f}")
+
+
+# %% [markdown]
+# You can run the workflow and the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    print(f"Strongest superhero: {pickled_superheroes_wf()}")
+    benchmark()
@@ -0,0 +1,310 @@
+# %% [markdown]
+# (safetensors_type)=
+#
+# # Memory-Mapped State Dicts with safetensors
+#
+# ```{eval-rst}
+# .. tags:: MachineLearning, Advanced
+# ```
+#
+# The {ref}`PyTorch type <pytorch_type>` example passes tensors, modules and `PyTorchCheckpoint` objects
+# through `torch.save`, which is based on pickle. Loading a checkpoint reads the whole file into memory and unpickles it,
+# and the module is built, with freshly initialized weights, before `load_state_dict` copies the stored weights into it.
+# For a state dict of several gigabytes, that means waiting for the full download and holding the weights in memory twice.
+#
+# [safetensors](https://huggingface.co/docs/safetensors) stores tensors in a flat layout:
+# a JSON header with the dtype, shape and byte range of every tensor, followed by the raw tensor data.
+# This example defines a `LazyStateDict` type whose transformer stores state dicts in that layout, so that
+#
+# - a local file is memory-mapped, and tensors are read from the page cache without being copied,
+# - individual named tensors are fetched from the blob store with a range request, without downloading the whole file, and
+# - modules can be instantiated on the `meta` device and take over the loaded tensors directly.
+#
+# To begin, import the dependencies.
+# %%
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import struct
+import threading
+import time
+import typing
+from collections.abc import Mapping
+from typing import Type
+
+import torch
+from nebulakit import (
+    Blob,
+    BlobMetadata,
+    BlobType,
+    Literal,
+    LiteralType,
+    NebulaContext,
+    NebulaContextManager,
+    Scalar,
+    task,
+    workflow,
+)
+from nebulakit.extend import TypeEngine, TypeTransformer
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+# %% [markdown]
+# ## Lazy state dict
+#
+# `LazyStateDict` is a read-only mapping from tensor names to tensors.
+# On the producer side, it wraps an ordinary state dict. On the consumer side, it only reads the header of the file,
+# and loads a tensor when it is accessed: through `safe_open` if the file is local, or with a range request if it is not.
+# The file is opened and memory-mapped on the first access, and the handle is kept until `close()`, so iterating over
+# the tensors does not reopen the file for every one of them.
+# Calling `download()` fetches the whole file once, after which every tensor is read through the memory map.
+#
+# String metadata, such as hyperparameters, is stored in the header alongside the tensors.
+# %%
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+class LazyStateDict(Mapping):
+    def __init__(
+        self,
+        tensors: typing.Optional[typing.Dict[str, torch.Tensor]] = None,
+        metadata: typing.Optional[typing.Dict[str, str]] = None,
+    ):
+        self._tensors = tensors
+        self._metadata = metadata or {}
+        self._uri: typing.Optional[str] = None
+        self._local_path: typing.Optional[str] = None
+        self._header: typing.Dict[str, dict] = {}
+        self._data_start = 0
+        self._handle = None
+        self._handle_lock = threading.Lock()
+        self._files = contextlib.ExitStack()
+
+    @classmethod
+    def _from_uri(cls, ctx: NebulaContext, uri: str) -> "LazyStateDict":
+        lazy = cls()
+        lazy._uri = uri
+        if not ctx.file_access.is_remote(uri):
+            lazy._local_path = uri
+        fs = ctx.file_access.get_filesystem_for_path(uri)
+        (header_size,) = struct.unpack("<Q", fs.cat_file(uri, start=0, end=8))
+        header = json.loads(fs.cat_file(uri, start=8, end=8 + header_size))
+        lazy._metadata = header.pop("__metadata__", {})
+        lazy._header = header
+        lazy._data_start = 8 + header_size
+        return lazy
+
+    @property
+    def metadata(self) -> typing.Dict[str, str]:
+        return self._metadata
+
+    def __len__(self) -> int:
+        return len(self._tensors if self._tensors is not None else self._header)
+
+    def __iter__(self):
+        return iter(self._tensors if self._tensors is not None else self._header)
+
+    def __getitem__(self, name: str) -> torch.Tensor:
+        if self._tensors is not None:
+            return self._tensors[name]
+        if self._local_path is not None:
+            return self._open().get_tensor(name)
+        return self._fetch(name)
+
+    def _open(self):
+        with self._handle_lock:
+            if self._handle is None:
+                self._handle = self._files.enter_context(safe_open(self._local_path, framework="pt", device="cpu"))
+            return self._handle
+
+    def close(self):
+        with self._handle_lock:
+            self._files.close()
+            self._handle = None
+
+    def _fetch(self, name: str) -> torch.Tensor:
+        info = self._header[name]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if begin == end:
+            return torch.empty(info["shape"], dtype=dtype)
+        ctx = NebulaContextManager.current_context()
+        fs = ctx.file_access.get_filesystem_for_path(self._uri)
+        data = fs.cat_file(self._uri, start=self._data_start + begin, end=self._data_start + end)
+        return torch.frombuffer(bytearray(data), dtype=dtype).reshape(info["shape"])
+
+    def load(self, names: typing.Optional[typing.Iterable[str]] = None) -> typing.Dict[str, torch.Tensor]:
+        return {name: self[name] for name in (names if names is not None else self)}
+
+    def download(self) -> "LazyStateDict":
+        if self._tensors is None and self._local_path is None:
+            ctx = NebulaContextManager.current_context()
+            local_path = ctx.file_access.get_random_local_path()
+            ctx.file_access.get_data(self._uri, local_path)
+            self._local_path = local_path
+        return self
+
+
+# %% [markdown]
+# ## Transformer
+#
+# `to_literal` writes the state dict with `safetensors.torch.save_file` and uploads it as a single blob.
+# safetensors only stores contiguous CPU tensors that do not share storage, so tied weights are written as separate copies.
+# `to_python_value` only reads the header.
+# %%
+class LazyStateDictTransformer(TypeTransformer[LazyStateDict]):
+    _TYPE_INFO = BlobType(format="safetensors", dimensionality=BlobType.BlobDimensionality.SINGLE)
+
+    def __init__(self):
+        super().__init__(name="lazy-state-dict-transform", t=LazyStateDict)
+
+    def get_literal_type(self, t: Type[LazyStateDict]) -> LiteralType:
+        return LiteralType(blob=self._TYPE_INFO)
+
+    def to_literal(
+        self,
+        ctx: NebulaContext,
+        python_val: LazyStateDict,
+        python_type: Type[LazyStateDict],
+        expected: LiteralType,
+    ) -> Literal:
+        tensors, storages = {}, set()
+        for name, tensor in python_val.items():
+            tensor = tensor.detach().cpu().contiguous()
+            if tensor.untyped_storage().data_ptr() in storages:
+                # tied weights share their storage, and are written as separate tensors
+                tensor = tensor.clone()
+            storages.add(tensor.untyped_storage().data_ptr())
+            tensors[name] = tensor
+        local_path = ctx.file_access.get_random_local_path()
+        save_file(tensors, local_path, metadata=python_val.metadata)
+
+        remote_path = ctx.file_access.get_random_remote_path(local_path)
+        ctx.file_access.put_data(local_path, remote_path, is_multipart=False)
+        return Literal(scalar=Scalar(blob=Blob(uri=remote_path, metadata=BlobMetadata(type=self._TYPE_INFO))))
+
+    def to_python_value(
+        self, ctx: NebulaContext, lv: Literal, expected_python_type: Type[LazyStateDict]
+    ) -> LazyStateDict:
+        return LazyStateDict._from_uri(ctx, lv.scalar.blob.uri)
+
+
+TypeEngine.register(LazyStateDictTransformer())
+
+# %% [markdown]
+# ## Loading modules without initializing them first
+#
+# Modules created under `torch.device("meta")` have parameters without storage, so no memory is allocated and
+# no weights are initialized. `load_state_dict(..., assign=True)` then makes the loaded tensors the parameters
+# of the module, instead of copying them into freshly allocated ones. `assign` requires PyTorch 2.1 or newer.
+# %%
+T = typing.TypeVar("T", bound=torch.nn.Module)
+
+
+def load_module(module_cls: typing.Callable[[], T], state_dict: LazyStateDict) -> T:
+    with torch.device("meta"):
+        module = module_cls()
+    module.load_state_dict(state_dict.download().load(), assign=True)
+    return module
+
+
+# %% [markdown]
+# Let's checkpoint a small model with its hyperparameters, restore it, and read a single layer without loading the rest.
+# %%
+class MyModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.l0 = torch.nn.Linear(4, 2)
+        self.l1 = torch.nn.Linear(2, 1)
+
+    def forward(self, input):
+        return self.l1(torch.nn.functional.relu(self.l0(input)))
+
+
+@task
+def train(epochs: int) -> LazyStateDict:
+    model = MyModel()
+    return LazyStateDict(model.state_dict(), metadata={"epochs": str(epochs)})
+
+
+@task
+def predict(state_dict: LazyStateDict) -> float:
+    model = load_module(MyModel, state_dict)
+    return float(model(torch.ones(1, 4)).item())
+
+
+@task
+def l1_bias(state_dict: LazyStateDict) -> float:
+    return float(state_dict["l1.bias"].item())
+
+
+@workflow
+def safetensors_wf(epochs: int = 10) -> typing.Tuple[float, float]:
+    state_dict = train(epochs=epochs)
+    return predict(state_dict=state_dict), l1_bias(state_dict=state_dict)
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark writes a state dict of `size_mb` megabytes, made of 64 tensors, with `torch.save` and with safetensors,
+# and loads it back on the CPU in a fresh process per case, reporting load latency and the peak resident set size.
+# The last case only loads a single named tensor.
+# %%
+def _load_case(case: str, path: str, results: multiprocessing.Queue):
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if case == "torch.load":
+        tensors = torch.load(path)
+    elif case == "safetensors":
+        with safe_open(path, framework="pt", device="cpu") as f:
+            tensors = {name: f.get_tensor(name) for name in f.keys()}
+    else:
+        with safe_open(path, framework="pt", device="cpu") as f:
+            tensors = {"layer_0": f.get_tensor("layer_0")}
+    checksum = sum(float(t[0, 0]) for t in tensors.values())
+    seconds = time.perf_counter() - start
+    peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss) / 1024
+    results.put((case, seconds, peak_mb, checksum))
+
+
+def benchmark(size_mb: int = 2048, n_tensors: int = 64):
+    ctx = NebulaContextManager.current_context()
+    side = int((size_mb * 1024 * 1024 / n_tensors / 4) ** 0.5)
+    state_dict = {f"layer_{i}": torch.randn(side, side) for i in range(n_tensors)}
+    local_dir = ctx.file_access.get_random_local_directory()
+    paths = {"torch.load": os.path.join(local_dir, "model.pt"), "safetensors": os.path.join(local_dir, "model.st")}
+    torch.save(state_dict, paths["torch.load"])
+    save_file(state_dict, paths["safetensors"])
+    del state_dict
+
+    mp_ctx = multiprocessing.get_context("spawn")
+    results = mp_ctx.Queue()
+    print(f"{'case':>20} {'seconds':>10} {'peak RSS MB':>12}")
+    for case, path in [*paths.items(), ("safetensors, 1 tensor", paths["safetensors"])]:
+        process = mp_ctx.Process(target=_load_case, args=(case, path, results))
+        process.start()
+        process.join()
+        name, seconds, peak_mb, _ = results.get()
+        print(f"{name:>20} {seconds:>10.3f} {peak_mb:>12.1f}")
+
+
+# %% [markdown]
+# You can run the workflow and the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    print(f"Prediction and l1 bias: {safetensors_wf()}")
+    benchmark()
@@ -0,0 +1,275 @@
+# %% [markdown]
+# (streaming_structured_dataset)=
+#
+# # Streaming Structured Datasets
+#
+# ```{eval-rst}
+# .. tags:: DataFrame, Intermediate
+# ```
+# ```{currentmodule} nebulakit.types.structured
+# ```
+#
+# `StructuredDataset.open(...).all()` materializes the entire dataset in memory before the task can look at a single row.
+# For datasets that are larger than the memory of the task pod, {py:class}`StructuredDataset` also offers `iter()`,
+# which hands the dataset to the task as a sequence of batches.
+#
+# A decoder supports `iter()` by returning a generator instead of a dataframe. Since a decoder returns either
+# the whole value or an iterator, the streaming decoders in this example are registered for dedicated iterator types,
+# so that `all()` keeps working with the stock decoders.
+#
+# To begin, import the dependencies.
+# %%
+import contextlib
+import json
+import os
+import queue
+import threading
+import typing
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from nebulakit import NebulaContext, kwtypes, task, workflow
+from nebulakit.models import literals
+from nebulakit.models.literals import StructuredDatasetMetadata
+from nebulakit.types.structured.structured_dataset import (
+    PARQUET,
+    StructuredDataset,
+    StructuredDatasetDecoder,
+    StructuredDatasetTransformerEngine,
+)
+from typing_extensions import Annotated
+
+from .numpy_structured_dataset import (
+    ARROW_IPC,
+    DTYPE_KEY,
+    SHAPE_KEY,
+    generate_volume,
+    local_part_file,
+    values_to_numpy,
+)
+
+# %% [markdown]
+# Define the types that select the streaming decoders.
+# %%
+PandasBatches = typing.Iterator[pd.DataFrame]
+NumpyBatches = typing.Iterator[np.ndarray]
+
+
+# %% [markdown]
+# The columns a task declares with `kwtypes` are passed to the decoder in its metadata,
+# so only those columns need to be read.
+# %%
+def declared_columns(metadata: StructuredDatasetMetadata) -> typing.Optional[typing.List[str]]:
+    sd_type = metadata.structured_dataset_type if metadata else None
+    if sd_type is None or not sd_type.columns:
+        return None
+    return [c.name for c in sd_type.columns]
+
+
+# %% [markdown]
+# ## Readahead
+#
+# While the task works on one batch, the next batches can already be fetched and decoded.
+# The `prefetch` helper drains an iterator on a background thread into a bounded queue.
+# The size of the queue caps the number of batches held in memory at any time,
+# and the thread stops as soon as the consumer stops iterating. The thread then closes the iterator, if it is a
+# generator, so the files it has open are closed right away rather than when the generator is garbage collected.
+# %%
+def prefetch(batches: typing.Iterator, readahead: int) -> typing.Generator:
+    if readahead <= 0:
+        yield from batches
+        return
+
+    buffer = queue.Queue(maxsize=readahead)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for batch in batches:
+                if not put(batch):
+                    return
+        except BaseException as e:
+            put(e)
+        finally:
+            if hasattr(batches, "close"):
+                batches.close()
+            put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+# %% [markdown]
+# ## Parquet batches
+#
+# The parquet decoders open every part file of the dataset through the filesystem of its URI,
+# so the parquet footer and the row groups are fetched on demand rather than by downloading the whole directory.
+# `ParquetFile.iter_batches` then decodes `batch_size` rows at a time. Hidden files are skipped.
+# %%
+def parquet_batches(
+    ctx: NebulaContext, uri: str, batch_size: int, columns: typing.Optional[typing.List[str]]
+) -> typing.Iterator[pa.RecordBatch]:
+    fs = ctx.file_access.get_filesystem_for_path(uri)
+    part_files = sorted(f for f in fs.find(uri) if not os.path.basename(f).startswith("."))
+    for part_file in part_files:
+        with fs.open(part_file, "rb") as f:
+            yield from pq.ParquetFile(f).iter_batches(batch_size=batch_size, columns=columns)
+
+
+# %% [markdown]
+# The pandas decoder yields every batch as a dataframe.
+# %%
+class PandasBatchDecodingHandler(StructuredDatasetDecoder):
+    def __init__(self, batch_size: int = 65536, readahead: int = 2):
+        super().__init__(PandasBatches, None, PARQUET)
+        self._batch_size = batch_size
+        self._readahead = readahead
+
+    def decode(
+        self,
+        ctx: NebulaContext,
+        nebula_value: literals.StructuredDataset,
+        current_task_metadata: StructuredDatasetMetadata,
+    ) -> typing.Generator[pd.DataFrame, None, None]:
+        record_batches = parquet_batches(
+            ctx, nebula_value.uri, self._batch_size, declared_columns(current_task_metadata)
+        )
+        with contextlib.closing(prefetch(record_batches, self._readahead)) as batches:
+            for batch in batches:
+                yield batch.to_pandas()
+
+
+# %% [markdown]
+# The NumPy decoder reads the parquet datasets of the NumPy handlers of the
+# {ref}`structured dataset <structured_dataset>` example, and yields every batch as a two-dimensional array,
+# like their decoder does for the whole dataset.
+# %%
+class NumpyParquetBatchDecodingHandler(StructuredDatasetDecoder):
+    def __init__(self, batch_size: int = 65536, readahead: int = 2):
+        super().__init__(NumpyBatches, None, PARQUET)
+        self._batch_size = batch_size
+        self._readahead = readahead
+
+    def decode(
+        self,
+        ctx: NebulaContext,
+        nebula_value: literals.StructuredDataset,
+        current_task_metadata: StructuredDatasetMetadata,
+    ) -> typing.Generator[np.ndarray, None, None]:
+        record_batches = parquet_batches(
+            ctx, nebula_value.uri, self._batch_size, declared_columns(current_task_metadata)
+        )
+        with contextlib.closing(prefetch(record_batches, self._readahead)) as batches:
+            for batch in batches:
+                yield batch.to_pandas().to_numpy()
+
+
+# %% [markdown]
+# ## Arrow IPC batches
+#
+# This NumPy decoder builds on the memory-mapped Arrow IPC layout from the
+# {ref}`zero-copy NumPy <numpy_structured_dataset>` example.
+# Every batch is a zero-copy view of `batch_size` entries along the first axis of the stored array.
+#
+# :::{note}
+# Memory mapping requires a local file, so a remote dataset is downloaded to local disk before the first batch.
+# The mapped file is not held in the memory of the task, but the task needs the disk space for it and waits for the
+# whole download. Use the parquet format to stream remote data one row group at a time.
+# :::
+# %%
+class NumpyBatchDecodingHandler(StructuredDatasetDecoder):
+    def __init__(self, batch_size: int = 65536, readahead: int = 2):
+        super().__init__(NumpyBatches, None, ARROW_IPC)
+        self._batch_size = batch_size
+        self._readahead = readahead
+
+    def decode(
+        self,
+        ctx: NebulaContext,
+        nebula_value: literals.StructuredDataset,
+        current_task_metadata: StructuredDatasetMetadata,
+    ) -> typing.Generator[np.ndarray, None, None]:
+        reader = pa.ipc.open_file(pa.memory_map(local_part_file(ctx, nebula_value.uri), "r"))
+        shape = tuple(json.loads(reader.schema.metadata[SHAPE_KEY]))
+        dtype = np.dtype(reader.schema.metadata[DTYPE_KEY].decode())
+
+        def slices() -> typing.Iterator[np.ndarray]:
+            for i in range(reader.num_record_batches):
+                column = reader.get_batch(i).column(0)
+                for start in range(0, len(column), self._batch_size):
+                    rows = column.slice(start, self._batch_size)
+                    yield values_to_numpy(rows.flatten(), dtype).reshape((len(rows),) + shape[1:])
+
+        with contextlib.closing(prefetch(slices(), self._readahead)) as batches:
+            yield from batches
+
+
+# %% [markdown]
+# Register the streaming decoders.
+# %%
+StructuredDatasetTransformerEngine.register(PandasBatchDecodingHandler())
+StructuredDatasetTransformerEngine.register(NumpyParquetBatchDecodingHandler())
+StructuredDatasetTransformerEngine.register(NumpyBatchDecodingHandler())
+
+
+# %% [markdown]
+# Open the dataset with one of the iterator types and call `iter()` to process it batch by batch.
+# Only a bounded number of batches is held in memory, no matter how large the dataset is.
+# %%
+all_cols = kwtypes(Name=str, Age=int, Height=int)
+
+
+@task
+def generate_people(n: int) -> Annotated[StructuredDataset, all_cols]:
+    return StructuredDataset(
+        dataframe=pd.DataFrame({"Name": [f"person_{i}" for i in range(n)], "Age": np.arange(n) % 90, "Height": 170})
+    )
+
+
+@task
+def mean_age(df: Annotated[StructuredDataset, all_cols]) -> float:
+    total, count = 0, 0
+    for batch in df.open(PandasBatches).iter():
+        total += int(batch["Age"].sum())
+        count += len(batch)
+    return total / count
+
+
+@task
+def volume_max(sd: Annotated[StructuredDataset, ARROW_IPC]) -> float:
+    return max(float(batch.max()) for batch in sd.open(NumpyBatches).iter())
+
+
+@workflow
+def streaming_sd_wf(n: int = 100_000) -> typing.Tuple[float, float]:
+    return mean_age(df=generate_people(n=n)), volume_max(sd=generate_volume(n=n))
+
+
+# %% [markdown]
+# You can run the workflow locally as follows:
+# %%
+if __name__ == "__main__":
+    print(f"Mean age and volume maximum: {streaming_sd_wf()}")
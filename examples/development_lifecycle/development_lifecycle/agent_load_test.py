@@ -0,0 +1,313 @@
+# %% [markdown]
+# (agent_load_test)=
+#
+# # Load Testing the Agent Service
+#
+# ```{eval-rst}
+# .. tags:: Extensibility, Advanced
+# ```
+#
+# The {ref}`agent service <extend-agent-service>` example explains how propeller calls `create`, `get` and `delete`
+# on an agent to run an asynchronous task, such as a BigQuery query or a Databricks job. An agent replica serves these
+# calls for many concurrent tasks from a single event loop, so it is worth measuring how many it can handle before
+# deciding how many replicas to deploy.
+#
+# This example starts the agent gRPC server in a separate process, with a fake agent whose latency and failure rate
+# are configurable, and drives thousands of concurrent task lifecycles against it: a `CreateTask` call, `GetTask` calls
+# until the task reaches a terminal state, and a `DeleteTask` call. It reports
+#
+# - the throughput in completed lifecycles per second,
+# - the p50 and p99 latency and the error count of every RPC, and
+# - how far behind schedule the event loop of the server runs, which shows when the server is saturated.
+#
+# To begin, import the dependencies.
+# %%
+import asyncio
+import json
+import multiprocessing
+import random
+import statistics
+import time
+import typing
+import uuid
+from dataclasses import asdict, dataclass
+
+import grpc
+from nebulaidl.admin.agent_pb2 import (
+    PERMANENT_FAILURE,
+    RETRYABLE_FAILURE,
+    RUNNING,
+    SUCCEEDED,
+    CreateTaskRequest,
+    CreateTaskResponse,
+    DeleteTaskRequest,
+    DeleteTaskResponse,
+    GetTaskRequest,
+    GetTaskResponse,
+    Resource,
+)
+from nebulaidl.core import identifier_pb2, tasks_pb2
+from nebulaidl.service.agent_pb2_grpc import AsyncAgentServiceStub, add_AsyncAgentServiceServicer_to_server
+from nebulakit.extend.backend.agent_service import AsyncAgentService
+from nebulakit.extend.backend.base_agent import AgentBase, AgentRegistry
+
+# %% [markdown]
+# ## Fake backend
+#
+# The fake agent stands in for an external service. Every call takes `latency` seconds, with up to `jitter` seconds
+# added at random, and fails with probability `failure_rate`. A job runs for `job_seconds` after it is created.
+#
+# With `blocking=True`, the agent implements the synchronous `create`, `get` and `delete` methods and sleeps
+# with `time.sleep`, like an agent built on a blocking client library. The agent service then runs every call on a
+# thread pool, which is usually the first thing to saturate.
+# %%
+TASK_TYPE = "load_test_task"
+
+
+@dataclass
+class FakeBackendConfig:
+    latency: float = 0.01
+    jitter: float = 0.01
+    failure_rate: float = 0.0
+    job_seconds: float = 1.0
+    blocking: bool = False
+
+
+@dataclass
+class Metadata:
+    job_id: str
+    done_at: float
+
+
+class FakeBackendError(Exception):
+    pass
+
+
+class FakeAgent(AgentBase):
+    def __init__(self, config: FakeBackendConfig):
+        super().__init__(task_type=TASK_TYPE, asynchronous=not config.blocking)
+        self._config = config
+
+    def _delay(self) -> float:
+        if random.random() < self._config.failure_rate:
+            raise FakeBackendError("The fake backend failed the request")
+        return self._config.latency + random.uniform(0, self._config.jitter)
+
+    def _create_response(self) -> CreateTaskResponse:
+        metadata = Metadata(job_id=uuid.uuid4().hex, done_at=time.time() + self._config.job_seconds)
+        return CreateTaskResponse(resource_meta=json.dumps(asdict(metadata)).encode("utf-8"))
+
+    def _get_response(self, resource_meta: bytes) -> GetTaskResponse:
+        metadata = Metadata(**json.loads(resource_meta.decode("utf-8")))
+        return GetTaskResponse(resource=Resource(state=SUCCEEDED if time.time() >= metadata.done_at else RUNNING))
+
+    async def async_create(self, context, output_prefix, task_template, inputs=None) -> CreateTaskResponse:
+        await asyncio.sleep(self._delay())
+        return self._create_response()
+
+    async def async_get(self, context, resource_meta: bytes) -> GetTaskResponse:
+        await asyncio.sleep(self._delay())
+        return self._get_response(resource_meta)
+
+    async def async_delete(self, context, resource_meta: bytes) -> DeleteTaskResponse:
+        await asyncio.sleep(self._delay())
+        return DeleteTaskResponse()
+
+    def create(self, context, output_prefix, task_template, inputs=None) -> CreateTaskResponse:
+        time.sleep(self._delay())
+        return self._create_response()
+
+    def get(self, context, resource_meta: bytes) -> GetTaskResponse:
+        time.sleep(self._delay())
+        return self._get_response(resource_meta)
+
+    def delete(self, context, resource_meta: bytes) -> DeleteTaskResponse:
+        time.sleep(self._delay())
+        return DeleteTaskResponse()
+
+
+# %% [markdown]
+# ## Agent server
+#
+# The server process registers the fake agent and serves the agent service with `grpc.aio`, as `pynebula serve agent`
+# does. Alongside the server, a monitor coroutine sleeps for `lag_interval` seconds at a time and records how late it
+# wakes up. On an idle loop the lag stays close to zero; once the loop is saturated, every callback waits behind
+# the others and the lag grows.
+# %%
+async def _monitor_loop_lag(interval: float, lags: typing.List[float]):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def _serve(config: FakeBackendConfig, port_queue, stop_event, stats_queue, lag_interval: float):
+    AgentRegistry.register(FakeAgent(config))
+    server = grpc.aio.server(options=[("grpc.max_concurrent_streams", 100_000)])
+    add_AsyncAgentServiceServicer_to_server(AsyncAgentService(), server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    await server.start()
+    port_queue.put(port)
+
+    lags: typing.List[float] = []
+    monitor = asyncio.create_task(_monitor_loop_lag(lag_interval, lags))
+    while not stop_event.is_set():
+        await asyncio.sleep(0.1)
+    monitor.cancel()
+    await server.stop(grace=None)
+    stats_queue.put(lags)
+
+
+def serve(config: FakeBackendConfig, port_queue, stop_event, stats_queue, lag_interval: float = 0.01):
+    asyncio.run(_serve(config, port_queue, stop_event, stats_queue, lag_interval))
+
+
+# %% [markdown]
+# ## Load generator
+#
+# Every lifecycle creates a task, polls it every `poll_interval` seconds until it succeeds or fails, and deletes it.
+# At most `concurrency` lifecycles are in flight at any time, over a single channel.
+# A failed RPC is counted as an error for that RPC, and ends the lifecycle.
+# %%
+TERMINAL_STATES = {SUCCEEDED, PERMANENT_FAILURE, RETRYABLE_FAILURE}
+
+
+def _task_template() -> tasks_pb2.TaskTemplate:
+    return tasks_pb2.TaskTemplate(
+        id=identifier_pb2.Identifier(
+            resource_type=identifier_pb2.TASK, project="load-test", domain="development", name="fake", version="1"
+        ),
+        type=TASK_TYPE,
+    )
+
+
+class RpcStats:
+    def __init__(self):
+        self.latencies: typing.Dict[str, typing.List[float]] = {"CreateTask": [], "GetTask": [], "DeleteTask": []}
+        self.errors: typing.Dict[str, int] = {name: 0 for name in self.latencies}
+
+    async def call(self, name: str, rpc, request):
+        start = time.perf_counter()
+        try:
+            return await rpc(request)
+        except grpc.aio.AioRpcError:
+            self.errors[name] += 1
+            raise
+        finally:
+            self.latencies[name].append(time.perf_counter() - start)
+
+
+async def _lifecycle(stub: AsyncAgentServiceStub, stats: RpcStats, poll_interval: float) -> bool:
+    try:
+        created = await stats.call(
+            "CreateTask",
+            stub.CreateTask,
+            CreateTaskRequest(template=_task_template(), output_prefix="/tmp/load-test"),
+        )
+        while True:
+            response = await stats.call(
+                "GetTask", stub.GetTask, GetTaskRequest(task_type=TASK_TYPE, resource_meta=created.resource_meta)
+            )
+            if response.resource.state in TERMINAL_STATES:
+                break
+            await asyncio.sleep(poll_interval)
+        await stats.call(
+            "DeleteTask", stub.DeleteTask, DeleteTaskRequest(task_type=TASK_TYPE, resource_meta=created.resource_meta)
+        )
+        return True
+    except grpc.aio.AioRpcError:
+        return False
+
+
+async def drive(port: int, n_tasks: int, concurrency: int, poll_interval: float) -> typing.Tuple[RpcStats, int, float]:
+    stats = RpcStats()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(stub):
+        async with semaphore:
+            return await _lifecycle(stub, stats, poll_interval)
+
+    async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+        stub = AsyncAgentServiceStub(channel)
+        start = time.perf_counter()
+        results = await asyncio.gather(*(bounded(stub) for _ in range(n_tasks)))
+        wall_seconds = time.perf_counter() - start
+    return stats, sum(results), wall_seconds
+
+
+# %% [markdown]
+# ## Load test
+#
+# `load_test` starts the server, drives `n_tasks` lifecycles against it and prints the report.
+# %%
+def _percentile(values: typing.List[float], q: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100)[q - 1]
+
+
+def load_test(
+    n_tasks: int = 5000,
+    concurrency: int = 1000,
+    poll_interval: float = 0.2,
+    config: typing.Optional[FakeBackendConfig] = None,
+) -> dict:
+    config = config or FakeBackendConfig()
+    mp_ctx = multiprocessing.get_context("spawn")
+    port_queue, stats_queue, stop_event = mp_ctx.Queue(), mp_ctx.Queue(), mp_ctx.Event()
+    server = mp_ctx.Process(target=serve, args=(config, port_queue, stop_event, stats_queue))
+    server.start()
+    try:
+        stats, completed, wall_seconds = asyncio.run(
+            drive(port_queue.get(timeout=60), n_tasks, concurrency, poll_interval)
+        )
+    finally:
+        stop_event.set()
+    lags = stats_queue.get()
+    server.join()
+
+    report = {
+        "completed": completed,
+        "throughput": completed / wall_seconds,
+        "loop_lag_p99_ms": _percentile(lags, 99) * 1000,
+        "loop_lag_max_ms": max(lags, default=0.0) * 1000,
+        "rpcs": {
+            name: {
+                "count": len(latencies),
+                "errors": stats.errors[name],
+                "p50_ms": _percentile(latencies, 50) * 1000,
+                "p99_ms": _percentile(latencies, 99) * 1000,
+            }
+            for name, latencies in stats.latencies.items()
+        },
+    }
+    print(
+        f"{completed}/{n_tasks} lifecycles at concurrency {concurrency}: {report['throughput']:.1f}/s, "
+        f"server loop lag p99 {report['loop_lag_p99_ms']:.1f} ms, max {report['loop_lag_max_ms']:.1f} ms"
+    )
+    print(f"{'rpc':>12} {'count':>8} {'errors':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, rpc in report["rpcs"].items():
+        print(f"{name:>12} {rpc['count']:>8} {rpc['errors']:>8} {rpc['p50_ms']:>8.1f} {rpc['p99_ms']:>8.1f}")
+    return report
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark increases the concurrency for an asynchronous and a blocking agent, with a small failure rate.
+# Once the loop lag or the p99 latency of `GetTask` approaches the `GetTask` timeout configured for the agent in
+# propeller, one replica is saturated at that concurrency.
+# %%
+def benchmark(concurrencies=(100, 1000, 5000), failure_rate: float = 0.01):
+    for blocking in (False, True):
+        config = FakeBackendConfig(failure_rate=failure_rate, blocking=blocking)
+        for concurrency in concurrencies:
+            print(f"\n{'blocking' if blocking else 'async'} agent")
+            load_test(n_tasks=concurrency * 2, concurrency=concurrency, config=config)
+
+
+# %% [markdown]
+# You can run the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,421 @@
+# %% [markdown]
+# (bulk_inspection)=
+#
+# # Inspecting Large Executions in Bulk
+#
+# ```{eval-rst}
+# .. tags:: Advanced
+# ```
+#
+# The {doc}`inspecting executions <inspecting_executions>` guide walks an execution with
+# `remote.sync(execution, sync_nodes=True)`, which lists the node executions and fetches the inputs and outputs
+# of every one of them, one request at a time. For an execution with thousands of dynamic or map subnodes,
+# that takes minutes, even when only a handful of nodes are of interest.
+#
+# This example defines a `BulkExecutionInspector` that
+#
+# - lists node executions page by page, and the children of all parent nodes concurrently,
+# - fetches the input and output literals only for the nodes that are asked for, in parallel, and
+# - caches node listings and literals on disk by execution ID, once they can no longer change.
+#
+# It talks to NebulaAdmin through the client of a `NebulaRemote`, and also works against the local admin stand-in
+# defined below, which is how it is tested and benchmarked.
+#
+# To begin, import the dependencies.
+# %%
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import typing
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from nebulaidl.core import literals_pb2
+from nebulakit.models.core.execution import NodeExecutionPhase, WorkflowExecutionPhase
+from nebulakit.models.core.identifier import NodeExecutionIdentifier, WorkflowExecutionIdentifier
+from nebulakit.models.literals import Literal, LiteralMap, Primitive, Scalar
+
+# %% [markdown]
+# ## Node records
+#
+# A `NodeRecord` holds the fields of a node execution that are needed to find the nodes of interest.
+# Parent nodes, such as dynamic workflow nodes, have children, which are listed under the ID of the parent.
+# %%
+TERMINAL_NODE_PHASES = {
+    NodeExecutionPhase.SUCCEEDED,
+    NodeExecutionPhase.FAILED,
+    NodeExecutionPhase.ABORTED,
+    NodeExecutionPhase.SKIPPED,
+    NodeExecutionPhase.TIMED_OUT,
+    NodeExecutionPhase.RECOVERED,
+}
+TERMINAL_EXECUTION_PHASES = {
+    WorkflowExecutionPhase.SUCCEEDED,
+    WorkflowExecutionPhase.FAILED,
+    WorkflowExecutionPhase.ABORTED,
+    WorkflowExecutionPhase.TIMED_OUT,
+}
+
+
+@dataclass
+class NodeRecord:
+    identifier: NodeExecutionIdentifier
+    parent_id: typing.Optional[str]
+    phase: int
+    is_parent: bool
+    retry_group: str
+    started_at: typing.Optional[datetime]
+    duration: typing.Optional[timedelta]
+
+    @property
+    def node_id(self) -> str:
+        return self.identifier.node_id
+
+    @property
+    def phase_name(self) -> str:
+        return NodeExecutionPhase.enum_to_string(self.phase)
+
+    @property
+    def is_terminal(self) -> bool:
+        return self.phase in TERMINAL_NODE_PHASES
+
+
+def _record(node_execution, parent_id: typing.Optional[str]) -> NodeRecord:
+    return NodeRecord(
+        identifier=node_execution.id,
+        parent_id=parent_id,
+        phase=node_execution.closure.phase,
+        is_parent=bool(node_execution.metadata.is_parent_node),
+        retry_group=node_execution.metadata.retry_group,
+        started_at=node_execution.closure.started_at,
+        duration=node_execution.closure.duration,
+    )
+
+
+def _record_to_json(record: NodeRecord) -> typing.Dict[str, typing.Any]:
+    return {
+        "node_id": record.node_id,
+        "parent_id": record.parent_id,
+        "phase": record.phase,
+        "is_parent": record.is_parent,
+        "retry_group": record.retry_group,
+        "started_at": record.started_at.isoformat() if record.started_at else None,
+        "duration": record.duration.total_seconds() if record.duration is not None else None,
+    }
+
+
+def _record_from_json(execution_id: WorkflowExecutionIdentifier, entry: typing.Dict[str, typing.Any]) -> NodeRecord:
+    return NodeRecord(
+        identifier=NodeExecutionIdentifier(node_id=entry["node_id"], execution_id=execution_id),
+        parent_id=entry["parent_id"],
+        phase=entry["phase"],
+        is_parent=entry["is_parent"],
+        retry_group=entry["retry_group"],
+        started_at=datetime.fromisoformat(entry["started_at"]) if entry["started_at"] else None,
+        duration=timedelta(seconds=entry["duration"]) if entry["duration"] is not None else None,
+    )
+
+
+# %% [markdown]
+# ## Local cache
+#
+# Cached entries are stored under a directory per execution, in the user's cache directory, which only the user can
+# write to. They are stored as data that is parsed rather than executed: node listings as JSON and literals as
+# the serialized `LiteralMap` protobuf. The node listing is only cached once the execution has finished,
+# and the literals of a node once the node has finished, so the cache never serves stale data.
+# Entries are written to a temporary file and moved into place, so concurrent readers never see partial files.
+# %%
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.cache/nebula-inspection")
+
+
+class InspectionCache:
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR):
+        self._cache_dir = cache_dir
+
+    def _path(self, execution_id: WorkflowExecutionIdentifier, key: str) -> str:
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self._cache_dir, execution_id.project, execution_id.domain, execution_id.name, digest)
+
+    def load(self, execution_id: WorkflowExecutionIdentifier, key: str) -> typing.Optional[bytes]:
+        try:
+            with open(self._path(execution_id, key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def store(self, execution_id: WorkflowExecutionIdentifier, key: str, data: bytes):
+        path = self._path(execution_id, key)
+        os.makedirs(self._cache_dir, mode=0o700, exist_ok=True)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+# %% [markdown]
+# ## Lazy node inputs and outputs
+#
+# `NodeIO` wraps the future of a `get_node_execution_data` request, and only blocks when the literals are read.
+# Admin returns small literal maps inline and larger ones as a signed URL to the serialized literal map, which is
+# downloaded with the file access of the `NebulaRemote`.
+# %%
+class NodeIO:
+    def __init__(self, future: Future):
+        self._future = future
+
+    @property
+    def inputs(self) -> LiteralMap:
+        return self._future.result()[0]
+
+    @property
+    def outputs(self) -> LiteralMap:
+        return self._future.result()[1]
+
+
+# %% [markdown]
+# ## Bulk inspector
+#
+# Admin pages node executions with an opaque token, so the pages of one listing are fetched one after the other.
+# The listings of different parents are independent, though, so the inspector lists the top-level nodes,
+# then the children of every parent node as soon as the parent is found, on a thread pool.
+# %%
+class BulkExecutionInspector:
+    def __init__(
+        self,
+        client,
+        remote=None,
+        cache: typing.Optional[InspectionCache] = None,
+        max_workers: int = 16,
+        page_size: int = 100,
+    ):
+        self._client = client
+        self._remote = remote
+        self._cache = cache if cache is not None else InspectionCache()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._page_size = page_size
+
+    @classmethod
+    def for_remote(cls, remote, **kwargs) -> "BulkExecutionInspector":
+        return cls(remote.client, remote=remote, **kwargs)
+
+    def _list_children(
+        self, execution_id: WorkflowExecutionIdentifier, parent_id: typing.Optional[str]
+    ) -> typing.List[NodeRecord]:
+        records, token = [], ""
+        while True:
+            node_executions, token = self._client.list_node_executions(
+                execution_id, limit=self._page_size, token=token, unique_parent_id=parent_id
+            )
+            records.extend(_record(node_execution, parent_id) for node_execution in node_executions)
+            if not token:
+                return records
+
+    def node_executions(self, execution_id: WorkflowExecutionIdentifier) -> typing.List[NodeRecord]:
+        cached = self._cache.load(execution_id, "nodes")
+        if cached is not None:
+            return [_record_from_json(execution_id, entry) for entry in json.loads(cached)]
+        execution_finished = self._client.get_execution(execution_id).closure.phase in TERMINAL_EXECUTION_PHASES
+
+        records: typing.List[NodeRecord] = []
+        pending = {self._pool.submit(self._list_children, execution_id, None)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for record in future.result():
+                    records.append(record)
+                    if record.is_parent:
+                        pending.add(self._pool.submit(self._list_children, execution_id, record.node_id))
+
+        if execution_finished:
+            self._cache.store(execution_id, "nodes", json.dumps([_record_to_json(r) for r in records]).encode())
+        return records
+
+    def _literal_map(self, full: LiteralMap, blob) -> LiteralMap:
+        if full.literals or blob is None or not blob.bytes:
+            return full
+        if self._remote is None:
+            raise ValueError(f"The literal map at {blob.url} can only be downloaded through a NebulaRemote")
+        with tempfile.TemporaryDirectory() as local_dir:
+            local_path = os.path.join(local_dir, "literals.pb")
+            self._remote.file_access.get_data(blob.url, local_path)
+            with open(local_path, "rb") as f:
+                return LiteralMap.from_nebula_idl(literals_pb2.LiteralMap.FromString(f.read()))
+
+    def _fetch_io(self, record: NodeRecord) -> typing.Tuple[LiteralMap, LiteralMap]:
+        execution_id = record.identifier.execution_id
+        key = f"io/{record.node_id}/{record.retry_group}"
+        cached = self._cache.load(execution_id, key)
+        if cached is not None:
+            io = LiteralMap.from_nebula_idl(literals_pb2.LiteralMap.FromString(cached)).literals
+            return io["inputs"].map, io["outputs"].map
+        data = self._client.get_node_execution_data(record.identifier)
+        inputs = self._literal_map(data.full_inputs, data.inputs)
+        outputs = self._literal_map(data.full_outputs, data.outputs)
+        if record.is_terminal:
+            io = LiteralMap({"inputs": Literal(map=inputs), "outputs": Literal(map=outputs)})
+            self._cache.store(execution_id, key, io.to_nebula_idl().SerializeToString())
+        return inputs, outputs
+
+    def io(self, records: typing.Iterable[NodeRecord]) -> typing.Dict[str, NodeIO]:
+        return {record.node_id: NodeIO(self._pool.submit(self._fetch_io, record)) for record in records}
+
+    def close(self):
+        self._pool.shutdown()
+
+
+# %% [markdown]
+# With a `NebulaRemote`, inspecting the failed nodes of a large execution looks like this:
+#
+# ```python
+# inspector = BulkExecutionInspector.for_remote(remote)
+# execution_id = WorkflowExecutionIdentifier(project="nebulasnacks", domain="development", name="fb22e306a0d91e1c6000")
+# failed = [r for r in inspector.node_executions(execution_id) if r.phase == NodeExecutionPhase.FAILED]
+# for node_id, io in inspector.io(failed).items():
+#     print(node_id, io.inputs)
+# ```
+#
+# ## Local admin stand-in
+#
+# `LocalAdmin` implements the three admin calls the inspector uses, with the same pagination and parent-child
+# semantics, for a synthetic execution with `n_nodes` top-level nodes, `n_parents` of which have `n_children`
+# children each. Every call takes `latency` seconds, like a round trip to admin.
+# The objects it returns only have the attributes that the inspector reads.
+# %%
+@dataclass
+class _Closure:
+    phase: int
+    started_at: typing.Optional[datetime] = None
+    duration: typing.Optional[timedelta] = None
+
+
+@dataclass
+class _Metadata:
+    is_parent_node: bool
+    retry_group: str = "0"
+
+
+@dataclass
+class _NodeExecution:
+    id: NodeExecutionIdentifier
+    closure: _Closure
+    metadata: _Metadata
+
+
+@dataclass
+class _Execution:
+    closure: _Closure
+
+
+@dataclass
+class _NodeExecutionData:
+    full_inputs: LiteralMap
+    full_outputs: LiteralMap
+    inputs: typing.Any = None
+    outputs: typing.Any = None
+
+
+def _int_map(**values: int) -> LiteralMap:
+    return LiteralMap({name: Literal(scalar=Scalar(primitive=Primitive(integer=v))) for name, v in values.items()})
+
+
+class LocalAdmin:
+    def __init__(self, n_nodes: int = 10, n_parents: int = 5, n_children: int = 200, latency: float = 0.02):
+        self.execution_id = WorkflowExecutionIdentifier(project="nebulasnacks", domain="development", name="local")
+        self._latency = latency
+        self._children: typing.Dict[typing.Optional[str], typing.List[_NodeExecution]] = {None: []}
+        for i in range(n_nodes):
+            node_id = f"n{i}"
+            is_parent = i < n_parents
+            self._children[None].append(self._node(node_id, is_parent))
+            if is_parent:
+                self._children[node_id] = [self._node(f"{node_id}-0-dn{j}", False) for j in range(n_children)]
+        self.calls = 0
+
+    def _node(self, node_id: str, is_parent: bool) -> _NodeExecution:
+        return _NodeExecution(
+            id=NodeExecutionIdentifier(node_id=node_id, execution_id=self.execution_id),
+            closure=_Closure(phase=NodeExecutionPhase.SUCCEEDED, started_at=datetime.now(), duration=timedelta(1)),
+            metadata=_Metadata(is_parent_node=is_parent),
+        )
+
+    def _round_trip(self):
+        self.calls += 1
+        time.sleep(self._latency)
+
+    def get_execution(self, execution_id: WorkflowExecutionIdentifier) -> _Execution:
+        self._round_trip()
+        return _Execution(closure=_Closure(phase=WorkflowExecutionPhase.SUCCEEDED))
+
+    def list_node_executions(self, execution_id, limit: int = 100, token: str = "", unique_parent_id=None, **kwargs):
+        self._round_trip()
+        offset = int(token or 0)
+        children = self._children[unique_parent_id]
+        next_token = str(offset + limit) if offset + limit < len(children) else ""
+        return children[offset : offset + limit], next_token
+
+    def get_node_execution_data(self, node_execution_id: NodeExecutionIdentifier) -> _NodeExecutionData:
+        self._round_trip()
+        index = int(node_execution_id.node_id.rsplit("n", 1)[-1])
+        return _NodeExecutionData(full_inputs=_int_map(x=index), full_outputs=_int_map(o0=index * index))
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark inspects the inputs and outputs of every node of the synthetic execution, first one request at a time,
+# as `remote.sync` does, then with the bulk inspector and an empty cache, and then again with a warm cache.
+# %%
+def _sequential(admin: LocalAdmin) -> int:
+    n_nodes, parents = 0, [None]
+    while parents:
+        parent_id = parents.pop()
+        token = ""
+        while True:
+            node_executions, token = admin.list_node_executions(
+                admin.execution_id, token=token, unique_parent_id=parent_id
+            )
+            for node_execution in node_executions:
+                admin.get_node_execution_data(node_execution.id)
+                n_nodes += 1
+                if node_execution.metadata.is_parent_node:
+                    parents.append(node_execution.id.node_id)
+            if not token:
+                break
+    return n_nodes
+
+
+def _bulk(admin: LocalAdmin, cache: InspectionCache) -> int:
+    inspector = BulkExecutionInspector(admin, cache=cache, max_workers=32)
+    records = inspector.node_executions(admin.execution_id)
+    for io in inspector.io(records).values():
+        io.outputs
+    inspector.close()
+    return len(records)
+
+
+def benchmark(n_nodes: int = 10, n_parents: int = 5, n_children: int = 200, latency: float = 0.02):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = InspectionCache(cache_dir)
+        cases = [
+            ("sequential", _sequential),
+            ("bulk, cold cache", lambda admin: _bulk(admin, cache)),
+            ("bulk, warm cache", lambda admin: _bulk(admin, cache)),
+        ]
+        print(f"{'inspection':>18} {'nodes':>8} {'admin calls':>12} {'seconds':>8}")
+        for name, inspect in cases:
+            admin = LocalAdmin(n_nodes, n_parents, n_children, latency)
+            start = time.perf_counter()
+            n = inspect(admin)
+            print(f"{name:>18} {n:>8} {admin.calls:>12} {time.perf_counter() - start:>8.2f}")
+
+
+# %% [markdown]
+# You can run the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    benchmark()
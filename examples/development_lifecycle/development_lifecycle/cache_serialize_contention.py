@@ -0,0 +1,256 @@
+# %% [markdown]
+# (cache_serialize_contention)=
+#
+# # Measuring Cache Serializing Under Contention
+#
+# ```{eval-rst}
+# .. tags:: Advanced
+# ```
+#
+# The {ref}`cache serializing <task_cache_serialize>` example explains how `cache_serialize=True` lets a single
+# execution of a cacheable task produce the outputs while concurrent identical executions wait for them.
+# How well that works depends on the reservation timeout: the reservation expires when its owner has not extended it
+# for a few heartbeat intervals, so a short interval recovers quickly from a failed owner, while a long one
+# tolerates slow heartbeats without handing the work to a second execution.
+#
+# This example implements a local stand-in for the reservation service of the data catalog,
+# and a harness that launches `N` concurrent identical executions of the `square` task to measure
+#
+# - duplicate work, the number of times the task body runs beyond the first,
+# - wait latency, the time an execution spends waiting for the outputs of another, and
+# - throughput, the number of executions that complete per second.
+#
+# To begin, import the dependencies.
+# %%
+import random
+import statistics
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from .task_cache_serialize import square
+
+
+# %% [markdown]
+# ## Reservation service
+#
+# The service follows the reservation protocol of the data catalog.
+# `get_or_extend_reservation` grants the reservation to the caller if nobody holds it, if it has expired,
+# or if the caller already owns it, in which case the reservation is extended.
+# A reservation expires `heartbeat_grace_period_multiplier` heartbeat intervals after it was last extended.
+# `release_reservation` only releases a reservation held by the caller.
+# The service also stores the cached outputs, standing in for the artifacts of the data catalog.
+# %%
+@dataclass(frozen=True)
+class Reservation:
+    owner_id: str
+    expires_at: float
+    heartbeat_interval: float
+
+
+_MISSING = object()
+
+
+class ReservationService:
+    def __init__(self, heartbeat_grace_period_multiplier: int = 3, clock: typing.Callable[[], float] = time.monotonic):
+        self._multiplier = heartbeat_grace_period_multiplier
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._reservations: typing.Dict[str, Reservation] = {}
+        self._artifacts: typing.Dict[str, typing.Any] = {}
+
+    def get_artifact(self, key: str) -> typing.Any:
+        with self._lock:
+            return self._artifacts.get(key, _MISSING)
+
+    def put_artifact(self, key: str, value: typing.Any):
+        with self._lock:
+            self._artifacts[key] = value
+
+    def get_or_extend_reservation(self, key: str, owner_id: str, heartbeat_interval: float) -> Reservation:
+        with self._lock:
+            now = self._clock()
+            reservation = self._reservations.get(key)
+            if reservation is None or reservation.expires_at < now or reservation.owner_id == owner_id:
+                reservation = Reservation(owner_id, now + heartbeat_interval * self._multiplier, heartbeat_interval)
+                self._reservations[key] = reservation
+            return reservation
+
+    def release_reservation(self, key: str, owner_id: str):
+        with self._lock:
+            reservation = self._reservations.get(key)
+            if reservation is not None and reservation.owner_id == owner_id:
+                del self._reservations[key]
+
+
+# %% [markdown]
+# ## Serialized execution
+#
+# Every execution first looks for cached outputs. On a miss, it asks for the reservation. The owner runs the task,
+# extending the reservation from a heartbeat thread, then writes the outputs and releases the reservation.
+# Every other execution polls until the outputs appear, or until it acquires an expired reservation itself.
+#
+# `heartbeat_jitter` delays every heartbeat by a random amount of up to that many seconds, like a busy propeller
+# that evaluates the node late. An owner that fails stops extending the reservation and never releases it.
+# %%
+class OwnerFailed(Exception):
+    pass
+
+
+@dataclass
+class ExecutionResult:
+    runs: int = 0
+    wait_seconds: float = 0.0
+    failed: bool = False
+
+
+def _run_with_heartbeat(
+    service: ReservationService,
+    key: str,
+    owner_id: str,
+    fn: typing.Callable[[], typing.Any],
+    heartbeat_interval: float,
+    heartbeat_jitter: float,
+) -> typing.Any:
+    done = threading.Event()
+
+    def heartbeat():
+        while not done.wait(heartbeat_interval + random.uniform(0, heartbeat_jitter)):
+            service.get_or_extend_reservation(key, owner_id, heartbeat_interval)
+
+    heartbeater = threading.Thread(target=heartbeat, daemon=True)
+    heartbeater.start()
+    try:
+        return fn()
+    finally:
+        done.set()
+        heartbeater.join()
+
+
+def execute(
+    service: ReservationService,
+    key: str,
+    owner_id: str,
+    fn: typing.Callable[[], typing.Any],
+    serialize: bool = True,
+    heartbeat_interval: float = 0.1,
+    heartbeat_jitter: float = 0.0,
+    poll_interval: float = 0.01,
+) -> ExecutionResult:
+    result = ExecutionResult()
+    start = time.monotonic()
+    while service.get_artifact(key) is _MISSING:
+        if serialize:
+            reservation = service.get_or_extend_reservation(key, owner_id, heartbeat_interval)
+            if reservation.owner_id != owner_id:
+                time.sleep(poll_interval)
+                continue
+        result.wait_seconds = time.monotonic() - start
+        result.runs += 1
+        try:
+            output = _run_with_heartbeat(service, key, owner_id, fn, heartbeat_interval, heartbeat_jitter)
+        except OwnerFailed:
+            result.failed = True
+            return result
+        service.put_artifact(key, output)
+        if serialize:
+            service.release_reservation(key, owner_id)
+        return result
+    result.wait_seconds = time.monotonic() - start
+    return result
+
+
+# %% [markdown]
+# ## Harness
+#
+# `run_contention` releases `n` executions of `square` at the same time. Every run of the task body takes
+# `task_seconds`. With `fail_owner`, the first execution that runs the task body fails halfway through,
+# and the others have to wait for its reservation to expire.
+# %%
+def run_contention(
+    n: int,
+    task_seconds: float = 0.5,
+    serialize: bool = True,
+    heartbeat_interval: float = 0.1,
+    heartbeat_jitter: float = 0.0,
+    fail_owner: bool = False,
+) -> dict:
+    service = ReservationService()
+    failed = threading.Event()
+    start_barrier = threading.Barrier(n)
+
+    def body() -> int:
+        if fail_owner and not failed.is_set():
+            failed.set()
+            time.sleep(task_seconds / 2)
+            raise OwnerFailed()
+        time.sleep(task_seconds)
+        return square.task_function(n=2)
+
+    def run(i: int) -> ExecutionResult:
+        start_barrier.wait()
+        return execute(
+            service,
+            "square-n=2",
+            f"execution-{i}",
+            body,
+            serialize=serialize,
+            heartbeat_interval=heartbeat_interval,
+            heartbeat_jitter=heartbeat_jitter,
+        )
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        results = list(pool.map(run, range(n)))
+    wall_seconds = time.monotonic() - start
+
+    completed = [r for r in results if not r.failed]
+    waits = sorted(r.wait_seconds for r in completed)
+    return {
+        "n": n,
+        "duplicate_runs": sum(r.runs for r in results) - len(results) + len(completed) - 1,
+        "mean_wait": statistics.fmean(waits),
+        "max_wait": waits[-1],
+        "throughput": len(completed) / wall_seconds,
+    }
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The first table compares serialized and non-serialized executions as `N` grows.
+# Without serializing, every execution that misses the cache runs the task body.
+#
+# The second table varies the heartbeat interval with late heartbeats and a failing owner:
+# with an interval that is short compared to the heartbeat jitter, reservations expire while the owner is still running,
+# and the task body runs more than once; with a long interval, the remaining executions wait for a long time
+# after the owner fails. The reservation timeout should be a few times the worst heartbeat delay, and no longer.
+# %%
+def _print_row(label: str, stats: dict):
+    print(
+        f"{label:>24} {stats['n']:>5} {stats['duplicate_runs']:>10} {stats['mean_wait']:>10.3f} "
+        f"{stats['max_wait']:>10.3f} {stats['throughput']:>12.1f}"
+    )
+
+
+def benchmark(ns=(1, 2, 4, 8, 16, 32, 64), heartbeat_intervals=(0.02, 0.05, 0.1, 0.5, 1.0)):
+    header = f"{'case':>24} {'N':>5} {'duplicates':>10} {'mean wait':>10} {'max wait':>10} {'executions/s':>12}"
+    print(header)
+    for n in ns:
+        _print_row("no cache_serialize", run_contention(n, serialize=False))
+        _print_row("cache_serialize", run_contention(n, serialize=True))
+
+    print()
+    print(header)
+    for heartbeat_interval in heartbeat_intervals:
+        stats = run_contention(16, heartbeat_interval=heartbeat_interval, heartbeat_jitter=0.1, fail_owner=True)
+        _print_row(f"heartbeat {heartbeat_interval}s", stats)
+
+
+# %% [markdown]
+# You can run the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,271 @@
+# %% [markdown]
+# (content_hashing)=
+#
+# # Content Hashing for Cached Tasks
+#
+# ```{eval-rst}
+# .. tags:: Advanced
+# ```
+#
+# The {ref}`caching <cache-offloaded-objects>` example computes the hash of a dataframe output with
+# `str(pandas.util.hash_pandas_object(df))`. That string is the repr of a `Series`, which pandas truncates
+# to its first and last rows, so dataframes that differ in the middle get the same hash, and building the repr
+# of a large `Series` is slow as well.
+#
+# This example provides content hash functions that can be passed directly to `HashMethod`. They feed the raw memory
+# of the value to a fast streaming hash, [xxHash](https://xxhash.com/) or [BLAKE3](https://github.com/BLAKE3-team/BLAKE3),
+# without building intermediate strings, and cover
+#
+# - pandas dataframes and Arrow tables, by hashing their Arrow buffers,
+# - NumPy arrays and PyTorch tensors, and
+# - `NebulaFile` and `NebulaDirectory`, by streaming the file contents.
+#
+# To begin, import the dependencies.
+# %%
+import json
+import os
+import sys
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas
+import pyarrow as pa
+import xxhash
+from nebulakit import HashMethod, task, workflow
+from nebulakit.types.directory import NebulaDirectory
+from nebulakit.types.file import NebulaFile
+from typing_extensions import Annotated
+
+# %% [markdown]
+# ## Hash algorithms
+#
+# `xxh3_128` is the default: it is not a cryptographic hash, but it runs at memory bandwidth and 128 bits make
+# accidental collisions between cache keys practically impossible. `blake3` is a cryptographic hash
+# that is also fast, and requires the `blake3` package.
+# %%
+DEFAULT_ALGORITHM = "xxh3_128"
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def new_hasher(algorithm: str = DEFAULT_ALGORITHM):
+    if algorithm == "xxh3_128":
+        return xxhash.xxh3_128()
+    if algorithm == "xxh3_64":
+        return xxhash.xxh3_64()
+    if algorithm == "blake3":
+        import blake3
+
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    raise ValueError(f"Unsupported hash algorithm {algorithm}, expected xxh3_128, xxh3_64 or blake3")
+
+
+# %% [markdown]
+# ## Arrow tables and dataframes
+#
+# An Arrow table is hashed through its schema, followed by the length, offset and length-prefixed buffers of every chunk
+# of every column, which covers nested and string columns as well. The buffers are passed to the hasher as they are,
+# without a copy. The metadata of the schema and its fields is left out of the hash, since it is not part of the data
+# and often records the versions of the libraries that wrote it, which would change every cache key on an upgrade.
+#
+# The hash describes the memory layout of the table, so equal tables that are chunked or sliced differently
+# may hash differently. For a cache key, that only results in a cache miss.
+#
+# Dataframes are converted to Arrow first, including their index. Instead of the pandas metadata, which includes
+# the pandas and pyarrow versions, the hash covers the names of the index levels and the column labels,
+# along with their types, so that, for instance, an index and a regular column of the same values hash differently.
+# %%
+def _update_with_array(hasher, array: pa.Array):
+    hasher.update(np.array([len(array), array.offset], dtype="<i8").tobytes())
+    for buffer in array.buffers():
+        # every buffer is prefixed with its length, and a missing buffer with -1, so different splits of the same bytes
+        # into buffers hash differently
+        hasher.update(np.array([-1 if buffer is None else buffer.size], dtype="<i8").tobytes())
+        if buffer is not None:
+            hasher.update(memoryview(buffer))
+
+
+def _update_with_table(hasher, table: pa.Table):
+    schema = pa.schema([field.remove_metadata() for field in table.schema])
+    hasher.update(memoryview(schema.serialize()))
+    for column in table.columns:
+        for chunk in column.chunks:
+            _update_with_array(hasher, chunk)
+
+
+def hash_arrow_table(table: pa.Table, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    hasher = new_hasher(algorithm)
+    _update_with_table(hasher, table)
+    return hasher.hexdigest()
+
+
+def _labels(labels: typing.Iterable) -> typing.List[typing.List[str]]:
+    return [[type(label).__name__, str(label)] for label in labels]
+
+
+def hash_pandas_dataframe(df: pandas.DataFrame, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    hasher = new_hasher(algorithm)
+    hasher.update(json.dumps({"index": _labels(df.index.names), "columns": _labels(df.columns)}).encode())
+    _update_with_table(hasher, pa.Table.from_pandas(df, preserve_index=True))
+    return hasher.hexdigest()
+
+
+# %% [markdown]
+# ## Arrays and tensors
+#
+# Arrays are hashed through their dtype, their shape and their contiguous memory.
+# Tensors are moved to the CPU and their memory is viewed as bytes, which also works for dtypes NumPy doesn't have,
+# such as `bfloat16`.
+# %%
+def _update_with_shape(hasher, dtype: str, shape: typing.Tuple[int, ...]):
+    hasher.update(f"{dtype}{list(shape)}".encode())
+
+
+def hash_numpy_array(array: np.ndarray, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    if array.dtype.hasobject:
+        raise TypeError("Arrays of Python objects have no stable memory representation and cannot be hashed")
+    hasher = new_hasher(algorithm)
+    _update_with_shape(hasher, array.dtype.str, array.shape)
+    # a byte view, rather than a memoryview of the array, also works for datetimes and for arrays without elements
+    hasher.update(np.ascontiguousarray(array).reshape(-1).view(np.uint8))
+    return hasher.hexdigest()
+
+
+def hash_torch_tensor(tensor, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    import torch
+
+    tensor = tensor.detach().cpu().contiguous()
+    hasher = new_hasher(algorithm)
+    _update_with_shape(hasher, str(tensor.dtype), tuple(tensor.shape))
+    hasher.update(memoryview(tensor.reshape(-1).view(torch.uint8).numpy()))
+    return hasher.hexdigest()
+
+
+# %% [markdown]
+# ## Files and directories
+#
+# Files are read in blocks, so they are never held in memory as a whole.
+# A directory is hashed through the relative path, size and content hash of every file, in sorted order.
+# The files of a directory are hashed on a thread pool, since the hash functions release the GIL on large blocks.
+# Remote files and directories are downloaded first.
+# %%
+def _hash_path(path: str, algorithm: str) -> str:
+    hasher = new_hasher(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(partial(f.read, BLOCK_SIZE), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def hash_file(file: typing.Union[NebulaFile, str, os.PathLike], algorithm: str = DEFAULT_ALGORITHM) -> str:
+    if isinstance(file, NebulaFile):
+        file.download()
+    return _hash_path(os.fspath(file), algorithm)
+
+
+def hash_directory(
+    directory: typing.Union[NebulaDirectory, str, os.PathLike], algorithm: str = DEFAULT_ALGORITHM, max_workers: int = 8
+) -> str:
+    if isinstance(directory, NebulaDirectory):
+        directory.download()
+    root = os.fspath(directory)
+    paths = sorted(os.path.join(dirpath, name) for dirpath, _, names in os.walk(root) for name in names)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        digests = pool.map(partial(_hash_path, algorithm=algorithm), paths)
+        hasher = new_hasher(algorithm)
+        for path, digest in zip(paths, digests):
+            hasher.update(f"{os.path.relpath(path, root)}\0{os.path.getsize(path)}\0{digest}\n".encode())
+    return hasher.hexdigest()
+
+
+# %% [markdown]
+# ## Dispatch
+#
+# `content_hash` picks the hash function for the type of the value, and can be used with any of the types above.
+# PyTorch is only imported if the value is a tensor, so the module does not depend on it.
+# Pass a `functools.partial` to choose another algorithm, for instance `HashMethod(partial(content_hash, algorithm="blake3"))`.
+# %%
+def content_hash(value: typing.Any, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    if isinstance(value, pandas.DataFrame):
+        return hash_pandas_dataframe(value, algorithm)
+    if isinstance(value, pa.Table):
+        return hash_arrow_table(value, algorithm)
+    if isinstance(value, np.ndarray):
+        return hash_numpy_array(value, algorithm)
+    if isinstance(value, NebulaDirectory):
+        return hash_directory(value, algorithm)
+    if isinstance(value, NebulaFile):
+        return hash_file(value, algorithm)
+    torch = sys.modules.get("torch")
+    if torch is not None and isinstance(value, torch.Tensor):
+        return hash_torch_tensor(value, algorithm)
+    raise TypeError(f"Cannot compute a content hash for a value of type {type(value)}")
+
+
+# %% [markdown]
+# Use `content_hash` with `HashMethod` to annotate the output of a task,
+# so that downstream cached tasks are keyed by the content of the value.
+# %%
+@task
+def read_data(n: int) -> Annotated[pandas.DataFrame, HashMethod(content_hash)]:
+    return pandas.DataFrame({"column_1": np.arange(n), "column_2": [f"row_{i}" for i in range(n)]})
+
+
+@task(cache=True, cache_version="1.0")
+def process_data(df: pandas.DataFrame) -> int:
+    time.sleep(1)
+    return int(df["column_1"].sum())
+
+
+@workflow
+def content_hash_wf(n: int = 1000) -> int:
+    return process_data(df=read_data(n=n))
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark hashes a dataframe of `n_rows` rows, with numeric and string columns, with the `str` of
+# `hash_pandas_object` used in the caching example, with `hash_pandas_object` over the full result,
+# and with the Arrow based hash functions. It also hashes a NumPy array of the same size as the numeric columns,
+# and reports the throughput in MB/s of the in-memory size of the data.
+# %%
+def _throughput(fn, value, nbytes: int) -> float:
+    start = time.perf_counter()
+    fn(value)
+    return nbytes / 1024 / 1024 / (time.perf_counter() - start)
+
+
+def benchmark(n_rows: int = 5_000_000, n_cols: int = 8):
+    rng = np.random.default_rng(0)
+    df = pandas.DataFrame({f"col_{i}": rng.random(n_rows) for i in range(n_cols)})
+    df["label"] = pandas.Series(rng.integers(0, 1000, n_rows)).astype(str)
+    df_bytes = int(df.memory_usage(deep=True).sum())
+    array = df.drop(columns="label").to_numpy()
+
+    cases = [
+        ("str(hash_pandas_object)", lambda d: str(pandas.util.hash_pandas_object(d)), df, df_bytes),
+        (
+            "hash_pandas_object + xxh3",
+            lambda d: xxhash.xxh3_128(pandas.util.hash_pandas_object(d).values).hexdigest(),
+            df,
+            df_bytes,
+        ),
+        ("arrow + xxh3_128", partial(content_hash, algorithm="xxh3_128"), df, df_bytes),
+        ("arrow + blake3", partial(content_hash, algorithm="blake3"), df, df_bytes),
+        ("numpy + xxh3_128", partial(content_hash, algorithm="xxh3_128"), array, array.nbytes),
+        ("numpy + blake3", partial(content_hash, algorithm="blake3"), array, array.nbytes),
+    ]
+    print(f"{'hash':>26} {'MB/s':>10}")
+    for name, fn, value, nbytes in cases:
+        print(f"{name:>26} {_throughput(fn, value, nbytes):>10.1f}")
+
+
+# %% [markdown]
+# You can run the workflow and the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    print(f"Sum: {content_hash_wf()}")
+    benchmark()
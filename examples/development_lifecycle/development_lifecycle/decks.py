@@ -51,6 +51,9 @@ if custom_image.is_container():
 # :::
 #
 # Note the usage of `append` to append the Plotly deck to the Markdown deck.
+# The figure loads plotly.js from the CDN instead of inlining the library, which keeps the deck small.
+# The {ref}`Plotly decks on a size budget <plotly_deck>` example shows how to keep decks with many figures
+# and large scatter plots small as well.
 # %%
 @task(disable_deck=False, container_image=custom_image)
 def pca_plot():
@@ -69,7 +72,7 @@ def pca_plot():
         labels={"0": "PC 1", "1": "PC 2", "2": "PC 3"},
     )
     main_deck = nebulakit.Deck("pca", MarkdownRenderer().to_html("### Principal Component Analysis"))
-    main_deck.append(plotly.io.to_html(fig))
+    main_deck.append(plotly.io.to_html(fig, full_html=False, include_plotlyjs="cdn"))
 
 
 # %% [markdown]
@@ -112,6 +115,7 @@ def pca_plot():
 # #### Frame Renderer
 #
 # Creates a profile report from a Pandas DataFrame.
+# For large frames, see the {ref}`sampled profiling renderer <frame_profiling>`.
 # %%
 import pandas as pd
 from nebulakitplugins.deck.renderer import FrameProfilingRenderer
@@ -0,0 +1,286 @@
+# %% [markdown]
+# (frame_profiling)=
+#
+# # Profiling Large Frames in Decks
+#
+# ```{eval-rst}
+# .. tags:: UI, DataFrame, Advanced
+# ```
+#
+# The {ref}`decks <decks>` example renders a profile report of a dataframe with `FrameProfilingRenderer`,
+# which profiles every row and every column of the frame on a single thread. For frames with tens of millions of rows,
+# rendering the deck can take longer than the task itself.
+#
+# This example defines a profiling renderer that
+#
+# - profiles a sample of the rows, drawn uniformly with reservoir sampling or stratified by a column,
+# - computes the statistics of every column in parallel with vectorized Arrow compute kernels,
+# - limits the correlation matrix to a bounded number of columns, and
+# - works within a time budget: sections that do not finish in time are reported as skipped instead of delaying the task.
+#
+# To begin, import the dependencies.
+# %%
+import html
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from nebulakit import task
+from typing_extensions import Annotated
+
+
+# %% [markdown]
+# ## Sampling
+#
+# Reservoir sampling assigns a random key to every row and keeps the rows with the smallest keys, which is a uniform
+# sample without replacement. Since it only ever holds the current sample, it also works on a stream of batches,
+# for instance the batches of a {ref}`streaming structured dataset <streaming_structured_dataset>`. The renderer uses
+# it for Arrow tables, which are converted to pandas one record batch at a time, so only the sample is ever held
+# as a pandas frame.
+#
+# Stratified sampling draws one row from every group of a column, so small groups are still represented,
+# and splits the remaining rows between the groups in proportion to their sizes. When a column has more groups than
+# rows to sample, such as an id column, it draws one row from each of `n_rows` groups chosen at random instead.
+# %%
+def reservoir_sample(batches: typing.Iterable[pd.DataFrame], n_rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    sample, keys = None, np.empty(0)
+    for batch in batches:
+        batch_keys = rng.random(len(batch))
+        candidates = batch if sample is None else pd.concat([sample, batch], ignore_index=True)
+        all_keys = np.concatenate([keys, batch_keys])
+        if len(all_keys) > n_rows:
+            keep = np.argpartition(all_keys, n_rows)[:n_rows]
+            candidates, all_keys = candidates.iloc[keep].reset_index(drop=True), all_keys[keep]
+        sample, keys = candidates, all_keys
+    return sample if sample is not None else pd.DataFrame()
+
+
+def stratified_sample(df: pd.DataFrame, n_rows: int, column: str, seed: int = 0) -> pd.DataFrame:
+    if len(df) <= n_rows:
+        return df
+    rng = np.random.default_rng(seed)
+    codes, _ = pd.factorize(df[column], use_na_sentinel=False)
+    sizes = np.bincount(codes)
+    if len(sizes) >= n_rows:
+        quotas = np.zeros_like(sizes)
+        quotas[rng.choice(len(sizes), n_rows, replace=False)] = 1
+    else:
+        # the rows left after one per group are split by largest remainder, so the sample has exactly n_rows rows
+        remaining = n_rows - len(sizes)
+        shares, remainders = np.divmod((sizes - 1) * remaining, len(df) - len(sizes))
+        shares[np.argsort(-remainders, kind="stable")[: remaining - shares.sum()]] += 1
+        quotas = 1 + shares
+    order = np.argsort(codes, kind="stable")
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    indices = np.concatenate(
+        [order[start + rng.choice(size, quota, replace=False)] for start, size, quota in zip(starts, sizes, quotas)]
+    )
+    return df.iloc[np.sort(indices)]
+
+
+def sample_rows(
+    df: pd.DataFrame, n_rows: int, method: str = "reservoir", stratify_by: typing.Optional[str] = None, seed: int = 0
+) -> pd.DataFrame:
+    if len(df) <= n_rows:
+        return df
+    if method == "reservoir":
+        # the frame is in memory, so the keys of all rows are drawn at once instead of batch by batch
+        keys = np.random.default_rng(seed).random(len(df))
+        return df.iloc[np.sort(np.argpartition(keys, n_rows)[:n_rows])]
+    if method == "stratified":
+        if stratify_by is None:
+            raise ValueError("Stratified sampling requires the column to stratify by")
+        return stratified_sample(df, n_rows, stratify_by, seed)
+    raise ValueError(f"Unsupported sampling method {method}, expected reservoir or stratified")
+
+
+# %% [markdown]
+# ## Column statistics
+#
+# The statistics of a column are computed with `pyarrow.compute` kernels, which release the GIL,
+# so the columns are profiled on a thread pool. Quantiles are approximated with a t-digest.
+# A running kernel cannot be interrupted, so `column_stats` checks whether the renderer gave up on it between kernels.
+# Arrow has no kernels to count the distinct values of nested columns, such as lists and structs, so those columns
+# are reported as not profiled.
+# %%
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+class ProfilingCancelled(Exception):
+    pass
+
+
+def column_stats(
+    column: pa.ChunkedArray, top_k: int = 5, cancelled: typing.Optional[threading.Event] = None
+) -> typing.Dict[str, typing.Any]:
+    def check():
+        if cancelled is not None and cancelled.is_set():
+            raise ProfilingCancelled()
+
+    stats = {
+        "type": str(column.type),
+        "count": len(column) - column.null_count,
+        "missing": column.null_count,
+    }
+    try:
+        stats["distinct"] = pc.count_distinct(column).as_py()
+    except (pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        stats["note"] = "not profiled"
+        return stats
+    check()
+    if pa.types.is_integer(column.type) or pa.types.is_floating(column.type):
+        min_max = pc.min_max(column)
+        check()
+        stats.update(
+            min=min_max["min"].as_py(),
+            max=min_max["max"].as_py(),
+            mean=pc.mean(column).as_py(),
+            std=pc.stddev(column).as_py(),
+            **{f"p{int(q * 100)}": v for q, v in zip(QUANTILES, pc.tdigest(column, q=QUANTILES).to_pylist())},
+        )
+    else:
+        counts = pc.value_counts(column)
+        check()
+        order = pc.array_sort_indices(counts.field("counts"), order="descending")[:top_k]
+        stats["top"] = ", ".join(
+            f"{value} ({count})"
+            for value, count in zip(
+                counts.field("values").take(order).to_pylist(), counts.field("counts").take(order).to_pylist()
+            )
+        )
+    return stats
+
+
+def correlations(table: pa.Table, max_columns: int) -> pd.DataFrame:
+    numeric = [
+        name
+        for name, field_type in zip(table.column_names, table.schema.types)
+        if pa.types.is_integer(field_type) or pa.types.is_floating(field_type)
+    ]
+    # keep the columns with the highest variance, so that constant columns don't take up the budget
+    variances = {name: pc.variance(table[name]).as_py() or 0.0 for name in numeric}
+    selected = sorted(numeric, key=variances.get, reverse=True)[:max_columns]
+    return table.select(selected).to_pandas().corr()
+
+
+# %% [markdown]
+# ## Renderer
+#
+# The renderer profiles a sample of `sample_rows` rows, and stops waiting for the column statistics once `time_budget`
+# seconds have passed since it started. Columns that are not profiled by then, and the correlation matrix if there
+# is no time left for it, are listed as skipped. Like other renderers, it can be used directly or in an `Annotated` type.
+# %%
+class SampledFrameProfilingRenderer:
+    def __init__(
+        self,
+        sample_rows: int = 100_000,
+        sampling: str = "reservoir",
+        stratify_by: typing.Optional[str] = None,
+        max_correlation_columns: int = 20,
+        time_budget: float = 30.0,
+        max_workers: typing.Optional[int] = None,
+        seed: int = 0,
+    ):
+        self._sample_rows = sample_rows
+        self._sampling = sampling
+        self._stratify_by = stratify_by
+        self._max_correlation_columns = max_correlation_columns
+        self._time_budget = time_budget
+        self._max_workers = max_workers
+        self._seed = seed
+
+    def to_html(self, df: typing.Union[pd.DataFrame, pa.Table]) -> str:
+        deadline = time.monotonic() + self._time_budget
+        n_rows, n_columns = df.shape if isinstance(df, pd.DataFrame) else (df.num_rows, df.num_columns)
+        if isinstance(df, pa.Table) and self._sampling == "reservoir":
+            batches = (batch.to_pandas() for batch in df.to_batches())
+            sample = reservoir_sample(batches, self._sample_rows, self._seed)
+        else:
+            if isinstance(df, pa.Table):
+                df = df.to_pandas()
+            sample = sample_rows(df, self._sample_rows, self._sampling, self._stratify_by, self._seed)
+        table = pa.Table.from_pandas(sample, preserve_index=False)
+
+        cancelled = threading.Event()
+        pool = ThreadPoolExecutor(max_workers=self._max_workers)
+        futures = {pool.submit(column_stats, table[name], cancelled=cancelled): name for name in table.column_names}
+        done, not_done = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+        # the workers stop at their next check, so waiting for them only takes as long as the kernels they are running
+        cancelled.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+        stats = {futures[f]: f.result() for f in done}
+        skipped = sorted(futures[f] for f in not_done)
+
+        corr = None
+        if self._max_correlation_columns and time.monotonic() < deadline:
+            corr = correlations(table, self._max_correlation_columns)
+
+        summary = pd.DataFrame.from_dict({name: stats[name] for name in table.column_names if name in stats}, "index")
+        parts = [
+            "<h3>Profile</h3>",
+            f"<p>{len(sample):,} of {n_rows:,} rows sampled with {html.escape(self._sampling)} sampling, "
+            f"{n_columns} columns.</p>",
+            summary.to_html(float_format=lambda v: f"{v:.4g}", na_rep=""),
+        ]
+        if skipped:
+            parts.append(f"<p>Skipped after {self._time_budget:g}s: {html.escape(', '.join(skipped))}</p>")
+        if corr is not None:
+            parts += ["<h3>Correlations</h3>", corr.to_html(float_format=lambda v: f"{v:.2f}")]
+        elif self._max_correlation_columns:
+            parts.append(f"<p>Correlations skipped after {self._time_budget:g}s.</p>")
+        return "\n".join(parts)
+
+
+# %% [markdown]
+# Annotate the output of a task with the renderer to profile it in the output deck.
+# %%
+@task(disable_deck=False)
+def profiled_frame(n_rows: int) -> Annotated[pd.DataFrame, SampledFrameProfilingRenderer(stratify_by="category")]:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(
+        {
+            "category": rng.choice(["a", "b", "c", "rare"], size=n_rows, p=[0.5, 0.3, 0.1999, 0.0001]),
+            "value": rng.normal(size=n_rows),
+            "count": rng.integers(0, 100, size=n_rows),
+        }
+    )
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark profiles frames of increasing size, with `n_cols` numeric columns and one string column,
+# with the sampled renderer and, for frames of up to `baseline_max_rows` rows, with `FrameProfilingRenderer`.
+# %%
+def benchmark(sizes=(100_000, 1_000_000, 10_000_000, 50_000_000), n_cols: int = 10, baseline_max_rows: int = 100_000):
+    from nebulakitplugins.deck.renderer import FrameProfilingRenderer
+
+    rng = np.random.default_rng(0)
+    print(f"{'rows':>12} {'FrameProfilingRenderer s':>26} {'sampled s':>10}")
+    for n_rows in sizes:
+        df = pd.DataFrame({f"col_{i}": rng.random(n_rows) for i in range(n_cols)})
+        df["label"] = rng.choice(["a", "b", "c"], size=n_rows)
+
+        baseline = "-"
+        if n_rows <= baseline_max_rows:
+            start = time.perf_counter()
+            FrameProfilingRenderer().to_html(df=df)
+            baseline = f"{time.perf_counter() - start:.2f}"
+
+        start = time.perf_counter()
+        SampledFrameProfilingRenderer().to_html(df)
+        print(f"{n_rows:>12} {baseline:>26} {time.perf_counter() - start:>10.2f}")
+
+
+# %% [markdown]
+# You can run the task and the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    profiled_frame(n_rows=1_000_000)
+    benchmark()
@@ -66,3 +66,7 @@
 # node_execution_output = synced_execution.node_executions["n1"].outputs["model_file"]
 # ```
 #
+# :::{note}
+# `remote.sync` fetches every node execution, and the inputs and outputs of every node, one request at a time.
+# To inspect executions with thousands of dynamic or map subnodes, see {ref}`bulk_inspection`.
+# :::
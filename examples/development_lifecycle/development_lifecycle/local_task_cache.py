@@ -0,0 +1,131 @@
+# %% [markdown]
+# (local_task_cache)=
+#
+# # Bounded Local Task Cache
+#
+# ```{eval-rst}
+# .. tags:: Advanced
+# ```
+#
+# As described in the {ref}`caching <task_cache>` example, local executions of tasks with `cache=True` are memoized
+# in a [diskcache](https://grantjenks.com/docs/diskcache/) store under `~/.nebula/local-cache/`, keyed by the task name,
+# the `cache_version`, the task signature and the hashes of the inputs. The store persists across Python processes,
+# so a second run of a long local pipeline only executes the tasks whose inputs changed.
+#
+# This example configures that store with
+#
+# - a size limit, beyond which the least recently *used* entries are evicted, rather than the least recently stored, and
+# - hit and miss counters, shared by all processes that use the cache, along with a `stats` command that reports
+#   the hit ratio and the number of bytes that were served from the cache instead of being recomputed.
+#
+# diskcache commits every write in an SQLite transaction, and writes large values to a file before the transaction
+# refers to it, so processes that run concurrently never observe a partially written entry.
+#
+# To begin, import the dependencies.
+# %%
+import os
+import pickle
+import sys
+import time
+
+import diskcache
+from nebulakit import task, workflow
+from nebulakit.core.local_cache import CACHE_LOCATION, LocalTaskCache
+
+# %% [markdown]
+# ## Cache with statistics
+#
+# `BoundedCache` extends `diskcache.Cache` to count hits and misses in a separate, never-evicted store inside the
+# cache directory. `Cache.incr` is atomic across processes. The bytes saved by a hit are the pickled size of the
+# cached outputs; offloaded outputs, such as dataframes and files, are stored by reference and not counted.
+# %%
+DEFAULT_SIZE_LIMIT = 2 * 1024**3
+STATS_DIR = "stats"
+_MISSING = object()
+
+
+class BoundedCache(diskcache.Cache):
+    def __init__(self, directory: str, size_limit: int = DEFAULT_SIZE_LIMIT):
+        super().__init__(directory, size_limit=size_limit, eviction_policy="least-recently-used")
+        self._stats = diskcache.Cache(os.path.join(directory, STATS_DIR), eviction_policy="none")
+
+    def get(self, key, default=None, **kwargs):
+        value = super().get(key, default=_MISSING, **kwargs)
+        if value is _MISSING:
+            self._stats.incr("misses", retry=True)
+            return default
+        self._stats.incr("hits", retry=True)
+        self._stats.incr("bytes_saved", len(pickle.dumps(value)), retry=True)
+        return value
+
+    def clear(self, retry: bool = False) -> int:
+        self._stats.clear(retry=retry)
+        return super().clear(retry=retry)
+
+    def stats_report(self) -> dict:
+        hits, misses = self._stats.get("hits", 0), self._stats.get("misses", 0)
+        return {
+            "entries": len(self),
+            "volume_bytes": self.volume(),
+            "size_limit_bytes": self.size_limit,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+            "bytes_saved": self._stats.get("bytes_saved", 0),
+        }
+
+
+# %% [markdown]
+# ## Enabling the cache
+#
+# `LocalTaskCache` opens its store the first time a cached task runs locally.
+# `enable_bounded_local_cache` opens it up front with the settings above, in the same directory,
+# so existing entries are kept. Call it before running a workflow locally, for instance before
+# `house_price_predictor_trainer()` in the house price prediction example.
+# %%
+def enable_bounded_local_cache(size_limit: int = DEFAULT_SIZE_LIMIT, directory: str = CACHE_LOCATION) -> BoundedCache:
+    cache = BoundedCache(os.path.expanduser(directory), size_limit=size_limit)
+    LocalTaskCache._cache = cache
+    LocalTaskCache._initialized = True
+    return cache
+
+
+def print_stats(cache: BoundedCache):
+    report = cache.stats_report()
+    print(f"entries:     {report['entries']}")
+    print(f"volume:      {report['volume_bytes'] / 1024**2:.1f} MB of {report['size_limit_bytes'] / 1024**2:.1f} MB")
+    print(f"hits:        {report['hits']}")
+    print(f"misses:      {report['misses']}")
+    print(f"hit ratio:   {report['hit_ratio']:.1%}")
+    print(f"bytes saved: {report['bytes_saved'] / 1024**2:.1f} MB")
+
+
+# %% [markdown]
+# Let's define a slow cached task, and run the workflow twice. The second run, and any later run in another process,
+# is served from the cache.
+# %%
+@task(cache=True, cache_version="1.0")
+def slow_square(n: int) -> int:
+    time.sleep(2)
+    return n * n
+
+
+@workflow
+def local_cache_wf(n: int = 3) -> int:
+    return slow_square(n=n)
+
+
+# %% [markdown]
+# Run the example with `python local_task_cache.py`, and print the statistics of the cache with
+# `python local_task_cache.py stats`.
+# %%
+if __name__ == "__main__":
+    cache = enable_bounded_local_cache()
+    if sys.argv[1:] == ["stats"]:
+        print_stats(cache)
+    else:
+        for run in range(2):
+            start = time.perf_counter()
+            local_cache_wf()
+            print(f"Run {run}: {time.perf_counter() - start:.2f}s")
+        print_stats(cache)
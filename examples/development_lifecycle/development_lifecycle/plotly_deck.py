@@ -0,0 +1,289 @@
+# %% [markdown]
+# (plotly_deck)=
+#
+# # Plotly Decks on a Size Budget
+#
+# ```{eval-rst}
+# .. tags:: UI, Advanced
+# ```
+#
+# The {ref}`decks <decks>` example renders a Plotly figure with `plotly.io.to_html(fig)`. By default, that inlines
+# the whole plotly.js library, which weighs several megabytes, into the HTML of the figure, and a task that renders
+# several figures repeats it for every one of them. Scatter plots with many points add their data on top of that.
+# The deck is uploaded along with the task outputs and downloaded by the UI, so both get slower with every figure.
+#
+# This example renders Plotly figures into a deck with
+#
+# - a single reference to plotly.js per deck, either a `<script>` tag pointing to the CDN or one inlined copy,
+# - downsampling of scatter traces whose points exceed a budget,
+# - a size report per deck, and
+# - a gzip-compressed, standalone copy of the deck that the task can return as an artifact.
+#
+# To begin, import the dependencies.
+# %%
+import gzip
+import typing
+from dataclasses import dataclass
+
+import nebulakit
+import numpy as np
+import plotly.graph_objects as go
+import plotly.io as pio
+from nebulakit import task, workflow
+from nebulakit.types.file import NebulaFile
+from nebulakitplugins.deck.renderer import MarkdownRenderer
+from sklearn.decomposition import PCA
+
+# %% [markdown]
+# ## Downsampling
+#
+# The budget is shared by water-filling: traces that fit within an equal share of it are kept as they are, and what
+# they leave of their share is split among the larger traces. Larger marker traces are sampled down uniformly at
+# random, with a fixed seed, so the rendered deck is the same on every run. Random points would distort a line, so
+# larger line traces keep the minimum and maximum of every bucket of consecutive points instead, which preserves its
+# peaks, along with their first and last points. Every per-point attribute of the trace, such as the coordinates, the
+# hover text or the marker colors, is sampled with the same indices, so the points keep their attributes.
+# %%
+SCATTER_TYPES = {"scatter", "scattergl", "scatter3d", "scatterpolar", "scatterpolargl", "scattergeo", "scattermapbox"}
+COORDINATE_ATTRIBUTES = ("x", "y", "z", "r", "theta", "lat", "lon")
+POINT_ATTRIBUTES = COORDINATE_ATTRIBUTES + ("text", "hovertext", "customdata", "ids")
+MARKER_ATTRIBUTES = ("color", "size", "symbol", "opacity")
+
+
+def _is_per_point(value, n: int) -> bool:
+    return value is not None and not isinstance(value, str) and np.ndim(value) > 0 and len(value) == n
+
+
+def _n_points(trace) -> int:
+    for attribute in COORDINATE_ATTRIBUTES:
+        value = getattr(trace, attribute, None)
+        if value is not None and not isinstance(value, str) and np.ndim(value) > 0:
+            return len(value)
+    return 0
+
+
+def _n_points_in(fig: go.Figure) -> int:
+    return sum(_n_points(trace) for trace in fig.data if trace.type in SCATTER_TYPES)
+
+
+def _budgets(sizes: typing.List[int], max_points: int) -> typing.List[int]:
+    budgets = list(sizes)
+    remaining = max_points
+    order = sorted(range(len(sizes)), key=sizes.__getitem__)
+    for rank, i in enumerate(order):
+        share = max(1, remaining // (len(order) - rank))
+        budgets[i] = min(sizes[i], share)
+        remaining -= budgets[i]
+    return budgets
+
+
+def _is_line(trace) -> bool:
+    # without a mode, plotly draws the traces of more than 20 points as lines
+    return "lines" in (getattr(trace, "mode", None) or "lines")
+
+
+def _line_indices(trace, n: int, budget: int) -> np.ndarray:
+    values = next(
+        (
+            np.asarray(getattr(trace, attribute))
+            for attribute in ("y", "r", "z")
+            if _is_per_point(getattr(trace, attribute, None), n)
+        ),
+        None,
+    )
+    n_buckets = (budget - 2) // 2
+    if values is None or not np.issubdtype(values.dtype, np.number) or n_buckets < 1:
+        return np.unique(np.linspace(0, n - 1, budget).round().astype(int))
+    values = values.astype(float)
+    low, high = np.where(np.isnan(values), np.inf, values), np.where(np.isnan(values), -np.inf, values)
+    edges = np.linspace(0, n, n_buckets + 1).astype(int)
+    indices = [0, n - 1]
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end > start:
+            indices += [start + np.argmin(low[start:end]), start + np.argmax(high[start:end])]
+    return np.unique(indices)
+
+
+def downsample_figure(fig: go.Figure, max_points: int, seed: int = 0) -> typing.Tuple[go.Figure, int, int]:
+    fig = go.Figure(fig)
+    total = _n_points_in(fig)
+    if total <= max_points:
+        return fig, total, total
+
+    rng = np.random.default_rng(seed)
+    traces = [trace for trace in fig.data if trace.type in SCATTER_TYPES]
+    kept = 0
+    for trace, budget in zip(traces, _budgets([_n_points(trace) for trace in traces], max_points)):
+        n = _n_points(trace)
+        if n > budget:
+            if _is_line(trace):
+                indices = _line_indices(trace, n, budget)
+            else:
+                indices = np.sort(rng.choice(n, size=budget, replace=False))
+            updates = {
+                attribute: np.asarray(getattr(trace, attribute))[indices]
+                for attribute in POINT_ATTRIBUTES
+                if _is_per_point(getattr(trace, attribute, None), n)
+            }
+            marker = getattr(trace, "marker", None)
+            if marker is not None:
+                marker_updates = {
+                    attribute: np.asarray(getattr(marker, attribute))[indices]
+                    for attribute in MARKER_ATTRIBUTES
+                    if _is_per_point(getattr(marker, attribute, None), n)
+                }
+                if marker_updates:
+                    updates["marker"] = marker_updates
+            trace.update(updates)
+            n = len(indices)
+        kept += n
+    return fig, total, kept
+
+
+# %% [markdown]
+# ## Plotly deck
+#
+# `PlotlyDeck` wraps a `nebulakit.Deck`. The first figure appended to it carries the plotly.js reference,
+# and every later figure is rendered without it. `plotlyjs="cdn"` adds a `<script>` tag of a few hundred bytes
+# that loads plotly.js from the CDN, and `plotlyjs="inline"` embeds the library once, for viewers without internet
+# access. Every figure is rendered as a `<div>` rather than a full HTML document.
+#
+# `size_report` lists the size of every figure, the size of the deck and its gzip-compressed size,
+# and `report_markdown` renders it as a table that can be appended to the deck itself.
+# `write_artifact` writes a standalone HTML page with the content of the deck, compressed with gzip by default,
+# for tasks that return their plots as a file in addition to, or instead of, the deck.
+# %%
+@dataclass
+class FigureSize:
+    title: str
+    points: int
+    points_rendered: int
+    html_bytes: int
+
+
+class PlotlyDeck:
+    def __init__(self, name: str, plotlyjs: str = "cdn", max_points: typing.Optional[int] = 20_000):
+        if plotlyjs not in ("cdn", "inline"):
+            raise ValueError(f"Unsupported plotlyjs mode {plotlyjs}, expected cdn or inline")
+        self.name = name
+        self.deck = nebulakit.Deck(name)
+        self.figures: typing.List[FigureSize] = []
+        self._plotlyjs = plotlyjs
+        self._max_points = max_points
+        self._asset_included = False
+        self._html: typing.List[str] = []
+
+    def append_html(self, html: str) -> "PlotlyDeck":
+        self._html.append(html)
+        self.deck.append(html)
+        return self
+
+    def append(self, fig: go.Figure) -> "PlotlyDeck":
+        points = points_rendered = _n_points_in(fig)
+        if self._max_points is not None:
+            fig, points, points_rendered = downsample_figure(fig, self._max_points)
+        include_plotlyjs = False if self._asset_included else {"cdn": "cdn", "inline": True}[self._plotlyjs]
+        self._asset_included = True
+        html = pio.to_html(fig, full_html=False, include_plotlyjs=include_plotlyjs)
+        title = fig.layout.title.text or f"figure {len(self.figures)}"
+        self.figures.append(FigureSize(title, points, points_rendered, len(html.encode())))
+        return self.append_html(html)
+
+    def html(self) -> str:
+        return "\n".join(self._html)
+
+    def size_report(self) -> dict:
+        html = self.html().encode()
+        return {
+            "deck": self.name,
+            "figures": self.figures,
+            "html_bytes": len(html),
+            "gzip_bytes": len(gzip.compress(html)),
+        }
+
+    def report_markdown(self) -> str:
+        report = self.size_report()
+        rows = "\n".join(
+            f"| {f.title} | {f.points} | {f.points_rendered} | {f.html_bytes / 1024:.1f} |" for f in report["figures"]
+        )
+        return (
+            f"### Size of the `{report['deck']}` deck\n\n"
+            "| figure | points | points rendered | KiB |\n|---|---|---|---|\n"
+            f"{rows}\n\n"
+            f"Total: {report['html_bytes'] / 1024:.1f} KiB, {report['gzip_bytes'] / 1024:.1f} KiB compressed with gzip."
+        )
+
+    def write_artifact(self, path: str, compress: bool = True) -> str:
+        page = f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>{self.name}</title></head><body>"
+        page += self.html() + "</body></html>"
+        if compress:
+            path = path if path.endswith(".gz") else f"{path}.gz"
+            with gzip.open(path, "wt", encoding="utf-8") as f:
+                f.write(page)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(page)
+        return path
+
+
+# %% [markdown]
+# Let's render the PCA plot of the decks example, along with a scatter plot of a hundred thousand points
+# that is sampled down to the budget, and return a compressed copy of the deck.
+# %%
+@task(disable_deck=False)
+def pca_plot_on_budget(n_points: int = 100_000) -> NebulaFile:
+    import plotly.express as px
+
+    iris_df = px.data.iris()
+    X = iris_df[["sepal_length", "sepal_width", "petal_length", "petal_width"]]
+    components = PCA(n_components=3).fit_transform(X)
+    pca_fig = px.scatter_3d(components, x=0, y=1, z=2, color=iris_df["species"], title="PCA")
+
+    rng = np.random.default_rng(0)
+    noise_fig = go.Figure(go.Scattergl(x=rng.normal(size=n_points), y=rng.normal(size=n_points), mode="markers"))
+    noise_fig.update_layout(title="Noise")
+
+    deck = PlotlyDeck("pca", plotlyjs="cdn", max_points=20_000)
+    deck.append_html(MarkdownRenderer().to_html("### Principal Component Analysis"))
+    deck.append(pca_fig).append(noise_fig)
+    deck.append_html(MarkdownRenderer().to_html(deck.report_markdown()))
+
+    path = deck.write_artifact(f"{nebulakit.current_context().working_directory}/pca_deck.html")
+    return NebulaFile(path)
+
+
+@workflow
+def plotly_deck_wf() -> NebulaFile:
+    return pca_plot_on_budget()
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark renders `n_figures` scatter plots of `n_points` points each, with `plotly.io.to_html` as in the decks
+# example, and with `PlotlyDeck` in both modes, and compares the size of the resulting decks.
+# %%
+def benchmark(n_figures: int = 5, n_points: int = 100_000, max_points: int = 20_000):
+    rng = np.random.default_rng(0)
+    figures = [
+        go.Figure(go.Scattergl(x=rng.normal(size=n_points), y=rng.normal(size=n_points), mode="markers"))
+        for _ in range(n_figures)
+    ]
+    baseline = "\n".join(pio.to_html(fig) for fig in figures).encode()
+    print(f"{'rendering':>24} {'MiB':>8} {'gzip MiB':>10}")
+    print(f"{'plotly.io.to_html':>24} {len(baseline) / 1024**2:>8.2f} {len(gzip.compress(baseline)) / 1024**2:>10.2f}")
+    for plotlyjs in ("inline", "cdn"):
+        deck = PlotlyDeck(f"benchmark-{plotlyjs}", plotlyjs=plotlyjs, max_points=max_points)
+        for fig in figures:
+            deck.append(fig)
+        report = deck.size_report()
+        label = f"PlotlyDeck, {plotlyjs}"
+        print(f"{label:>24} {report['html_bytes'] / 1024**2:>8.2f} {report['gzip_bytes'] / 1024**2:>10.2f}")
+
+
+# %% [markdown]
+# You can run the workflow and the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    print(f"Deck artifact: {plotly_deck_wf()}")
+    benchmark()
@@ -0,0 +1,280 @@
+# %% [markdown]
+# (remote_entity_cache)=
+#
+# # Caching Remote Entities
+#
+# ```{eval-rst}
+# .. tags:: Advanced
+# ```
+#
+# The {doc}`remote task <remote_task>`, {doc}`remote workflow <remote_workflow>` and
+# {doc}`remote launch plan <remote_launchplan>` examples fetch an entity with `NebulaRemote` before executing it.
+# A script that launches hundreds of executions of the same entities repeats these fetches, and every one of them is
+# a round trip to FlyteAdmin, which can take longer than creating the execution itself.
+#
+# This example wraps a `NebulaRemote` with a client-side cache of fetched entities, keyed by
+# `(project, domain, name, version)`:
+#
+# - a registered version never changes, so entities fetched by version are cached for good, and can also be
+#   cached on disk to be shared between scripts,
+# - fetches without a version return the latest version, which changes when a new version is registered,
+#   so they are cached for `latest_ttl` seconds only, and
+# - concurrent fetches of the same entity are deduplicated, so only one of them calls FlyteAdmin.
+#
+# To begin, import the dependencies.
+# %%
+import hashlib
+import os
+import pickle
+import threading
+import time
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+
+# %% [markdown]
+# ## Cache keys
+#
+# A key with `version=None` stands for the latest version. Once a latest lookup returns, its entity is also cached under
+# the key of the version it resolved to, so later fetches of that version are served from the cache.
+# %%
+TASK = "task"
+WORKFLOW = "workflow"
+LAUNCH_PLAN = "launch_plan"
+
+
+@dataclass(frozen=True)
+class EntityKey:
+    resource_type: str
+    project: str
+    domain: str
+    name: str
+    version: typing.Optional[str] = None
+
+    @property
+    def is_pinned(self) -> bool:
+        return self.version is not None
+
+    def pinned(self, version: str) -> "EntityKey":
+        return EntityKey(self.resource_type, self.project, self.domain, self.name, version)
+
+
+# %% [markdown]
+# ## Entity cache
+#
+# `EntityCache.get` returns the cached entity for a key or calls `fetch` to get it. The first caller of a missing key
+# registers a future for it, and every concurrent caller of the same key waits on that future instead of fetching
+# the entity again. A failed fetch is not cached, and its error is raised to every waiting caller.
+#
+# With `cache_dir`, pinned entities are also pickled to disk, written to a temporary file and moved into place,
+# so that concurrent scripts never read a partial file.
+# %%
+class EntityCache:
+    def __init__(
+        self,
+        latest_ttl: float = 60.0,
+        cache_dir: typing.Optional[str] = None,
+        clock: typing.Callable[[], float] = time.monotonic,
+    ):
+        self._latest_ttl = latest_ttl
+        self._cache_dir = cache_dir
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entities: typing.Dict[EntityKey, typing.Tuple[typing.Any, float]] = {}
+        self._in_flight: typing.Dict[EntityKey, Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: EntityKey) -> str:
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        return os.path.join(self._cache_dir, key.resource_type, digest)
+
+    def _load(self, key: EntityKey) -> typing.Any:
+        if self._cache_dir is None or not key.is_pinned:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _store(self, key: EntityKey, entity: typing.Any):
+        if self._cache_dir is None:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entity, f)
+        os.replace(tmp_path, path)
+
+    def _cached(self, key: EntityKey) -> typing.Any:
+        cached = self._entities.get(key)
+        if cached is None:
+            return None
+        entity, expires_at = cached
+        if expires_at < self._clock():
+            del self._entities[key]
+            return None
+        return entity
+
+    def _put(self, key: EntityKey, entity: typing.Any):
+        expires_at = float("inf") if key.is_pinned else self._clock() + self._latest_ttl
+        self._entities[key] = (entity, expires_at)
+
+    def get(self, key: EntityKey, fetch: typing.Callable[[], typing.Any]) -> typing.Any:
+        with self._lock:
+            entity = self._cached(key)
+            if entity is not None:
+                self.hits += 1
+                return entity
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = self._in_flight[key] = Future()
+            else:
+                self.hits += 1
+        if not owner:
+            return future.result()
+
+        try:
+            entity = self._load(key)
+            if entity is None:
+                entity = fetch()
+                pinned_key = key if key.is_pinned else key.pinned(entity.id.version)
+                self._store(pinned_key, entity)
+            with self._lock:
+                self._put(key, entity)
+                if not key.is_pinned:
+                    self._put(key.pinned(entity.id.version), entity)
+            future.set_result(entity)
+            return entity
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def invalidate_latest(self):
+        with self._lock:
+            for key in [key for key in self._entities if not key.is_pinned]:
+                del self._entities[key]
+
+
+# %% [markdown]
+# ## Cached remote
+#
+# `CachedRemote` has the same `fetch_task`, `fetch_workflow` and `fetch_launch_plan` methods as `NebulaRemote`,
+# and passes every other attribute, such as `execute`, through to the remote it wraps.
+# Registering an entity invalidates the cached latest versions, since the registered version may now be the latest.
+#
+# ```python
+# remote = CachedRemote(
+#     NebulaRemote(
+#         config=Config.for_endpoint(endpoint="nebula.example.net"),
+#         default_project="nebulasnacks",
+#         default_domain="development",
+#     ),
+#     cache=EntityCache(latest_ttl=300, cache_dir=os.path.expanduser("~/.cache/nebula-entities")),
+# )
+#
+# for inputs in batch:
+#     nebula_lp = remote.fetch_launch_plan(name="workflows.example.wf", version="v1")
+#     remote.execute(nebula_lp, inputs=inputs)
+# ```
+# %%
+class CachedRemote:
+    def __init__(self, remote, cache: typing.Optional[EntityCache] = None):
+        self._remote = remote
+        self.cache = cache if cache is not None else EntityCache()
+
+    def __getattr__(self, name: str) -> typing.Any:
+        attribute = getattr(self._remote, name)
+        if name.startswith("register"):
+
+            def register(*args, **kwargs):
+                try:
+                    return attribute(*args, **kwargs)
+                finally:
+                    self.cache.invalidate_latest()
+
+            return register
+        return attribute
+
+    def _key(self, resource_type: str, project, domain, name, version) -> EntityKey:
+        return EntityKey(
+            resource_type,
+            project or self._remote.default_project,
+            domain or self._remote.default_domain,
+            name,
+            version,
+        )
+
+    def fetch_task(self, project=None, domain=None, name=None, version=None):
+        key = self._key(TASK, project, domain, name, version)
+        return self.cache.get(key, lambda: self._remote.fetch_task(key.project, key.domain, name, version))
+
+    def fetch_workflow(self, project=None, domain=None, name=None, version=None):
+        key = self._key(WORKFLOW, project, domain, name, version)
+        return self.cache.get(key, lambda: self._remote.fetch_workflow(key.project, key.domain, name, version))
+
+    def fetch_launch_plan(self, project=None, domain=None, name=None, version=None):
+        key = self._key(LAUNCH_PLAN, project, domain, name, version)
+        return self.cache.get(key, lambda: self._remote.fetch_launch_plan(key.project, key.domain, name, version))
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark stands in for a batch launcher: `n_threads` threads fetch the launch plans of `n_entities` workflows
+# `n_fetches` times in total, half of them by version and half of them latest. `SlowRemote` takes `latency` seconds
+# per fetch, like a round trip to FlyteAdmin, and counts the fetches that reach it.
+# %%
+@dataclass(frozen=True)
+class _Identifier:
+    project: str
+    domain: str
+    name: str
+    version: str
+
+
+@dataclass(frozen=True)
+class _Entity:
+    id: _Identifier
+
+
+class SlowRemote:
+    default_project = "nebulasnacks"
+    default_domain = "development"
+
+    def __init__(self, latency: float = 0.05):
+        self._latency = latency
+        self._lock = threading.Lock()
+        self.fetches = 0
+
+    def fetch_launch_plan(self, project=None, domain=None, name=None, version=None) -> _Entity:
+        with self._lock:
+            self.fetches += 1
+        time.sleep(self._latency)
+        return _Entity(_Identifier(project, domain, name, version or "v2"))
+
+
+def benchmark(n_entities: int = 10, n_fetches: int = 1000, n_threads: int = 32, latency: float = 0.05):
+    requests = [(f"workflows.example.wf_{i % n_entities}", "v1" if i % 2 else None) for i in range(n_fetches)]
+    print(f"{'remote':>14} {'admin fetches':>14} {'seconds':>8}")
+    for label in ("NebulaRemote", "CachedRemote"):
+        slow_remote = SlowRemote(latency)
+        remote = slow_remote if label == "NebulaRemote" else CachedRemote(slow_remote)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(lambda request: remote.fetch_launch_plan(name=request[0], version=request[1]), requests))
+        print(f"{label:>14} {slow_remote.fetches:>14} {time.perf_counter() - start:>8.2f}")
+
+
+# %% [markdown]
+# You can run the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    benchmark()
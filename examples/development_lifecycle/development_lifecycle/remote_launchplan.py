@@ -67,3 +67,7 @@
 # )
 # ```
 #
+# :::{note}
+# Scripts that launch many executions of the same entities can cache the fetched entities with
+# the `CachedRemote` wrapper of {ref}`remote_entity_cache`.
+# :::
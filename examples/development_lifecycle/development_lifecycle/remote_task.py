@@ -81,3 +81,7 @@
 # output_keys = execution.outputs.keys()
 # ```
 #
+# :::{note}
+# Scripts that launch many executions of the same entities can cache the fetched entities with
+# the `CachedRemote` wrapper of {ref}`remote_entity_cache`.
+# :::
@@ -165,6 +165,12 @@ def wf_1(a: int, b: str):  # noqa: F811
 # %% [markdown]
 # Note how the output of task `foo` is annotated with an object of type `HashMethod`. Essentially, it represents a function that produces a hash that is used as part of the cache key calculation in calling the task `bar`.
 #
+# :::{note}
+# The string representation of a `Series` is truncated by pandas, so `hash_pandas_dataframe` only looks at the first and last rows.
+# The {ref}`content hashing <content_hashing>` example provides hash functions over the full content of dataframes,
+# arrays, tensors, files and directories that can be passed to `HashMethod` directly.
+# :::
+#
 # ### How Does Caching of Offloaded Objects Work?
 #
 # Recall how task input values are taken into account to derive a cache key.
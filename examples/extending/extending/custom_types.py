@@ -124,6 +124,11 @@ class MyDatasetTransformer(TypeTransformer[MyDataset]):
 
 
 # %% [markdown]
+# :::{note}
+# This transformer uploads and downloads the whole directory every time. For datasets with many files,
+# see {ref}`multipart_transport`, which uploads only new content and downloads files as they are accessed.
+# :::
+#
 # Before we can use MyDataset in our tasks, we need to let Nebulakit know that `MyDataset` should be considered as a valid type.
 # This is done using {py:class}`~nebulakit:nebulakit.extend.TypeEngine`'s `register` method.
 # %%
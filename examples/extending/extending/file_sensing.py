@@ -0,0 +1,245 @@
+# %% [markdown]
+# (file_sensing)=
+#
+# # Sensing Files with Backoff and Events
+#
+# ```{eval-rst}
+# .. tags:: Extensibility, Advanced
+# ```
+#
+# The `WaitForObjectStoreFile` sensor of the {ref}`user container <user_container>` example checks whether its file
+# exists at a fixed interval. Every check is a request to the object store, and a workflow that runs many sensors
+# in parallel sends a steady stream of them for as long as the files are missing, although most files land long after
+# the sensor starts.
+#
+# This example implements the waiting loop of the sensor with
+#
+# - exponential backoff, so a sensor checks often at first and less often as it keeps waiting,
+# - jitter, so sensors started together do not check in lockstep,
+# - sub-second intervals, and
+# - an `inotify` mode for local and mounted filesystems, which waits for the kernel to report that the file was created
+#   instead of checking for it.
+#
+# To begin, import the dependencies.
+# %%
+import ctypes
+import os
+import random
+import select
+import statistics
+import struct
+import tempfile
+import threading
+import time
+import typing
+
+
+# %% [markdown]
+# ## Backoff
+#
+# The interval starts at `poll_interval` seconds and is multiplied by `backoff` after every check, up to
+# `max_poll_interval` seconds. Each interval is then scaled by a random factor between `1 - jitter` and `1 + jitter`.
+# With `backoff=1` and `jitter=0`, the sensor checks at a fixed interval.
+# %%
+def backoff_intervals(
+    poll_interval: float,
+    max_poll_interval: typing.Optional[float] = None,
+    backoff: float = 1.0,
+    jitter: float = 0.0,
+    rng: typing.Optional[random.Random] = None,
+) -> typing.Iterator[float]:
+    rng = rng or random.Random()
+    max_poll_interval = max(poll_interval, max_poll_interval or poll_interval)
+    interval = poll_interval
+    while True:
+        yield interval * rng.uniform(1 - jitter, 1 + jitter)
+        interval = min(interval * backoff, max_poll_interval)
+
+
+# %% [markdown]
+# ## File events
+#
+# On Linux, `inotify` reports the files that are created in, or moved into, a watched directory. The watcher below calls
+# the `inotify` functions of the C library through `ctypes`, so it needs no extra dependency, and is only available
+# where the C library has them.
+#
+# Changes made by other hosts to a network or FUSE mount are not always reported, so in `inotify` mode the sensor still
+# checks for the file every time the backoff interval passes without an event: the interval only bounds how late the
+# sensor notices the file when events are missing.
+#
+# Every event names the file it is about, so the watcher only returns early for events about the file it waits for,
+# and keeps waiting through the events of other files in the same directory. Many sensors can then watch one directory
+# without checking for their files every time any file in it is created. If the kernel drops events because too many
+# are queued, the watcher returns as well, since the event of the file may be among them.
+# %%
+IN_CREATE = 0x100
+IN_MOVED_TO = 0x80
+IN_Q_OVERFLOW = 0x4000
+# struct inotify_event: int wd, uint32_t mask, uint32_t cookie, uint32_t len, followed by len bytes of the name
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class DirectoryWatcher:
+    def __init__(self, directory: str, name: str):
+        self._name = os.fsencode(name)
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self._fd, os.fsencode(directory), IN_CREATE | IN_MOVED_TO) < 0:
+            os.close(self._fd)
+            raise OSError(ctypes.get_errno(), f"Cannot watch {directory}")
+
+    def _names_file(self, events: bytes) -> bool:
+        offset = 0
+        while offset < len(events):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(events, offset)
+            offset += INOTIFY_EVENT.size
+            # the name is padded with null bytes
+            if mask & IN_Q_OVERFLOW or events[offset : offset + length].rstrip(b"\0") == self._name:
+                return True
+            offset += length
+        return False
+
+    def wait(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            readable, _, _ = select.select([self._fd], [], [], max(0.0, deadline - time.monotonic()))
+            if not readable:
+                return False
+            found = False
+            while True:
+                try:
+                    found = self._names_file(os.read(self._fd, 64 * 1024)) or found
+                except BlockingIOError:
+                    break
+            if found:
+                return True
+
+    def close(self):
+        os.close(self._fd)
+
+
+def _local_directory(path: str) -> typing.Optional[str]:
+    if "://" in path and not path.startswith("file://"):
+        return None
+    directory = os.path.dirname(os.path.abspath(path.replace("file://", "", 1)))
+    return directory if os.path.isdir(directory) else None
+
+
+# %% [markdown]
+# ## Waiting loop
+#
+# `wait_for_file` checks for the file with `exists` until it is there. In `poll` mode it sleeps for each backoff
+# interval between checks; in `inotify` mode it waits for an event about the file, for at most the backoff
+# interval. Paths that are not on a local or mounted filesystem, and systems without `inotify`, fall back to polling.
+# %%
+POLL = "poll"
+INOTIFY = "inotify"
+
+
+def wait_for_file(
+    path: str,
+    exists: typing.Callable[[str], bool],
+    poll_interval: float,
+    max_poll_interval: typing.Optional[float] = None,
+    backoff: float = 1.0,
+    jitter: float = 0.0,
+    mode: str = POLL,
+    log: typing.Optional[typing.Callable[[str], None]] = None,
+) -> str:
+    if mode not in (POLL, INOTIFY):
+        raise ValueError(f"Unsupported sensing mode {mode}, expected {POLL} or {INOTIFY}")
+    log = log or (lambda message: None)
+
+    watcher = None
+    if mode == INOTIFY:
+        directory = _local_directory(path)
+        try:
+            watcher = DirectoryWatcher(directory, os.path.basename(path)) if directory else None
+        except (OSError, AttributeError) as e:
+            log(f"inotify is not available for {path}, falling back to polling: {e}")
+        if watcher is None and directory is None:
+            log(f"{path} is not in a local directory, falling back to polling")
+
+    try:
+        # the watch is in place before the first check, so a file created in between is not missed
+        for interval in backoff_intervals(poll_interval, max_poll_interval, backoff, jitter):
+            if exists(path):
+                return path
+            log(f"file in path {path} does not exist, checking again in at most {interval:.3f}s")
+            if watcher is not None:
+                watcher.wait(interval)
+            else:
+                time.sleep(interval)
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark runs `n_sensors` sensors in parallel for every strategy, each waiting for its own file in a temporary
+# directory, and creates every file after a random delay of up to `max_delay` seconds. It reports the mean and
+# worst detection latency, the time between the creation of a file and its sensor returning, and the mean number of
+# existence checks per sensor, which are object store requests for a sensor on a bucket.
+# %%
+STRATEGIES = {
+    "fixed 1s": dict(poll_interval=1.0),
+    "fixed 0.1s": dict(poll_interval=0.1),
+    "backoff 0.1s-2s": dict(poll_interval=0.1, max_poll_interval=2.0, backoff=1.5, jitter=0.2),
+    "inotify": dict(poll_interval=1.0, max_poll_interval=30.0, backoff=2.0, mode=INOTIFY),
+}
+
+
+def _run_strategy(
+    directory: str, name: str, kwargs: dict, n_sensors: int, max_delay: float, rng: random.Random
+) -> typing.Tuple[typing.List[float], typing.List[int]]:
+    latencies, checks = [0.0] * n_sensors, [0] * n_sensors
+
+    def sense(i: int, path: str, created_at: typing.List[float]):
+        def exists(p: str) -> bool:
+            checks[i] += 1
+            return os.path.exists(p)
+
+        wait_for_file(path, exists, **kwargs)
+        latencies[i] = time.monotonic() - created_at[0]
+
+    threads = []
+    for i in range(n_sensors):
+        path = os.path.join(directory, f"{name.replace(' ', '_')}-{i}")
+        created_at = [0.0]
+        sensor = threading.Thread(target=sense, args=(i, path, created_at))
+        creator = threading.Timer(rng.uniform(0, max_delay), _create, args=(path, created_at))
+        sensor.start()
+        creator.start()
+        threads += [sensor, creator]
+    for thread in threads:
+        thread.join()
+    return latencies, checks
+
+
+def _create(path: str, created_at: typing.List[float]):
+    created_at[0] = time.monotonic()
+    with open(path, "w") as f:
+        f.write("Hello World!")
+
+
+def benchmark(n_sensors: int = 20, max_delay: float = 10.0, seed: int = 0):
+    rng = random.Random(seed)
+    print(f"{'strategy':>16} {'mean latency s':>15} {'max latency s':>14} {'checks per sensor':>18}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, kwargs in STRATEGIES.items():
+            latencies, checks = _run_strategy(directory, name, kwargs, n_sensors, max_delay, rng)
+            print(
+                f"{name:>16} {statistics.fmean(latencies):>15.3f} {max(latencies):>14.3f} "
+                f"{statistics.fmean(checks):>18.1f}"
+            )
+
+
+# %% [markdown]
+# You can run the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,386 @@
+# %% [markdown]
+# (multipart_transport)=
+#
+# # Lazy, Content-Addressed Multipart Types
+#
+# ```{eval-rst}
+# .. tags:: Extensibility, Advanced
+# ```
+#
+# The `MyDatasetTransformer` of the {ref}`custom types <advanced_custom_types>` example uploads the whole base directory
+# of a dataset on every `to_literal`, and downloads the whole directory on every `to_python_value`, before the task
+# has read a single file. With tens of thousands of files, a task that reads a few of them or changes a few of them
+# spends most of its time moving files it never uses.
+#
+# This example defines a reusable base transformer for multipart types, `MultipartTransformer`, that
+#
+# - stores every file once, under the SHA-256 of its content, and uploads files in parallel, skipping files that are
+#   already stored,
+# - writes a manifest that maps the relative path of every file to its content hash, and
+# - gives the task a lazy view of the files, which downloads a file the first time it is accessed,
+#   and prefetches the files that follow it.
+#
+# Files that a task passes through without reading are never downloaded, and are not uploaded again.
+#
+# To begin, import the dependencies.
+# %%
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+from nebulakit import Blob, BlobMetadata, BlobType, Literal, LiteralType, NebulaContext, Scalar, task, workflow
+from nebulakit.core.context_manager import NebulaContextManager
+from nebulakit.extend import TypeEngine, TypeTransformer
+
+from .custom_types import MyDataset, MyDatasetTransformer
+
+# %% [markdown]
+# ## Content-addressed store
+#
+# Objects are stored under `<store>/<first two hex digits>/<sha256>`, so the store can be shared by every execution
+# that writes to it. The raw output prefix differs between task attempts, so the default store is the `cas` directory
+# at the root of its bucket, such as `s3://my-bucket/cas`, which every task and execution share. Pass `store` to the
+# transformer to use another shared prefix. Locally, the default store is a directory in the temporary directory.
+# %%
+MANIFEST = "manifest.json"
+
+
+def default_store(raw_output_prefix: str) -> str:
+    if "://" not in raw_output_prefix or raw_output_prefix.startswith("file://"):
+        return os.path.join(tempfile.gettempdir(), "nebula-cas")
+    protocol, path = raw_output_prefix.split("://", 1)
+    return f"{protocol}://{path.split('/', 1)[0]}/cas"
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(partial(f.read, 1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def object_uri(store: str, digest: str) -> str:
+    return f"{store.rstrip('/')}/{digest[:2]}/{digest}"
+
+
+# %% [markdown]
+# ## Lazy files
+#
+# `LazyFiles` is a sequence of local paths, one per file in the manifest, in the order of their relative paths.
+# Accessing a path downloads the file, if it is not downloaded yet, and schedules the download of the next `prefetch`
+# files on a thread pool, so iterating over the files overlaps the downloads with the work on each file.
+# Files are downloaded to a temporary path and moved into place, so a file at its local path is always complete.
+#
+# `new_file` returns the local path of a file that the task writes, and adds it to the sequence if it is a new file.
+# The file is never downloaded after that, and a download of it that is still running is discarded, so a prefetch
+# cannot overwrite what the task wrote.
+# %%
+class LazyFiles(typing.Sequence[str]):
+    def __init__(
+        self, fs, store: str, manifest: typing.Dict[str, str], local_dir: str, prefetch: int = 8, max_workers: int = 16
+    ):
+        self.store = store
+        self.manifest = manifest
+        self.local_dir = local_dir
+        self._fs = fs
+        self._names = sorted(manifest)
+        self._known = set(self._names)
+        self._written: typing.Set[str] = set()
+        self._prefetch = prefetch
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._downloads: typing.Dict[int, Future] = {}
+        self._partial_dir = f"{local_dir.rstrip(os.sep)}.partial"
+        os.makedirs(self._partial_dir, exist_ok=True)
+
+    def _local_path(self, i: int) -> str:
+        return os.path.join(self.local_dir, self._names[i])
+
+    def _download(self, i: int) -> str:
+        local_path = self._local_path(i)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        tmp_path = os.path.join(self._partial_dir, f"{i}")
+        self._fs.get_file(object_uri(self.store, self.manifest[self._names[i]]), tmp_path)
+        with self._lock:
+            if self._names[i] in self._written:
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, local_path)
+        return local_path
+
+    def _schedule(self, i: int) -> Future:
+        with self._lock:
+            future = self._downloads.get(i)
+            if future is None:
+                if self._names[i] in self._written:
+                    future = Future()
+                    future.set_result(self._local_path(i))
+                else:
+                    future = self._pool.submit(self._download, i)
+                self._downloads[i] = future
+            return future
+
+    def new_file(self, name: str) -> str:
+        with self._lock:
+            self._written.add(name)
+            if name not in self._known:
+                self._known.add(name)
+                self._names.append(name)
+        local_path = os.path.join(self.local_dir, name)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        return local_path
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = range(len(self))[i]
+        future = self._schedule(i)
+        for j in range(i + 1, min(i + 1 + self._prefetch, len(self))):
+            self._schedule(j)
+        return future.result()
+
+    def download_all(self) -> typing.List[str]:
+        return [future.result() for future in [self._schedule(i) for i in range(len(self))]]
+
+
+# %% [markdown]
+# ## Base transformer
+#
+# `MultipartTransformer` implements `to_literal` and `to_python_value` for any type whose values are a directory
+# of files. Subclasses tell it where the files of a value are, with `base_dir`, and how to build a value from its
+# lazy files, with `from_files`.
+#
+# `to_literal` starts from the manifest of the lazy files of the value, if it has any, so files that were never
+# downloaded keep their content hash without being read. Every file in the base directory, whether it was downloaded,
+# changed or added by the task, is then hashed and uploaded in parallel, unless the store already has an object with
+# its hash. Lazy files from a different store are downloaded first, since their objects are not in this store.
+# The blob of the literal points to the directory that holds the manifest, and its format tells the transformer that
+# it is a manifest rather than the files themselves.
+# %%
+T = typing.TypeVar("T")
+
+
+class MultipartTransformer(TypeTransformer[T]):
+    _TYPE_INFO = BlobType(format="sha256-manifest", dimensionality=BlobType.BlobDimensionality.MULTIPART)
+
+    def __init__(
+        self, name: str, t: typing.Type[T], store: typing.Optional[str] = None, max_workers: int = 16, prefetch: int = 8
+    ):
+        super().__init__(name=name, t=t)
+        self._store = store
+        self._max_workers = max_workers
+        self._prefetch = prefetch
+        self._lock = threading.Lock()
+        self.uploaded = 0
+        self.skipped = 0
+
+    def base_dir(self, python_val: T) -> str:
+        raise NotImplementedError
+
+    def lazy_files(self, python_val: T) -> typing.Optional[LazyFiles]:
+        return None
+
+    def from_files(self, files: LazyFiles, expected_python_type: typing.Type[T]) -> T:
+        raise NotImplementedError
+
+    def get_literal_type(self, t: typing.Type[T]) -> LiteralType:
+        return LiteralType(blob=self._TYPE_INFO)
+
+    def _upload(self, fs, store: str, local_path: str) -> str:
+        digest = sha256_file(local_path)
+        uri = object_uri(store, digest)
+        if fs.exists(uri):
+            with self._lock:
+                self.skipped += 1
+            return digest
+        fs.makedirs(uri.rsplit("/", 1)[0], exist_ok=True)
+        fs.put_file(local_path, uri)
+        with self._lock:
+            self.uploaded += 1
+        return digest
+
+    def to_literal(
+        self, ctx: NebulaContext, python_val: T, python_type: typing.Type[T], expected: LiteralType
+    ) -> Literal:
+        store = self._store or default_store(ctx.file_access.raw_output_prefix)
+        fs = ctx.file_access.get_filesystem_for_path(store)
+
+        lazy = self.lazy_files(python_val)
+        manifest = {}
+        if lazy is not None and lazy.store == store:
+            manifest.update(lazy.manifest)
+        elif lazy is not None:
+            lazy.download_all()
+        base_dir = self.base_dir(python_val)
+        local_files = {}
+        for root, _, names in os.walk(base_dir):
+            for name in names:
+                relative_path = os.path.relpath(os.path.join(root, name), base_dir).replace(os.sep, "/")
+                local_files[relative_path] = os.path.join(root, name)
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+            digests = pool.map(lambda p: self._upload(fs, store, p), local_files.values())
+            manifest.update(zip(local_files, digests))
+
+        remote_dir = ctx.file_access.get_random_remote_directory()
+        fs = ctx.file_access.get_filesystem_for_path(remote_dir)
+        fs.makedirs(remote_dir, exist_ok=True)
+        fs.pipe_file(f"{remote_dir.rstrip('/')}/{MANIFEST}", json.dumps({"store": store, "files": manifest}).encode())
+        return Literal(scalar=Scalar(blob=Blob(uri=remote_dir, metadata=BlobMetadata(type=self._TYPE_INFO))))
+
+    def to_python_value(self, ctx: NebulaContext, lv: Literal, expected_python_type: typing.Type[T]) -> T:
+        uri = lv.scalar.blob.uri
+        fs = ctx.file_access.get_filesystem_for_path(uri)
+        document = json.loads(fs.cat_file(f"{uri.rstrip('/')}/{MANIFEST}"))
+        files = LazyFiles(
+            ctx.file_access.get_filesystem_for_path(document["store"]),
+            document["store"],
+            document["files"],
+            ctx.file_access.get_random_local_directory(),
+            prefetch=self._prefetch,
+            max_workers=self._max_workers,
+        )
+        return self.from_files(files, expected_python_type)
+
+
+# %% [markdown]
+# ## A lazy `MyDataset`
+#
+# `LazyMyDataset` is a `MyDataset` whose `files` are the lazy files it was created from. Files are written with
+# `new_file`, as before, which adds them to the lazy files. Its transformer only has to implement the three hooks.
+# %%
+class LazyMyDataset(MyDataset):
+    def __init__(self, base_dir: str = None, lazy_files: typing.Optional[LazyFiles] = None):
+        if lazy_files is None:
+            super().__init__(base_dir)
+        else:
+            self._base_dir = lazy_files.local_dir
+            self._files = lazy_files
+        self._lazy_files = lazy_files
+
+    def new_file(self, name: str) -> str:
+        if self._lazy_files is None:
+            return super().new_file(name)
+        return self._lazy_files.new_file(name)
+
+
+class LazyMyDatasetTransformer(MultipartTransformer[LazyMyDataset]):
+    def __init__(self, store: typing.Optional[str] = None):
+        super().__init__(name="lazy-mydataset-transform", t=LazyMyDataset, store=store)
+
+    def base_dir(self, python_val: LazyMyDataset) -> str:
+        return python_val.base_dir
+
+    def lazy_files(self, python_val: LazyMyDataset) -> typing.Optional[LazyFiles]:
+        return python_val._lazy_files
+
+    def from_files(self, files: LazyFiles, expected_python_type: typing.Type[LazyMyDataset]) -> LazyMyDataset:
+        return LazyMyDataset(lazy_files=files)
+
+
+TypeEngine.register(LazyMyDatasetTransformer())
+
+
+# %% [markdown]
+# The tasks below generate a dataset, change one file of it without reading the others, and read a few of its files.
+# Only the changed file is uploaded by the second task, and the third task only downloads the files it reads,
+# and the files that it prefetches.
+# %%
+@task
+def generate_lazy(n_files: int) -> LazyMyDataset:
+    d = LazyMyDataset()
+    for i in range(n_files):
+        with open(d.new_file(f"x{i:05d}"), "w") as f:
+            f.write(f"Contents of file{i}")
+    return d
+
+
+@task
+def update_first(d: LazyMyDataset) -> LazyMyDataset:
+    with open(d.new_file("x00000"), "w") as f:
+        f.write("Updated contents")
+    return d
+
+
+@task
+def consume_first(d: LazyMyDataset, n: int) -> str:
+    s = ""
+    for f in d.files[:n]:
+        with open(f) as fp:
+            s += fp.read()
+            s += "\n"
+    return s
+
+
+@workflow
+def lazy_wf(n_files: int = 100, n: int = 3) -> str:
+    return consume_first(d=update_first(d=generate_lazy(n_files=n_files)), n=n)
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark round-trips a dataset of `n_files` files of `file_size` bytes with `MyDatasetTransformer` and with
+# `LazyMyDatasetTransformer`: it writes the dataset, reads it back and reads `n_read` of its files, then writes it again
+# with one file changed. The last column counts the files that `LazyMyDatasetTransformer` uploaded in total, to a new
+# store, so files from earlier runs are not skipped.
+# %%
+def benchmark(n_files: int = 10_000, file_size: int = 16 * 1024, n_read: int = 10):
+    ctx = NebulaContextManager.current_context()
+    base_dir, store = tempfile.mkdtemp(), tempfile.mkdtemp()
+    for i in range(n_files):
+        with open(os.path.join(base_dir, f"x{i:05d}"), "wb") as f:
+            f.write(os.urandom(file_size))
+
+    def read(files):
+        for path in files[:n_read]:
+            with open(path, "rb") as f:
+                f.read()
+
+    print(f"{'transformer':>26} {'write s':>8} {'read s':>8} {'rewrite s':>10} {'uploads':>8}")
+    for transformer, dataset_type in (
+        (MyDatasetTransformer(), MyDataset),
+        (LazyMyDatasetTransformer(store=store), LazyMyDataset),
+    ):
+        literal_type = transformer.get_literal_type(dataset_type)
+
+        start = time.perf_counter()
+        lv = transformer.to_literal(ctx, dataset_type(base_dir=base_dir), dataset_type, literal_type)
+        write_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        dataset = transformer.to_python_value(ctx, lv, dataset_type)
+        read(dataset.files)
+        read_seconds = time.perf_counter() - start
+
+        with open(dataset.new_file("x00000"), "wb") as f:
+            f.write(os.urandom(file_size))
+        start = time.perf_counter()
+        transformer.to_literal(ctx, dataset, dataset_type, literal_type)
+        rewrite_seconds = time.perf_counter() - start
+        uploads = getattr(transformer, "uploaded", "-")
+        print(
+            f"{type(transformer).__name__:>26} {write_seconds:>8.2f} {read_seconds:>8.2f} {rewrite_seconds:>10.2f} "
+            f"{uploads:>8}"
+        )
+    shutil.rmtree(base_dir)
+    shutil.rmtree(store)
+
+
+# %% [markdown]
+# You can run the workflow and the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    print(lazy_wf())
+    benchmark()
@@ -34,17 +34,23 @@
 # %%
 import typing
 from datetime import timedelta
-from time import sleep
 
 from nebulakit import TaskMetadata, task, workflow
 from nebulakit.extend import Interface, PythonTask, context_manager
 
+from .file_sensing import POLL, wait_for_file
+
 
 # %% [markdown]
 # ### Plugin Structure
 #
 # As illustrated above, to achieve this structure we need to create a class named `WaitForObjectStoreFile`, which
 # derives from {py:class}`nebulakit.PythonFunctionTask` as follows.
+#
+# The sensor checks for the file every `poll_interval`. With `backoff`, the interval grows by that factor after every
+# check, up to `max_poll_interval`, and `jitter` spreads the checks of sensors that start together.
+# With `mode="inotify"`, a sensor on a local or mounted filesystem waits for the file to be created instead.
+# The waiting loop is explained in {ref}`file_sensing`.
 # %%
 class WaitForObjectStoreFile(PythonTask):
     """
@@ -58,6 +64,10 @@ class WaitForObjectStoreFile(PythonTask):
         self,
         name: str,
         poll_interval: timedelta = timedelta(seconds=10),
+        max_poll_interval: typing.Optional[timedelta] = None,
+        backoff: float = 1.0,
+        jitter: float = 0.0,
+        mode: str = POLL,
         **kwargs,
     ):
         super(WaitForObjectStoreFile, self).__init__(
@@ -68,19 +78,29 @@ class WaitForObjectStoreFile(PythonTask):
             **kwargs,
         )
         self._poll_interval = poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._backoff = backoff
+        self._jitter = jitter
+        self._mode = mode
 
     def execute(self, **kwargs) -> typing.Any:
         # No need to check for existence, as that is guaranteed.
         path = kwargs[self._VAR_NAME]
         ctx = context_manager.NebulaContext.current_context()
         user_context = ctx.user_space_params
-        while True:
-            user_context.logging.info(f"Sensing file in path {path}...")
-            if ctx.file_access.exists(path):
-                user_context.logging.info(f"file in path {path} exists!")
-                return path
-            user_context.logging.warning(f"file in path {path} does not exists!")
-            sleep(self._poll_interval.seconds)
+        user_context.logging.info(f"Sensing file in path {path}...")
+        wait_for_file(
+            path,
+            ctx.file_access.exists,
+            poll_interval=self._poll_interval.total_seconds(),
+            max_poll_interval=self._max_poll_interval.total_seconds() if self._max_poll_interval else None,
+            backoff=self._backoff,
+            jitter=self._jitter,
+            mode=self._mode,
+            log=user_context.logging.warning,
+        )
+        user_context.logging.info(f"file in path {path} exists!")
+        return path
 
 
 # %% [markdown]
@@ -110,6 +130,9 @@ sensor = WaitForObjectStoreFile(
     name="my-objectstore-sensor",
     metadata=TaskMetadata(retries=10, timeout=timedelta(minutes=20)),
     poll_interval=timedelta(seconds=1),
+    max_poll_interval=timedelta(minutes=1),
+    backoff=2.0,
+    jitter=0.1,
 )
 
 
@@ -304,7 +304,8 @@ def plot_with_plotly(x: List[float], y: List[float], labels: List[str]):
             font=dict(size=15, color="black", family="Sans Serif"),
         )
     logger.info("Generating the Word Embedding Plot using Nebula Deck")
-    nebulakit.Deck("Word Embeddings", io.to_html(fig, full_html=True))
+    # load plotly.js from the CDN rather than inlining several megabytes of JavaScript into the deck
+    nebulakit.Deck("Word Embeddings", io.to_html(fig, full_html=True, include_plotlyjs="cdn"))
 
 
 # %% [markdown]
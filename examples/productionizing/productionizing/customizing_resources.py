@@ -75,6 +75,9 @@ if __name__ == "__main__":
     print(count_unique_numbers(x=[1, 1, 2]))
     print(my_workflow(x=[1, 1, 2]))
 
+# %% [markdown]
+# To choose the requests and limits of a task from measurements rather than guesses, see {ref}`resource_profiling`.
+
 # %% [markdown]
 # :::{note}
 # To alter the limits of the default platform configuration, change the [admin config](https://github.com/nebulaclouds/nebula/blob/b16ffd76934d690068db1265ac9907a278fba2ee/deployment/eks/nebula_helm_generated.yaml#L203-L213) and [namespace level quota](https://github.com/nebulaclouds/nebula/blob/b16ffd76934d690068db1265ac9907a278fba2ee/deployment/eks/nebula_helm_generated.yaml#L214-L240) on the cluster.
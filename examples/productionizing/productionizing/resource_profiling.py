@@ -0,0 +1,381 @@
+# %% [markdown]
+# (resource_profiling)=
+#
+# # Right-Sizing Task Resources
+#
+# ```{eval-rst}
+# .. tags:: Deployment, Infrastructure, Advanced
+# ```
+#
+# The {doc}`customizing resources <customizing_resources>` example declares requests and limits such as
+# `Resources(cpu="1", mem="100Mi")`, but it is rarely clear which numbers a task needs. Requests that are too high
+# reserve nodes that sit idle, and a memory limit that is too low gets the task killed with an out-of-memory error
+# once it runs on real data.
+#
+# This example profiles a workflow locally with representative inputs. It runs every task in a child process,
+# samples its CPU usage while it runs, and records its peak resident memory. From these, it recommends requests and
+# limits with some headroom, flags the tasks whose declared memory limit is lower than the memory they used, and
+# returns the recommendations as a dictionary that can be pasted into the task decorators or `with_overrides`.
+#
+# First, import the dependencies.
+# %%
+import contextlib
+import importlib
+import math
+import multiprocessing
+import os
+import re
+import resource
+import time
+import typing
+from dataclasses import dataclass
+
+from nebulakit import Resources
+from nebulakit.core.python_function_task import PythonFunctionTask
+from nebulakit.models.task import Resources as ResourcesModel
+
+from .customizing_resources import my_pipeline, my_workflow
+
+
+# %% [markdown]
+# ## Measuring a task
+#
+# The task runs in a fresh process, started with the `spawn` method, which receives only the function to run and its
+# arguments. Its memory is therefore that of the container of the task: the interpreter, the modules the task imports
+# and its inputs, but not the memory of the profiling process or the outputs of earlier tasks, as a forked process
+# would inherit.
+#
+# The child tells the parent when it starts the task, so the time spent starting the interpreter is not counted.
+# While the task runs, the CPU time the child has used so far is read from `/proc` every `interval` seconds, which
+# gives the number of cores it used in each interval. Once the task returns, the child measures its own CPU time with
+# `getrusage` and its peak resident memory, `VmHWM` in `/proc/self/status`, so a short spike of memory between two
+# samples is not missed, and sends them back with the outputs. `ru_maxrss` is not used for the memory, since Linux
+# carries it over from the forked process that the `spawn` method replaces with a new interpreter.
+# %%
+@dataclass
+class Measurement:
+    wall_seconds: float
+    cpu_seconds: float
+    peak_cores: float
+    peak_memory: int
+
+    @property
+    def mean_cores(self) -> float:
+        return self.cpu_seconds / self.wall_seconds if self.wall_seconds else 0.0
+
+
+def _cpu_seconds(pid: int) -> typing.Optional[float]:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the fields after the command name, which is in parentheses, start at the state, the third field
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _peak_memory() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                # the value is in kibibytes
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("The peak memory of the process is not reported in /proc/self/status")
+
+
+def _measure_in_child(writer, fn: typing.Callable, args: tuple):
+    writer.send(None)
+    start, before = time.monotonic(), resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        succeeded, result = True, fn(*args)
+    except BaseException as e:
+        succeeded, result = False, e
+    wall_seconds, after = time.monotonic() - start, resource.getrusage(resource.RUSAGE_SELF)
+    measurement = Measurement(
+        wall_seconds=wall_seconds,
+        cpu_seconds=(after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime),
+        peak_cores=0.0,
+        peak_memory=_peak_memory(),
+    )
+    try:
+        writer.send((succeeded, result, measurement))
+    except Exception:
+        # the outputs or the exception cannot be pickled
+        writer.send((False, RuntimeError(repr(result)), measurement))
+
+
+def run_measured(fn: typing.Callable, *args, interval: float = 0.05) -> typing.Tuple[typing.Any, Measurement]:
+    mp_ctx = multiprocessing.get_context("spawn")
+    reader, writer = mp_ctx.Pipe(duplex=False)
+    process = mp_ctx.Process(target=_measure_in_child, args=(writer, fn, args))
+    process.start()
+    writer.close()
+    try:
+        reader.recv()
+        last_sampled_at, last_cpu_seconds, peak_cores = time.monotonic(), _cpu_seconds(process.pid) or 0.0, 0.0
+        # the outputs are read as soon as they are sent, so a child with large outputs does not block on a full pipe
+        while not reader.poll(interval):
+            sampled_at, cpu_seconds = time.monotonic(), _cpu_seconds(process.pid)
+            if cpu_seconds is not None:
+                peak_cores = max(peak_cores, (cpu_seconds - last_cpu_seconds) / (sampled_at - last_sampled_at))
+                last_sampled_at, last_cpu_seconds = sampled_at, cpu_seconds
+        succeeded, result, measurement = reader.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError(f"The task process exited with code {process.exitcode} without returning its outputs")
+    finally:
+        reader.close()
+    process.join()
+
+    if not succeeded:
+        raise result
+    # a task that returns before the first sample used at least its mean number of cores
+    measurement.peak_cores = min(max(peak_cores, measurement.mean_cores), os.cpu_count() or 1)
+    return result, measurement
+
+
+# %% [markdown]
+# ## Profiling a workflow
+#
+# `ResourceProfiler.profile` runs a workflow locally while `PythonFunctionTask.execute` is replaced with a version that
+# measures every call. Dynamic workflows are not measured themselves, but the tasks they run are.
+# The child process imports the task by the module and name of its function, so, as for registration, the tasks
+# have to be defined at the top level of a module.
+# The profiler also records the limits that the nodes of the workflow set with `with_overrides`, which replace the
+# limits declared by their tasks.
+# %%
+def _execute_task(module: str, name: str, inputs: typing.Dict[str, typing.Any]) -> typing.Any:
+    return getattr(importlib.import_module(module), name).execute(**inputs)
+
+
+def _overridden_limits(workflow) -> typing.Dict[str, Resources]:
+    limits = {}
+    for node in workflow.nodes:
+        resources = getattr(node, "_resources", None)
+        if resources is None or not resources.limits:
+            continue
+        entries = {entry.name: entry.value for entry in resources.limits}
+        limits[node.run_entity.name] = Resources(
+            cpu=entries.get(ResourcesModel.ResourceName.CPU), mem=entries.get(ResourcesModel.ResourceName.MEMORY)
+        )
+    return limits
+
+
+class ResourceProfiler:
+    def __init__(self, interval: float = 0.05):
+        self._interval = interval
+        self.tasks: typing.Dict[str, PythonFunctionTask] = {}
+        self.measurements: typing.Dict[str, typing.List[Measurement]] = {}
+        self.overridden_limits: typing.Dict[str, Resources] = {}
+
+    @contextlib.contextmanager
+    def measuring(self):
+        execute = PythonFunctionTask.execute
+        profiler = self
+
+        def measured_execute(task: PythonFunctionTask, **kwargs) -> typing.Any:
+            if task.execution_mode != PythonFunctionTask.ExecutionBehavior.DEFAULT:
+                return execute(task, **kwargs)
+            function = task.task_function
+            outputs, measurement = run_measured(
+                _execute_task, function.__module__, function.__name__, kwargs, interval=profiler._interval
+            )
+            profiler.tasks[task.name] = task
+            profiler.measurements.setdefault(task.name, []).append(measurement)
+            return outputs
+
+        PythonFunctionTask.execute = measured_execute
+        try:
+            yield self
+        finally:
+            PythonFunctionTask.execute = execute
+
+    def profile(self, workflow, **inputs) -> typing.Any:
+        with self.measuring():
+            outputs = workflow(**inputs)
+        self.overridden_limits.update(_overridden_limits(workflow))
+        return outputs
+
+
+# %% [markdown]
+# ## Recommendations
+#
+# Across all the runs of a task:
+#
+# - the CPU request is the highest mean number of cores used by a run, and the CPU limit the peak number of cores used
+#   in a sampling interval, and
+# - the memory request is the peak memory of the task, since memory cannot be taken back from a running task the way
+#   CPU time can, and the memory limit leaves more room above the peak.
+#
+# `headroom` and `limit_headroom` are added on top, as a fraction of the measured value. CPU is rounded up to 50
+# millicores and memory to 16Mi. A memory limit below the peak memory would get the task killed, and is reported
+# as an out-of-memory risk.
+# %%
+MEMORY_UNITS = {
+    "": 1,
+    "k": 10**3,
+    "M": 10**6,
+    "G": 10**9,
+    "T": 10**12,
+    "Ki": 2**10,
+    "Mi": 2**20,
+    "Gi": 2**30,
+    "Ti": 2**40,
+}
+
+
+def parse_cpu(quantity: str) -> float:
+    return float(quantity[:-1]) / 1000 if quantity.endswith("m") else float(quantity)
+
+
+def parse_memory(quantity: str) -> int:
+    match = re.fullmatch(r"([0-9.]+)([A-Za-z]*)", quantity.strip())
+    if match is None or match.group(2) not in MEMORY_UNITS:
+        raise ValueError(f"Unsupported memory quantity {quantity}")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
+
+
+def format_cpu(cores: float) -> str:
+    return f"{max(1, math.ceil(cores * 20)) * 50}m"
+
+
+def format_memory(size: float) -> str:
+    return f"{max(1, math.ceil(size / (16 * 2**20))) * 16}Mi"
+
+
+@dataclass
+class Recommendation:
+    task: str
+    runs: int
+    mean_cores: float
+    peak_cores: float
+    peak_memory: int
+    declared_requests: Resources
+    declared_limits: Resources
+    requests: Resources
+    limits: Resources
+
+    @property
+    def would_oom(self) -> bool:
+        return self.declared_limits.mem is not None and self.peak_memory > parse_memory(self.declared_limits.mem)
+
+    @property
+    def over_requested(self) -> typing.List[str]:
+        over = []
+        if self.declared_requests.cpu and parse_cpu(self.declared_requests.cpu) > 2 * parse_cpu(self.requests.cpu):
+            over.append("cpu")
+        if self.declared_requests.mem and parse_memory(self.declared_requests.mem) > 2 * parse_memory(
+            self.requests.mem
+        ):
+            over.append("mem")
+        return over
+
+
+def recommend(
+    profiler: ResourceProfiler, headroom: float = 0.2, limit_headroom: float = 0.5
+) -> typing.List[Recommendation]:
+    recommendations = []
+    for name, measurements in profiler.measurements.items():
+        resources = profiler.tasks[name].resources
+        overridden = profiler.overridden_limits.get(name, Resources())
+        mean_cores = max(m.mean_cores for m in measurements)
+        peak_cores = max(m.peak_cores for m in measurements)
+        peak_memory = max(m.peak_memory for m in measurements)
+        recommendations.append(
+            Recommendation(
+                task=name,
+                runs=len(measurements),
+                mean_cores=mean_cores,
+                peak_cores=peak_cores,
+                peak_memory=peak_memory,
+                declared_requests=resources.requests,
+                declared_limits=Resources(
+                    cpu=overridden.cpu or resources.limits.cpu, mem=overridden.mem or resources.limits.mem
+                ),
+                requests=Resources(
+                    cpu=format_cpu(mean_cores * (1 + headroom)), mem=format_memory(peak_memory * (1 + headroom))
+                ),
+                limits=Resources(
+                    cpu=format_cpu(max(peak_cores, mean_cores) * (1 + limit_headroom)),
+                    mem=format_memory(peak_memory * (1 + limit_headroom)),
+                ),
+            )
+        )
+    return recommendations
+
+
+# %% [markdown]
+# ## Report
+#
+# `report` prints the measurements and recommendations of every task, and `patch` returns them as a dictionary from
+# task names to `requests` and `limits`, which `as_resources` turns into the arguments of `@task` or `with_overrides`:
+#
+# ```python
+# overrides = as_resources(patch(recommendations)["productionizing.customizing_resources.count_unique_numbers"])
+# count_unique_numbers(x=x).with_overrides(**overrides)
+# ```
+# %%
+def patch(recommendations: typing.List[Recommendation]) -> typing.Dict[str, typing.Dict[str, typing.Dict[str, str]]]:
+    return {
+        r.task: {
+            "requests": {"cpu": r.requests.cpu, "mem": r.requests.mem},
+            "limits": {"cpu": r.limits.cpu, "mem": r.limits.mem},
+        }
+        for r in recommendations
+    }
+
+
+def as_resources(entry: typing.Dict[str, typing.Dict[str, str]]) -> typing.Dict[str, Resources]:
+    return {kind: Resources(**quantities) for kind, quantities in entry.items()}
+
+
+def _quantities(resources: Resources) -> str:
+    return f"{resources.cpu or '-'}/{resources.mem or '-'}"
+
+
+def report(recommendations: typing.List[Recommendation]):
+    width = max([len("task")] + [len(r.task) for r in recommendations])
+    print(
+        f"{'task':<{width}} {'runs':>4} {'mean cores':>10} {'peak cores':>10} {'peak mem':>9} "
+        f"{'declared req':>14} {'declared lim':>14} {'recommended req':>16} {'recommended lim':>16}"
+    )
+    for r in recommendations:
+        print(
+            f"{r.task:<{width}} {r.runs:>4} {r.mean_cores:>10.2f} {r.peak_cores:>10.2f} {r.peak_memory / 2**20:>7.0f}Mi "
+            f"{_quantities(r.declared_requests):>14} {_quantities(r.declared_limits):>14} "
+            f"{_quantities(r.requests):>16} {_quantities(r.limits):>16}"
+        )
+    for r in recommendations:
+        if r.would_oom:
+            print(
+                f"OOM risk: {r.task} used {r.peak_memory / 2**20:.0f}Mi, above its memory limit of {r.declared_limits.mem}"
+            )
+        if r.over_requested:
+            print(f"Over-requested: {r.task} requests more than twice the {' and '.join(r.over_requested)} it uses")
+
+
+# %% [markdown]
+# ## Profiling the customizing resources example
+#
+# The workflows of the {doc}`customizing resources <customizing_resources>` example count the unique numbers of a
+# list. With a list of a million numbers, `count_unique_numbers` needs the interpreter, nebulakit, its input list and
+# the set of unique numbers at once, which comes close to its memory limit of 150Mi, while `square` needs little more
+# memory than the interpreter itself.
+# %%
+def benchmark(n: int = 1_000_000):
+    profiler = ResourceProfiler()
+    x = [i % (n // 2) for i in range(n)]
+    profiler.profile(my_workflow, x=x)
+    profiler.profile(my_pipeline, x=x)
+
+    recommendations = recommend(profiler)
+    report(recommendations)
+    print()
+    print(patch(recommendations))
+
+
+# %% [markdown]
+# You can profile the workflows locally, on Linux, as follows:
+# %%
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,224 @@
+# %% [markdown]
+# (batch_file_sensor)=
+#
+# # Batch File Sensor
+#
+# The {doc}`file sensor <file_sensor_example>` example waits for a single path. A pipeline that waits for hundreds of
+# partition files, such as `s3://my-s3-bucket/date=*/part-*.parquet`, needs one `FileSensor` per file, and every poll
+# of every sensor sends an `exists` request to the object store.
+#
+# This example defines two sensors that wait for a batch of files under a prefix with a single listing per poll:
+#
+# - `PrefixSensor` waits until at least `expected_count` files under the prefix match a glob pattern, and
+# - `ManifestSensor` waits until every file of a manifest exists under the prefix.
+#
+# Sensors run in the agent, which polls all of them from one process. The sensors share a listing cache there,
+# so sensors that watch the same prefix share one listing per `listing_ttl` seconds.
+#
+# First, import the required libraries.
+# %%
+import asyncio
+import fnmatch
+import os
+import tempfile
+import threading
+import time
+import typing
+from dataclasses import dataclass
+
+import fsspec
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.utils import get_protocol
+from nebulakit import task, workflow
+from nebulakit.sensor.base_sensor import BaseSensor
+
+
+# %% [markdown]
+# ## Listing cache
+#
+# The cache keeps the relative paths of all files under a prefix for `ttl` seconds. A poll that finds no fresh listing
+# starts one, and concurrent polls of the same prefix wait for that listing instead of starting their own.
+# Asynchronous filesystems, such as `s3fs` and `gcsfs`, are listed on the event loop of the agent; others are listed
+# on a thread, so a slow listing does not block the other sensors.
+# %%
+class ListingCache:
+    def __init__(self, clock: typing.Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self._listings: typing.Dict[str, typing.Tuple[typing.FrozenSet[str], float]] = {}
+        self._in_flight: typing.Dict[typing.Tuple[int, str], asyncio.Future] = {}
+
+    @staticmethod
+    async def _list(prefix: str) -> typing.FrozenSet[str]:
+        protocol = get_protocol(prefix)
+        fs = fsspec.filesystem(protocol, asynchronous=protocol != "file")
+        root = fs._strip_protocol(prefix).rstrip("/") + "/"
+        if fs.async_impl:
+            paths = await fs._find(root)
+        else:
+            paths = await asyncio.get_running_loop().run_in_executor(None, fs.find, root)
+        return frozenset(path[len(root) :] for path in paths if path.startswith(root))
+
+    async def list(self, prefix: str, ttl: float) -> typing.FrozenSet[str]:
+        cached = self._listings.get(prefix)
+        if cached is not None and self._clock() - cached[1] < ttl:
+            return cached[0]
+
+        # futures belong to the event loop that created them, so listings are only shared within a loop
+        key = (id(asyncio.get_running_loop()), prefix)
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            return await asyncio.shield(in_flight)
+
+        future = self._in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            listed_at = self._clock()
+            paths = await self._list(prefix)
+            self._listings[prefix] = (paths, listed_at)
+            future.set_result(paths)
+            return paths
+        except Exception as e:
+            future.set_exception(e)
+            # the waiting sensors receive the error, so the future does not need to be awaited here
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+
+LISTING_CACHE = ListingCache()
+
+
+# %% [markdown]
+# ## Sensors
+#
+# Like `FileSensor`, both sensors take their inputs from the signature of `poke`, and their configuration from
+# `config`, which is passed to the agent along with the task. The glob pattern is matched against the paths relative
+# to the prefix, and a `*` in the pattern also matches `/`.
+# %%
+@dataclass
+class BatchSensorConfig:
+    listing_ttl: float = 5.0
+
+
+class PrefixSensor(BaseSensor):
+    def __init__(self, name: str, config: typing.Optional[BatchSensorConfig] = None, **kwargs):
+        self._config = config or BatchSensorConfig()
+        super().__init__(name=name, sensor_config=self._config, **kwargs)
+
+    async def poke(self, prefix: str, pattern: str, expected_count: int) -> bool:
+        paths = await LISTING_CACHE.list(prefix, self._config.listing_ttl)
+        return sum(1 for path in paths if fnmatch.fnmatchcase(path, pattern)) >= expected_count
+
+
+class ManifestSensor(BaseSensor):
+    def __init__(self, name: str, config: typing.Optional[BatchSensorConfig] = None, **kwargs):
+        self._config = config or BatchSensorConfig()
+        super().__init__(name=name, sensor_config=self._config, **kwargs)
+
+    async def poke(self, prefix: str, manifest: typing.List[str]) -> bool:
+        paths = await LISTING_CACHE.list(prefix, self._config.listing_ttl)
+        return paths.issuperset(path.lstrip("/") for path in manifest)
+
+
+# %% [markdown]
+# A single sensor now waits for all the partitions of a day.
+# %%
+partitions_sensor = PrefixSensor(name="partitions_sensor")
+manifest_sensor = ManifestSensor(name="manifest_sensor")
+
+
+@task()
+def t1():
+    print("SUCCEEDED")
+
+
+@workflow()
+def wf():
+    partitions = partitions_sensor(
+        prefix="s3://my-s3-bucket/events", pattern="date=2023-10-01/part-*.parquet", expected_count=24
+    )
+    partitions >> t1()
+
+
+@workflow()
+def manifest_wf():
+    manifest_sensor(prefix="s3://my-s3-bucket/events", manifest=["date=2023-10-01/_SUCCESS"]) >> t1()
+
+
+# %% [markdown]
+# ## Benchmark
+#
+# The benchmark stands in for an object store with a local directory, behind a filesystem that counts requests
+# and adds `latency` seconds to each of them. `n_files` partition files land in the directory over `n_polls` polls,
+# while `n_pipelines` pipelines wait for all of them. It compares one `FileSensor` per file and pipeline, which sends
+# one `exists` request per poll until its file lands, with one `PrefixSensor` per pipeline.
+# %%
+class CountingFileSystem(LocalFileSystem):
+    protocol = "counting"
+    latency = 0.002
+    requests = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def _count(cls):
+        with cls._lock:
+            cls.requests += 1
+        time.sleep(cls.latency)
+
+    @classmethod
+    def _strip_protocol(cls, path):
+        return super()._strip_protocol(path[len("counting://") :] if path.startswith("counting://") else path)
+
+    def exists(self, path, **kwargs):
+        self._count()
+        return super().exists(path, **kwargs)
+
+    def find(self, path, *args, **kwargs):
+        self._count()
+        return super().find(path, *args, **kwargs)
+
+
+def benchmark(n_files: int = 200, n_pipelines: int = 5, n_polls: int = 10, latency: float = 0.002):
+    fsspec.register_implementation("counting", CountingFileSystem, clobber=True)
+    CountingFileSystem.latency = latency
+    fs = fsspec.filesystem("counting")
+    sensor = PrefixSensor(name="benchmark_sensor", config=BatchSensorConfig(listing_ttl=0.5))
+
+    with tempfile.TemporaryDirectory() as directory:
+        prefix = f"counting://{directory}"
+        paths = [f"date=2023-10-01/part-{i:05d}.parquet" for i in range(n_files)]
+        waiting = [(pipeline, path) for pipeline in range(n_pipelines) for path in paths]
+        requests = {"FileSensor": 0, "PrefixSensor": 0}
+        seconds = {"FileSensor": 0.0, "PrefixSensor": 0.0}
+
+        for poll in range(n_polls):
+            for path in paths[poll * n_files // n_polls : (poll + 1) * n_files // n_polls]:
+                os.makedirs(os.path.join(directory, os.path.dirname(path)), exist_ok=True)
+                open(os.path.join(directory, path), "w").close()
+
+            CountingFileSystem.requests, start = 0, time.perf_counter()
+            waiting = [(pipeline, path) for pipeline, path in waiting if not fs.exists(f"{prefix}/{path}")]
+            requests["FileSensor"] += CountingFileSystem.requests
+            seconds["FileSensor"] += time.perf_counter() - start
+
+            async def poll_pipelines():
+                pokes = [sensor.poke(prefix, "date=*/part-*.parquet", n_files) for _ in range(n_pipelines)]
+                return await asyncio.gather(*pokes)
+
+            CountingFileSystem.requests, start = 0, time.perf_counter()
+            done = asyncio.run(poll_pipelines())
+            requests["PrefixSensor"] += CountingFileSystem.requests
+            seconds["PrefixSensor"] += time.perf_counter() - start
+            time.sleep(0.5)
+
+    assert not waiting and all(done)
+    print(f"{'sensor':>14} {'requests':>10} {'seconds':>8}")
+    for name in requests:
+        print(f"{name:>14} {requests[name]:>10} {seconds[name]:>8.2f}")
+
+
+# %% [markdown]
+# You can run the benchmark locally as follows:
+# %%
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,237 @@
+"""
+Collects the ImageSpecs declared across the examples, computes their image tags without building them, and proposes
+a smaller set of shared images.
+
+Example modules are read with ``ast`` rather than imported, so the analysis does not need the dependencies of every
+example, such as Spark or PyTorch, to be installed. Only ImageSpecs whose arguments are literals are analyzed;
+the others are reported as dynamic. Tags are cached per module, keyed by the content of the module and of the
+requirements files it refers to, so unchanged modules are not analyzed again.
+
+Usage: python scripts/analyze_image_specs.py [--examples examples] [--max-added-packages 3]
+"""
+
+import argparse
+import ast
+import dataclasses
+import hashlib
+import importlib.metadata
+import json
+import os
+import re
+import typing
+
+from nebulakit.image_spec.image_spec import ImageSpec, calculate_hash_from_image_spec
+
+CACHE_VERSION = 1
+# packages that make an image much larger, and are not added to images that do not already have them, along with the
+# plugins that install them, such as nebulakitplugins-ray
+DEFAULT_KEEP_APART = ("tensorflow", "torch", "pyspark", "ray", "dask")
+MERGEABLE_FIELDS = ("name", "packages", "apt_packages")
+
+
+@dataclasses.dataclass
+class DeclaredSpec:
+    module: str
+    variable: typing.Optional[str]
+    line: int
+    kwargs: typing.Optional[dict]
+    tag: typing.Optional[str] = None
+
+    @property
+    def location(self) -> str:
+        return f"{self.module}:{self.line}" + (f" ({self.variable})" if self.variable else "")
+
+
+def _is_image_spec_call(node: ast.AST) -> bool:
+    if not isinstance(node, ast.Call):
+        return False
+    func = node.func
+    return (isinstance(func, ast.Name) and func.id == "ImageSpec") or (
+        isinstance(func, ast.Attribute) and func.attr == "ImageSpec"
+    )
+
+
+def _literal_kwargs(call: ast.Call) -> typing.Optional[dict]:
+    if call.args:
+        return None
+    try:
+        return {keyword.arg: ast.literal_eval(keyword.value) for keyword in call.keywords}
+    except ValueError:
+        return None
+
+
+def declared_specs(module_path: str, source: str) -> typing.List[DeclaredSpec]:
+    tree = ast.parse(source, filename=module_path)
+    variables = {
+        id(node.value): node.targets[0].id
+        for node in ast.walk(tree)
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)
+    }
+    return [
+        DeclaredSpec(module_path, variables.get(id(node)), node.lineno, _literal_kwargs(node))
+        for node in ast.walk(tree)
+        if _is_image_spec_call(node)
+    ]
+
+
+def _requirements_path(module_path: str, kwargs: dict) -> typing.Optional[str]:
+    requirements = kwargs.get("requirements")
+    return os.path.join(os.path.dirname(module_path), requirements) if requirements else None
+
+
+def image_tag(spec: DeclaredSpec) -> str:
+    kwargs = dict(spec.kwargs)
+    requirements = _requirements_path(spec.module, kwargs)
+    if requirements:
+        kwargs["requirements"] = requirements
+    return calculate_hash_from_image_spec(ImageSpec(**kwargs))
+
+
+def _cache_key(module_path: str, source: str, specs: typing.List[DeclaredSpec]) -> str:
+    digest = hashlib.sha256(source.encode())
+    for spec in specs:
+        requirements = _requirements_path(module_path, spec.kwargs or {})
+        if requirements and os.path.exists(requirements):
+            with open(requirements, "rb") as f:
+                digest.update(f.read())
+    # the way tags are computed can change between nebulakit versions
+    return f"{CACHE_VERSION}:{importlib.metadata.version('nebulakit')}:{digest.hexdigest()}"
+
+
+def collect(examples_dir: str, cache: dict) -> typing.List[DeclaredSpec]:
+    specs = []
+    for root, _, names in sorted(os.walk(examples_dir)):
+        for name in sorted(names):
+            if not name.endswith(".py"):
+                continue
+            module_path = os.path.join(root, name)
+            with open(module_path) as f:
+                source = f.read()
+            if "ImageSpec(" not in source:
+                continue
+            module_specs = declared_specs(module_path, source)
+            key = _cache_key(module_path, source, module_specs)
+            cached = cache.get(module_path)
+            if cached and cached["key"] == key:
+                tags = cached["tags"]
+            else:
+                tags = [image_tag(spec) if spec.kwargs is not None else None for spec in module_specs]
+                cache[module_path] = {"key": key, "tags": tags}
+            for spec, tag in zip(module_specs, tags):
+                spec.tag = tag
+            specs.extend(module_specs)
+    return specs
+
+
+def _package_name(requirement: str) -> str:
+    return re.split(r"[\s<>=!~;\[]", requirement, maxsplit=1)[0].lower().replace("_", "-")
+
+
+def _is_kept_apart(name: str, keep_apart: typing.Iterable[str]) -> bool:
+    return any(name == package or name.endswith(f"-{package}") for package in keep_apart)
+
+
+def _group_key(spec: DeclaredSpec) -> str:
+    return json.dumps({k: v for k, v in sorted(spec.kwargs.items()) if k not in MERGEABLE_FIELDS}, sort_keys=True)
+
+
+@dataclasses.dataclass
+class SharedImage:
+    members: typing.List[DeclaredSpec]
+    packages: typing.Dict[str, str]
+    apt_packages: typing.Set[str]
+
+    @classmethod
+    def of(cls, spec: DeclaredSpec) -> "SharedImage":
+        packages = {_package_name(p): p for p in spec.kwargs.get("packages") or []}
+        return cls([spec], packages, set(spec.kwargs.get("apt_packages") or []))
+
+    def merge(self, spec: DeclaredSpec, max_added_packages: int, keep_apart: typing.Iterable[str]) -> bool:
+        other = SharedImage.of(spec)
+        if any(self.packages[name] != other.packages[name] for name in self.packages.keys() & other.packages.keys()):
+            return False
+        added_to_self = other.packages.keys() - self.packages.keys()
+        added_to_other = self.packages.keys() - other.packages.keys()
+        if max(len(added_to_self), len(added_to_other)) > max_added_packages:
+            return False
+        if any(_is_kept_apart(name, keep_apart) for name in added_to_self | added_to_other):
+            return False
+        self.members.append(spec)
+        self.packages.update(other.packages)
+        self.apt_packages |= other.apt_packages
+        return True
+
+    def kwargs(self, name: str) -> dict:
+        kwargs = dict(self.members[0].kwargs)
+        kwargs["name"] = name
+        if self.packages:
+            kwargs["packages"] = sorted(self.packages.values())
+        if self.apt_packages:
+            kwargs["apt_packages"] = sorted(self.apt_packages)
+        return kwargs
+
+
+def propose(
+    specs: typing.List[DeclaredSpec], max_added_packages: int, keep_apart: typing.Iterable[str]
+) -> typing.List[SharedImage]:
+    groups: typing.Dict[str, typing.List[SharedImage]] = {}
+    unshared: typing.Dict[str, SharedImage] = {}
+    # specs with the most packages go first, so smaller specs are merged into them rather than the other way around
+    for spec in sorted(
+        (spec for spec in specs if spec.kwargs is not None), key=lambda s: -len(s.kwargs.get("packages") or [])
+    ):
+        # a spec without packages may only name a prebuilt image, such as the image of a plugin, whose contents are not
+        # known here, and a spec with requirements installs packages that are not listed in the spec
+        if not spec.kwargs.get("packages") or spec.kwargs.get("requirements"):
+            key = json.dumps(spec.kwargs, sort_keys=True)
+            if key in unshared:
+                unshared[key].members.append(spec)
+            else:
+                unshared[key] = SharedImage.of(spec)
+            continue
+        images = groups.setdefault(_group_key(spec), [])
+        if not any(image.merge(spec, max_added_packages, keep_apart) for image in images):
+            images.append(SharedImage.of(spec))
+    return [image for images in groups.values() for image in images] + list(unshared.values())
+
+
+def report(specs: typing.List[DeclaredSpec], images: typing.List[SharedImage]):
+    literal_specs = [spec for spec in specs if spec.kwargs is not None]
+    tags = {(spec.kwargs.get("registry"), spec.kwargs.get("name", "nebulakit"), spec.tag) for spec in literal_specs}
+    print(f"{len(specs)} ImageSpecs declared, {len(tags)} distinct images\n")
+    for spec in specs:
+        tag = spec.tag or "dynamic, not analyzed"
+        print(f"  {spec.location}: {(spec.kwargs or {}).get('name', 'nebulakit')}:{tag}")
+
+    print(f"\nProposed shared images: {len(images)}\n")
+    for i, image in enumerate(images):
+        # identical specs already build a single image
+        if len({json.dumps(spec.kwargs, sort_keys=True) for spec in image.members}) == 1:
+            continue
+        kwargs = image.kwargs(f"nebula-examples-{i}")
+        print(f"  ImageSpec(**{kwargs})")
+        print(f"    tag {image_tag(DeclaredSpec(image.members[0].module, None, 0, kwargs))}")
+        for spec in image.members:
+            print(f"    replaces {spec.location}")
+    print(f"\nRegistering every example would build {len(images)} images instead of {len(tags)}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--examples", default="examples")
+    parser.add_argument("--cache", default=".image_spec_cache.json")
+    parser.add_argument("--max-added-packages", type=int, default=3)
+    parser.add_argument("--keep-apart", nargs="*", default=list(DEFAULT_KEEP_APART))
+    args = parser.parse_args()
+
+    try:
+        with open(args.cache) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        cache = {}
+
+    specs = collect(args.examples, cache)
+    with open(args.cache, "w") as f:
+        json.dump(cache, f, indent=2)
+
+    report(specs, propose(specs, args.max_added_packages, args.keep_apart))
@@ -0,0 +1,34 @@
+#!/bin/sh
+#
+# Builds the images of the raw container examples from their per-language Dockerfiles, and pushes them with --push.
+#
+# Usage: ./scripts/build-raw-container-images.sh [--push] [<tag>]
+
+set -e
+
+push=false
+if [ "$1" = "--push" ]
+then
+    push=true
+    shift
+fi
+
+tag="$1"
+if [ -z "$tag" ]
+then
+    tag="v3"
+fi
+
+languages_dir=examples/customizing_dependencies/raw-containers-supporting-files/per-language
+
+for dir in "$languages_dir"/*/
+do
+    language=$(basename -- "$dir")
+    image_uri=ghcr.io/nebulaclouds/rawcontainers-"$language":"$tag"
+    docker build "$dir" -t "$image_uri"
+    if [ "$push" = true ]
+    then
+        docker push "$image_uri"
+    fi
+    echo "$image_uri"
+done